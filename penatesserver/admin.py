@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from django.contrib import admin
 
+from penatesserver.glpi.models import CheckTemplate
 from penatesserver.models import Host, MountPoint, Service
 
 __author__ = 'Matthieu Gallet'
@@ -22,6 +23,19 @@ class HostAdmin(admin.ModelAdmin):
     search_fields = ('fqdn', 'serial', 'main_ip_address', 'admin_ip_address', )
 
 
+class CheckTemplateAdmin(admin.ModelAdmin):
+    fields = (
+        ('name', 'enabled', 'position'),
+        ('use', 'service_description'),
+        'check_command',
+        ('icon_set', 'check_interval', 'notifications_enabled'),
+    )
+    list_display = ('name', 'service_description', 'check_command', 'enabled', 'position', )
+    list_editable = ('enabled', 'position', )
+    search_fields = ('name', 'service_description', 'check_command', )
+
+
 admin.site.register(Host, admin_class=HostAdmin)
+admin.site.register(CheckTemplate, admin_class=CheckTemplateAdmin)
 admin.site.register(MountPoint)
 admin.site.register(Service)
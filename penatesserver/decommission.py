@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""Removal of many hosts at once, with all their dependent objects:
+
+  * DNS records in forward and reverse zones (A/AAAA/CNAME, SSHFP, TLSA, SRV, MX, NS, PTR), the SOA serial of each
+    modified zone being updated only once,
+  * services (only the service names that are not also provided by another host), Shinken checks and mount points,
+  * Kerberos principals (in a single kadmin session),
+  * certificates (revoked at once, with a single CRL regeneration).
+
+Dependent objects are collected with a few set-based queries, then deleted by batches in a transaction per database.
+"""
+from __future__ import unicode_literals
+import os
+import threading
+
+from django.conf import settings
+from django.db import transaction, router
+import netaddr
+
+from penatesserver.glpi.models import ShinkenService
+from penatesserver.kerb import delete_principals
+from penatesserver.models import Host, Service, MountPoint
+from penatesserver.pki.constants import CESSATION_OF_OPERATION, SERVICE, KERBEROS_DC, PRINTER, TIME_SERVER, \
+    SERVICE_1024
+from penatesserver.pki.service import PKI
+from penatesserver.pki.views import service_entry
+from penatesserver.powerdns.models import Record, Domain
+from penatesserver.utils import principal_from_hostname, chunks
+from penatesserver.views import entry_from_hostname, admin_entry_from_hostname
+
+__author__ = 'Matthieu Gallet'
+
+decommission_state = threading.local()
+
+
+class HostDecommission(object):
+    """Remove a set of hosts and everything that depends on them.
+
+    >>> decommission = HostDecommission(['machine1.infra.test.example.org', 'machine2.infra.test.example.org'])
+    >>> report = decommission.run(dry_run=True)  # doctest: +SKIP
+
+    :param fqdns: fqdns of the hosts (`hostname.infra.domain`)
+    :param batch_size: max number of objects deleted by a single query
+    :param reason: reason of the certificate revocations
+    :param ip_addresses: extra IP addresses whose PTR records must be removed (e.g. of already deleted hosts)
+    """
+    service_roles = (SERVICE, KERBEROS_DC, PRINTER, TIME_SERVER, SERVICE_1024)
+
+    def __init__(self, fqdns, batch_size=500, reason=CESSATION_OF_OPERATION, ip_addresses=None):
+        self.fqdns = set(fqdns)
+        self.ip_addresses = set(ip_addresses or [])
+        self.batch_size = batch_size
+        self.reason = reason
+        self.hosts = {}  # {pk: fqdn}
+        self.names = set()
+        self.services = {}  # {pk: str(service)}
+        self.service_hostnames = set()
+        self.shinken_services = set()
+        self.mount_points = set()
+        self.principals = set()
+        self.principal_errors = {}  # {principal: error message}
+        self.records = {}  # {pk: (domain_id, name, type, content)}
+        self.certificate_entries = []
+        self.serials = []
+
+    def collect(self):
+        """Collect all objects to remove, without modifying anything"""
+        ip_addresses = set(self.ip_addresses)
+        for pk, fqdn, main_ip_address, admin_ip_address in Host.objects.filter(fqdn__in=self.fqdns)\
+                .values_list('pk', 'fqdn', 'main_ip_address', 'admin_ip_address'):
+            self.hosts[pk] = fqdn
+            ip_addresses |= {main_ip_address, admin_ip_address}
+        self.names = set()
+        for fqdn in self.fqdns:
+            admin_fqdn = '%s.%s%s' % (fqdn.partition('.')[0], settings.PDNS_ADMIN_PREFIX, settings.PENATES_DOMAIN)
+            self.names |= {fqdn, admin_fqdn}
+            self.principals.add(principal_from_hostname(fqdn, settings.PENATES_REALM))
+            self.certificate_entries += [entry_from_hostname(fqdn), admin_entry_from_hostname(admin_fqdn)]
+        self.mount_points = set(MountPoint.objects.filter(host_id__in=list(self.hosts)).values_list('pk', flat=True))
+        self.shinken_services = set(ShinkenService.objects.filter(host_name__in=self.names)
+                                    .values_list('pk', flat=True))
+        # services
+        service_values = list(Service.objects.filter(fqdn__in=self.names)
+                              .values_list('pk', 'fqdn', 'scheme', 'hostname', 'port', 'protocol', 'kerberos_service'))
+        hostnames = {x[3] for x in service_values}
+        # service names that are also provided by remaining hosts are kept
+        shared_hostnames = set(Service.objects.filter(hostname__in=hostnames).exclude(fqdn__in=self.names)
+                               .values_list('hostname', flat=True))
+        self.service_hostnames = hostnames - shared_hostnames
+        tlsa_names = set()
+        for pk, fqdn, scheme, hostname, port, protocol, kerberos_service in service_values:
+            self.services[pk] = '%s://%s:%s/' % (scheme, hostname, port)
+            if kerberos_service:
+                self.principals.add('%s/%s@%s' % (kerberos_service, fqdn, settings.PENATES_REALM))
+            if hostname in self.service_hostnames:
+                tlsa_names |= {'_%d._%s.%s' % (port, protocol, hostname), '_%s.%s' % (protocol, hostname)}
+        for hostname in self.service_hostnames:
+            self.certificate_entries += [service_entry(hostname, role) for role in self.service_roles]
+        pki = PKI()
+        if os.path.isfile(pki.index_path):
+            self.certificate_entries += [x[2] for x in pki.get_expiry_index()
+                                         if x[2].commonName in self.names | self.service_hostnames]
+            self.serials = pki.get_valid_serials(self.certificate_entries)
+        # DNS records: a few indexed queries instead of a OR on name and content
+        all_names = self.names | self.service_hostnames
+        record_fields = ('pk', 'domain_id', 'name', 'type', 'content')
+        for names in chunks(all_names, self.batch_size):
+            self.add_records(Record.objects.filter(name__in=names).exclude(type='SOA').values_list(*record_fields))
+            self.add_records(Record.objects.filter(content__in=names).exclude(type='SOA')
+                             .values_list(*record_fields))
+        for names in chunks(tlsa_names, self.batch_size):
+            self.add_records(Record.objects.filter(name__in=names).values_list(*record_fields))
+        # SRV records ("weight port target") can only be in the parent domains of their target
+        parent_domains = {name.split('.', index)[-1] for name in all_names for index in range(1, name.count('.') + 1)}
+        domain_ids = []
+        for names in chunks(parent_domains, self.batch_size):
+            domain_ids += list(Domain.objects.filter(name__in=names).values_list('pk', flat=True))
+        for pks in chunks(domain_ids, self.batch_size):
+            self.add_records([x for x in Record.objects.filter(domain_id__in=pks, type='SRV')
+                              .values_list(*record_fields) if x[4] and x[4].split()[-1] in all_names])
+        # reverse records of the IP addresses of these hosts, unless they point to another existing name
+        ip_addresses |= {x[3] for x in self.records.values() if x[2] in ('A', 'AAAA')}
+        reverse_names = set()
+        for ip_address in ip_addresses:
+            try:
+                reverse_names.add(netaddr.IPAddress(ip_address).reverse_dns[:-1])
+            except (netaddr.core.AddrFormatError, TypeError, ValueError):
+                continue
+        ptr_records = []
+        for names in chunks(reverse_names, self.batch_size):
+            ptr_records += list(Record.objects.filter(name__in=names, type='PTR').values_list(*record_fields))
+        targets = {x[4] for x in ptr_records} - all_names
+        remaining_targets = set()
+        for names in chunks(targets, self.batch_size):
+            remaining_targets |= set(Record.objects.filter(name__in=names, type__in=['A', 'AAAA', 'CNAME'])
+                                     .exclude(pk__in=list(self.records)).values_list('name', flat=True))
+        self.add_records([x for x in ptr_records if x[4] not in remaining_targets])
+        return self.report()
+
+    def add_records(self, values_list):
+        for pk, domain_id, name, record_type, content in values_list:
+            self.records[pk] = (domain_id, name, record_type, content)
+
+    def apply(self, delete_hosts=True):
+        """Remove all collected objects (:meth:`collect` must be called before)"""
+        with transaction.atomic(using=router.db_for_write(Record)):
+            for pks in chunks(self.records, self.batch_size):
+                Record.objects.filter(pk__in=pks).delete()
+            for domain in Domain.objects.filter(pk__in={x[0] for x in self.records.values()}):
+                domain.update_soa()
+        with transaction.atomic(using=router.db_for_write(Service)):
+            for pks in chunks(self.services, self.batch_size):
+                Service.objects.filter(pk__in=pks).delete()
+            for pks in chunks(self.shinken_services, self.batch_size):
+                ShinkenService.objects.filter(pk__in=pks).delete()
+            for pks in chunks(self.mount_points, self.batch_size):
+                MountPoint.objects.filter(pk__in=pks).delete()
+            if delete_hosts:
+                # dependent objects are already removed: the `post_delete` signal of each host must be ignored
+                decommission_state.active = True
+                try:
+                    for pks in chunks(self.hosts, self.batch_size):
+                        Host.objects.filter(pk__in=pks).delete()
+                finally:
+                    decommission_state.active = False
+        self.principal_errors = delete_principals(sorted(self.principals))
+        if self.serials:
+            PKI().revoke_certificates(self.serials, reason=self.reason)
+
+    def run(self, dry_run=False):
+        """Collect and (unless `dry_run` is True) remove all objects; return the report of :meth:`report`"""
+        report = self.collect()
+        if not dry_run:
+            self.apply()
+            report['principal_errors'] = self.principal_errors
+        return report
+
+    def report(self):
+        return {'hosts': sorted(self.hosts.values()), 'unknown_hosts': sorted(self.fqdns - set(self.hosts.values())),
+                'services': sorted(self.services.values()), 'shinken_services': len(self.shinken_services),
+                'mount_points': len(self.mount_points), 'principals': sorted(self.principals),
+                'records': sorted('%s %s %s' % x[1:] for x in self.records.values()),
+                'zones': len({x[0] for x in self.records.values()}), 'certificates': sorted(self.serials),
+                'principal_errors': self.principal_errors, }
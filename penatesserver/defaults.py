@@ -75,9 +75,21 @@ RUNNING_TESTS = False
 PENATES_SUBNETS = """10.19.1.0/24,10.19.1.1
 10.8.0.0/16,10.8.0.1"""
 
-LDAP_NAME = 'ldap://192.168.56.101/'
+LDAP_NAME = 'ldap://192.168.56.101/'  # several space-separated URIs can be given (tried in order)
 LDAP_USER = 'cn=admin,dc=test,dc=example,dc=org'
 LDAP_PASSWORD = 'toto'
+LDAP_POOL_SIZE = 10  # max number of idle bound connections kept by each process
+LDAP_POOL_MAX_LIFETIME = 3600  # in seconds
+LDAP_POOL_CHECK_INTERVAL = 60  # in seconds, idle connections are checked before being reused
+LDAP_TIMEOUT = 5  # in seconds
+LDAP_CACHE = 'default'  # cache used for LDAP lookups by name, uid or gid
+LDAP_CACHE_TIMEOUT = 300  # in seconds
+MONITORING_CACHE = 'default'  # cache used for the generated Shinken configuration (should be shared by all processes)
+MONITORING_CACHE_TIMEOUT = 3600  # in seconds, the configuration is also invalidated when a host or a service changes
+MONITORING_CONTACTS_CACHE_TIMEOUT = 600  # in seconds, LDAP users can also be modified outside Penates
+MONITORING_SESSION_DURATION = 3600  # in seconds, validity of the XML-RPC sessions (they can be refreshed)
+MONITORING_LOGIN_CACHE_TIMEOUT = 600  # in seconds, valid XML-RPC credentials are not checked again during this time
+MONITORING_MULTICALL_THREADS = 4  # number of threads evaluating the calls of a XML-RPC system.multicall
 
 PDNS_USER = 'powerdns'
 PDNS_PASSWORD = 'toto'
@@ -99,10 +111,12 @@ DATABASES = {
         'PORT': '{DATABASE_PORT}',
     },
     'ldap': {
-        'ENGINE': 'ldapdb.backends.ldap',
+        'ENGINE': 'penatesserver.ldappool',
         'NAME': '{LDAP_NAME}',
         'USER': '{LDAP_USER}',
         'PASSWORD': '{LDAP_PASSWORD}',
+        'OPTIONS': {'POOL_SIZE': '{LDAP_POOL_SIZE}', 'MAX_LIFETIME': '{LDAP_POOL_MAX_LIFETIME}',
+                    'CHECK_INTERVAL': '{LDAP_POOL_CHECK_INTERVAL}', 'TIMEOUT': '{LDAP_TIMEOUT}', },
     },
     'powerdns': {
         'ENGINE': '{PDNS_ENGINE}',
@@ -116,7 +130,7 @@ DATABASES = {
 }
 STORE_CLEARTEXT_PASSWORDS = False
 OFFER_HOST_KEYTABS = True
-DATABASE_ROUTERS = ['ldapdb.router.Router', 'penatesserver.routers.PowerdnsManagerDbRouter', ]
+DATABASE_ROUTERS = ['penatesserver.routers.LdapRouter', 'penatesserver.routers.PowerdnsManagerDbRouter', ]
 AUTH_USER_MODEL = 'penatesserver.DjangoUser'
 
 DEBUG = False
@@ -1,11 +1,110 @@
 # -*- coding: utf-8 -*-
-from django.db import models
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
 from django.utils import six
+from django.utils.crypto import get_random_string
 from django.utils.six import text_type
 
-from penatesserver.utils import clean_string
+from penatesserver.utils import clean_string, chunks
 
 __author__ = 'Matthieu Gallet'
+MONITORING_GENERATION_KEY = 'penatesserver.monitoring.generation'
+MONITORING_CONTACTS_KEY = 'penatesserver.monitoring.contacts'
+
+
+def get_monitoring_cache():
+    return caches[settings.MONITORING_CACHE]
+
+
+def get_monitoring_generation():
+    """Return a random string, changed each time a monitored object (host, service, Shinken service) is modified.
+    It is used in the key of all cached monitoring configurations."""
+    cache = get_monitoring_cache()
+    generation = cache.get(MONITORING_GENERATION_KEY)
+    if generation is None:
+        generation = get_random_string(12)
+        cache.set(MONITORING_GENERATION_KEY, generation, None)
+    return generation
+
+
+def invalidate_monitoring_cache(**kwargs):
+    """Invalidate all cached monitoring configurations (can be used as a signal receiver)"""
+    get_monitoring_cache().delete(MONITORING_GENERATION_KEY)
+
+
+def record_monitoring_changes(hosts=(), services=(), contacts=()):
+    """Record the modification of monitored objects in the change log (used by incremental synchronizations) and
+    invalidate the cached configurations.
+
+    :param hosts: fqdns of modified hosts (their Shinken services are also marked as modified)
+    :param services: fqdns of the hosts whose Shinken services are modified
+    :param contacts: names of modified users
+    """
+    hosts = set(hosts)
+    changes = [(MonitoringChange.HOSTS, hosts), (MonitoringChange.SERVICES, hosts | set(services)),
+               (MonitoringChange.CONTACTS, set(contacts))]
+    changes = [(kind, [x for x in keys if x]) for (kind, keys) in changes]
+    if not any(keys for (kind, keys) in changes):
+        return
+    with transaction.atomic():
+        # the counter row stays locked until the commit, so versions are committed in increasing order
+        version = MonitoringVersion.increment()
+        for kind, keys in changes:
+            for keys_chunk in chunks(keys, 500):
+                # only the last modification of each object is kept
+                MonitoringChange.objects.filter(kind=kind, key__in=keys_chunk).delete()
+            MonitoringChange.objects.bulk_create([MonitoringChange(kind=kind, key=x, version=version) for x in keys])
+        if hosts or services:
+            # cached configurations must not be computed again before the commit with the old generation
+            invalidate_monitoring_cache()
+            transaction.on_commit(invalidate_monitoring_cache)
+
+
+class MonitoringVersion(models.Model):
+    """Single-row counter of the versions of the monitoring configuration."""
+    value = models.IntegerField('value', default=0)
+
+    @classmethod
+    def increment(cls):
+        """Lock the counter until the end of the current transaction and return its new value"""
+        counter, created = cls.objects.select_for_update().get_or_create(pk=1)
+        counter.value += 1
+        counter.save(update_fields=['value'])
+        return counter.value
+
+    @classmethod
+    def get_value(cls):
+        values = list(cls.objects.filter(pk=1).values_list('value', flat=True))
+        return values[0] if values else 0
+
+
+class MonitoringChange(models.Model):
+    """Last modification of a monitored object, with the version of the configuration that includes it
+    (used by incremental synchronizations)."""
+    HOSTS = 'hosts'
+    SERVICES = 'services'
+    CONTACTS = 'contacts'
+    kind = models.CharField('kind', max_length=20, choices=[(HOSTS, HOSTS), (SERVICES, SERVICES),
+                                                            (CONTACTS, CONTACTS)])
+    key = models.CharField('key', max_length=255)
+    version = models.IntegerField('version', default=0, db_index=True)
+
+    class Meta(object):
+        index_together = [('kind', 'key')]
+
+    @classmethod
+    def get_version(cls):
+        """Return the current version of the monitoring configuration.
+        All changes up to this version are committed, since versions are allocated under a lock."""
+        return MonitoringVersion.get_value()
+
+    @classmethod
+    def get_changed_keys(cls, kind, since, version):
+        """Return the set of keys of the objects of the given kind modified after `since` (up to `version`)"""
+        return set(cls.objects.filter(kind=kind, version__gt=since, version__lte=version)
+                   .values_list('key', flat=True))
 
 
 class ShinkenService(models.Model):
@@ -111,13 +210,129 @@ class ShinkenService(models.Model):
             return '%s on %s' % (self.check_command, self.host_name)
 
     def to_dict(self):
-        values = {k: text_type(getattr(self, k)) for k in self.get_field_list() if getattr(self, k) is not None}
-        values['use'] = 'generic-service'
-        values.setdefault('service_description', '%s on %s' % (self.check_command, self.host_name))
-        values['service_description'] = clean_string(values['service_description'])
-        return values
+        return self.values_to_dict({k: getattr(self, k) for k in self.get_field_list()})
+
+    @staticmethod
+    def values_to_dict(values):
+        """Convert a dict of field values (e.g. a row of `ShinkenService.objects.values(*get_field_list())`) to the
+        dict expected by Shinken"""
+        result = {k: text_type(v) for (k, v) in values.items() if v is not None}
+        result['use'] = 'generic-service'
+        result.setdefault('service_description', '%s on %s' % (values['check_command'], values['host_name']))
+        result['service_description'] = clean_string(result['service_description'])
+        return result
+
+    @classmethod
+    def parse_definitions(cls, host_name, definitions):
+        """Validate a list of check definitions (dicts of field values, `check_command` being required)
+
+        :return: a dict {check_command: {field: value}}
+        :raise ValueError: if a definition is invalid
+        """
+        field_list = cls.get_field_list()
+        result = {}
+        for index, definition in enumerate(definitions):
+            if not isinstance(definition, dict) or not definition.get('check_command'):
+                raise ValueError('check %d: check_command is required' % index)
+            unknown_fields = set(definition) - set(field_list)
+            if unknown_fields:
+                raise ValueError('check %d: unknown fields %s' % (index, ', '.join(sorted(unknown_fields))))
+            service = cls(**definition)
+            service.host_name = host_name
+            try:
+                service.full_clean()
+            except ValidationError as e:
+                raise ValueError('check %d: %s' % (index, '; '.join('%s: %s' % (key, ' '.join(messages))
+                                                                    for (key, messages) in e.message_dict.items())))
+            result[service.check_command] = {key: getattr(service, key) for key in field_list}
+        return result
+
+    @classmethod
+    def synchronize(cls, host_name, definitions):
+        """Replace all Shinken services of a host by the given ones, in a single transaction: services are
+        identified by their `check_command`, modified ones are updated and missing ones are removed.
+
+        :param host_name: fqdn of the host
+        :param definitions: list of dicts of field values (see :meth:`parse_definitions`)
+        :return: (created, updated, deleted) counts
+        :raise ValueError: if a definition is invalid
+        """
+        new_values = cls.parse_definitions(host_name, definitions)
+        field_list = cls.get_field_list()
+        with transaction.atomic():
+            existing = {}
+            to_delete = []
+            for values in cls.objects.filter(host_name=host_name).values('pk', *field_list):
+                pk = values.pop('pk')
+                check_command = values['check_command']
+                if check_command in existing or check_command not in new_values:
+                    to_delete.append(pk)
+                else:
+                    existing[check_command] = (pk, values)
+            updated = 0
+            for check_command, (pk, values) in existing.items():
+                if values != new_values[check_command]:
+                    cls.objects.filter(pk=pk).update(**new_values[check_command])
+                    updated += 1
+            for pks in chunks(to_delete, 500):
+                cls.objects.filter(pk__in=pks).delete()
+            to_create = [cls(**values) for (check_command, values) in new_values.items()
+                         if check_command not in existing]
+            cls.objects.bulk_create(to_create)
+        if to_create or updated or to_delete:
+            record_monitoring_changes(services=[host_name])
+        return len(to_create), updated, len(to_delete)
+
+    _field_list = None
 
     @classmethod
     def get_field_list(cls):
-        # noinspection PyProtectedMember
-        return [x.name for x in cls._meta.get_fields() if x.name != 'id']
+        if cls._field_list is None:
+            # noinspection PyProtectedMember
+            cls._field_list = [x.name for x in cls._meta.get_fields() if x.name != 'id']
+        return cls._field_list
+
+
+class CheckTemplate(models.Model):
+    """Shinken service applied to each host. The description and the check command are formatted with the values
+    of each host: `%(fqdn)s`, `%(hostname)s`, `%(main_ip_address)s`, `%(admin_ip_address)s` and `%(admin_fqdn)s`
+    (so `%` must be written `%%`)."""
+    host_fields = ('fqdn', 'hostname', 'main_ip_address', 'admin_ip_address', 'admin_fqdn')
+    name = models.CharField('name', max_length=100, unique=True)
+    use = models.CharField('use', max_length=255, default='generic-service')
+    service_description = models.CharField('service_description', max_length=255)
+    check_command = models.CharField('check_command', max_length=255)
+    icon_set = models.CharField('icon_set', max_length=255, default=None, null=True, blank=True)
+    check_interval = models.IntegerField('check_interval', default=None, null=True, blank=True)
+    notifications_enabled = models.IntegerField('notifications_enabled', default=0, choices=[(0, '0'), (1, '1')])
+    enabled = models.BooleanField('enabled', default=True, db_index=True)
+    position = models.IntegerField('position', default=0)
+
+    class Meta(object):
+        ordering = ('position', 'pk')
+
+    def __str__(self):
+        if six.PY3:
+            return self.__unicode__()
+        return self.__unicode__().encode('utf-8')
+
+    def __unicode__(self):
+        return self.name
+
+    def clean(self):
+        sample = {x: x for x in self.host_fields}
+        for field in ('service_description', 'check_command'):
+            try:
+                getattr(self, field) % sample
+            except (KeyError, ValueError, TypeError) as e:
+                raise ValidationError({field: 'Invalid template (%s). Allowed values: %s' %
+                                              (e, ', '.join('%%(%s)s' % x for x in self.host_fields))})
+
+    def to_dict(self):
+        """Return the constant values of the generated Shinken services"""
+        result = {'use': self.use, 'notifications_enabled': text_type(self.notifications_enabled)}
+        if self.icon_set:
+            result['icon_set'] = self.icon_set
+        if self.check_interval is not None:
+            result['check_interval'] = text_type(self.check_interval)
+        return result
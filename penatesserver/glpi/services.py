@@ -1,149 +1,258 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
-import datetime
+import time
+
+from django.conf import settings
 from django.core.signing import Signer
+from django.utils.crypto import salted_hmac
 from django.utils.six import text_type
-from django.utils.translation import ugettext as _
-from penatesserver.glpi.models import ShinkenService
-from penatesserver.models import Host, Service
+from django.utils.translation import ugettext_lazy as _, get_language
+from penatesserver.glpi.models import ShinkenService, get_monitoring_cache, get_monitoring_generation, \
+    MonitoringChange, CheckTemplate, MONITORING_CONTACTS_KEY
+from penatesserver.models import Host, Service, User, AdminUser
+from penatesserver.utils import is_admin, chunks
 
 __author__ = 'Matthieu Gallet'
 signer = Signer()
-year_0 = datetime.datetime(1970, 1, 1, 0, 0, 0)
-session_duration_in_seconds = 600
+# per-process caches of verified sessions {signed session: (end time, login name)}
+# and of verified credentials {HMAC of login and password: end time}
+verified_sessions = {}
+verified_logins = {}
+max_verified_sessions = 1000
+
+
+def create_session(login_name):
+    """Return a new signed session, valid for `settings.MONITORING_SESSION_DURATION` seconds"""
+    end_time = int(time.time()) + settings.MONITORING_SESSION_DURATION
+    return signer.sign('%s:%s' % (end_time, login_name))
+
+
+def get_supervisor(login_name):
+    """Return the admin user with the `supervision` permission matching `login_name`, or None"""
+    users = list(AdminUser.objects.filter(username=login_name, user_permissions__codename='supervision')[0:1])
+    return users[0] if users else None
+
+
+def check_login(login_name, login_password):
+    """Return True if the given credentials belong to an admin user with the `supervision` permission.
+    Valid credentials are remembered for `settings.MONITORING_LOGIN_CACHE_TIMEOUT` seconds, so the password hash is
+    not computed again each time the supervision server logs in. The cache is keyed on the stored password hash,
+    so a changed password is immediately taken into account."""
+    user = get_supervisor(login_name)
+    if user is None:
+        return False
+    key = salted_hmac('penatesserver.monitoring.login',
+                      '%s:%s:%s' % (login_name, user.password, login_password)).hexdigest()
+    if verified_logins.get(key, 0) > time.time():
+        return True
+    if not user.check_password(login_password):
+        return False
+    if len(verified_logins) >= max_verified_sessions:
+        verified_logins.clear()
+    verified_logins[key] = time.time() + settings.MONITORING_LOGIN_CACHE_TIMEOUT
+    return True
 
 
-# noinspection PyUnusedLocal
 def check_session(request, args):
+    """Check the signed session given in the first argument of a RPC call and return the login name.
+    The signature of each session is only verified once per process, and at most once per HTTP request
+    (e.g. for all calls of a `system.multicall`).
+
+    :raise django.core.signing.BadSignature: if the session is not valid
+    :raise ValueError: if the session is expired
+    """
     session = args[0]['session']
-    session = signer.unsign(session)
-    end, sep, login_name = session.partition(':')
-    end = int(end)
-    if (datetime.datetime.utcnow() - year_0).total_seconds() > end:
-        raise ValueError
+    cached = getattr(request, 'monitoring_session', None)
+    if cached is None or cached[0] != session:
+        values = verified_sessions.get(session)
+        if values is None:
+            end, sep, login_name = signer.unsign(session).partition(':')
+            values = (int(end), login_name)
+            if len(verified_sessions) >= max_verified_sessions:
+                verified_sessions.clear()
+            verified_sessions[session] = values
+        cached = (session, ) + values
+        request.monitoring_session = cached
+    if time.time() > cached[1]:
+        raise ValueError('Session expired')
+    return cached[2]
+
+
+shinken_checks = {
+    # 'penates_dhcp': 'check_dhcp -r $ARG2$ -m $ARG1$',
+    'penates_dig': 'check_dig -l $ARG1$ -a $HOSTADDRESS$',
+    'penates_dig_2': 'check_dig -l $ARG1$ -a $ARG2$',
+    'penates_http': 'check_http -H $ARG1$ -p $ARG2$',
+    'penates_https': 'check_http -S --sni -H $ARG1$ -p $ARG2$ -C 15 -e 401',
+    'penates_imap': 'check_imap -H $HOSTNAME$ -p $ARG1$',
+    'penates_imaps': 'check_simap -H $HOSTNAME$ -p $ARG1$ -D 15',
+    'penates_ldap': 'check_ldap -H $HOSTADDRESS$ -p $ARG1$ -3',
+    'penates_ldaps': 'check_ldaps -H $HOSTADDRESS$ -p $ARG1$ -3',
+    'penates_ntp': 'check_ntp_peer -H $HOSTADDRESS$',
+    'penates_smtp': 'check_smtp -H $HOSTADDRESS$ -p $ARG1$',
+    'penates_smtps': 'check_ssmtp -H $HOSTADDRESS$ -p $ARG1$ -D 15',
+    'penates_udp': 'check_udp -H $HOSTADDRESS$ -p $ARG1$'
+}
+
+
+# checks of each service, by scheme: (template, description, check command, check command with encryption,
+# encryption levels that use the second check command)
+SERVICE_CHECKS = {
+    'http': [('local-service', _('HTTP on %(fqdn)s:%(port)s'), 'penates_http!%(fqdn)s!%(port)s',
+              'penates_https!%(fqdn)s!%(port)s', ('tls', 'starttls'))],
+    'ssh': [('local-service', _('SSH TCP on %(fqdn)s:%(port)s'), 'check_tcp!%(port)s', None, ()),
+            ('generic-service', _('SSH process on %(fqdn)s:%(port)s'), 'check_nrpe!check_sshd', None, ())],
+    'imap': [('local-service', _('IMAP on %(fqdn)s:%(port)s'), 'penates_imap!%(port)s', 'penates_imaps!%(port)s',
+              ('tls', ))],
+    'ldap': [('local-service', _('LDAP on %(fqdn)s:%(port)s'), 'penates_ldap!%(port)s', 'penates_ldaps!%(port)s',
+              ('tls', ))],
+    'krb': [('local-service', _('Kerberos on %(fqdn)s:%(port)s'), 'check_tcp!%(port)s', None, ())],
+    'dns': [('local-service', _('DNS on %(fqdn)s:%(port)s'), 'check_tcp!%(port)s', None, ())],
+    'smtp': [('local-service', _('SMTP on %(fqdn)s:%(port)s'), 'penates_smtp!%(port)s', 'penates_smtps!%(port)s',
+              ('tls', ))],
+    'ntp': [('local-service', _('NTP on %(fqdn)s:%(port)s'), 'penates_ntp!%(fqdn)s', None, ())],
+    'dkim': [],
+}
+SERVICE_CHECKS['carddav'] = SERVICE_CHECKS['caldav'] = SERVICE_CHECKS['http']
+TCP_SERVICE_CHECKS = [('local-service', _('TCP on %(fqdn)s:%(port)s'), 'check_tcp!%(port)s', None, ())]
+
+
+def get_shinken_commands():
+    return [{'command_name': key, 'command_line': '$PLUGINSDIR$/%s' % value}
+            for (key, value) in sorted(shinken_checks.items())]
+
+
+def restrict(queryset, field, keys):
+    """Return a list of querysets restricted to the objects whose `field` is in `keys`, by chunks
+    (or the whole queryset when `keys` is None)"""
+    if keys is None:
+        return [queryset]
+    return [queryset.filter(**{'%s__in' % field: x}) for x in chunks(keys, 500)]
+
+
+def get_contact_password(name):
+    """Return the dummy (but stable) password of a Shinken contact"""
+    return salted_hmac('penatesserver.monitoring.contact', name).hexdigest()[:20]
+
+
+def get_shinken_contacts(names=None):
+    """Return the Shinken contacts of all users (or only of the given users). Only the `uid`, `displayName` and `mail`
+    attributes are retrieved, with a paged LDAP search. The list of all contacts is cached for
+    `settings.MONITORING_CONTACTS_CACHE_TIMEOUT` seconds, or until a user is modified (the key contains the
+    monitoring version)."""
+    cache = get_monitoring_cache()
+    key = '%s.%s' % (MONITORING_CONTACTS_KEY, MonitoringChange.get_version())
+    if names is None:
+        result = cache.get(key)
+        if result is not None:
+            return result
+    field_names = ['name', 'display_name', 'mail']
+    if names is None:
+        attr_names = User.get_ldap_attributes(field_names)
+        users = [User.from_ldap_entry(dn, attrs, field_names)
+                 for (dn, attrs) in User.paged_search(User.get_ldap_filter(), attr_names)]
+    else:
+        users = User.get_projected_objects(sorted(names), field_names)
+    result = [{'contact_name': user.name, 'alias': user.display_name, 'use': 'generic-contact',
+               'password': get_contact_password(user.name), 'email': user.mail,
+               'is_admin': '1' if is_admin(user.name) else '0', } for user in users]
+    if names is None:
+        cache.set(key, result, settings.MONITORING_CONTACTS_CACHE_TIMEOUT)
+    return result
+
+
+def iter_shinken_hosts(fqdns=None):
+    admin_suffix = '.%s%s' % (settings.PDNS_ADMIN_PREFIX, settings.PENATES_DOMAIN)
+    for queryset in restrict(Host.objects.all(), 'fqdn', fqdns):
+        for fqdn, admin_ip_address in queryset.values_list('fqdn', 'admin_ip_address').iterator():
+            hostname = fqdn.partition('.')[0]
+            yield {'host_name': fqdn, 'alias': '%s%s,%s' % (hostname, admin_suffix, hostname), 'display_name': fqdn,
+                   'address': admin_ip_address, }
 
 
 def get_shinken_services():
+    """Return the Shinken services of all hosts and services; the result is cached until a host, a service or a
+    Shinken service is modified (the key contains the monitoring version, so other processes do not rely on a
+    shared cache to see the change)"""
+    cache = get_monitoring_cache()
+    key = 'penatesserver.monitoring.services.%s.%s.%s' % (get_monitoring_generation(), MonitoringChange.get_version(),
+                                                         get_language())
+    result = cache.get(key)
+    if result is None:
+        result = generate_shinken_services()
+        cache.set(key, result, settings.MONITORING_CACHE_TIMEOUT)
+    return result
+
+
+def expand_check_templates(fqdns=None):
+    """Return the Shinken services defined by the enabled :class:`CheckTemplate` for all hosts (or only for the given
+    hosts), with a single pass over the hosts"""
+    # (constant values, description template, command template) of each check
+    checks = [(template.to_dict(), template.service_description, template.check_command)
+              for template in CheckTemplate.objects.filter(enabled=True)]
+    if not checks:
+        return []
     result = []
-    for host in Host.objects.all():
-        result.append({'use': 'local-service', 'host_name': host.fqdn,
-                       'service_description': _('Check SSH %(fqdn)s') % {'fqdn': host.fqdn, },
-                       'check_command': 'check_ssh',
-                       'notifications_enabled': '0', })
-        result.append({'use': 'local-service', 'host_name': host.fqdn,
-                       'service_description': _('Ping %(fqdn)s') % {'fqdn': host.fqdn, },
-                       'check_command': 'check_ping!100.0,20%!500.0,60%', 'icon_set': 'server',
-                       'notifications_enabled': '0', })
-        result.append({'use': 'generic-service', 'host_name': host.fqdn,
-                       'service_description': _('Check all disks on %(fqdn)s') % {'fqdn': host.fqdn, },
-                       'check_command': 'check_nrpe!check_all_disk', 'icon_set': 'disk',
-                       'notifications_enabled': '0', })
-        result.append({'use': 'generic-service', 'host_name': host.fqdn,
-                       'service_description': _('Check swap on %(fqdn)s') % {'fqdn': host.fqdn, },
-                       'check_command': 'check_nrpe!check_swap',
-                       'notifications_enabled': '0', })
-        result.append({'use': 'generic-service', 'host_name': host.fqdn,
-                       'service_description': _('Check number of processes on %(fqdn)s') % {'fqdn': host.fqdn, },
-                       'check_command': 'check_nrpe!check_total_procs', 'icon_set': 'server',
-                       'notifications_enabled': '0', })
-        result.append({'use': 'generic-service', 'host_name': host.fqdn,
-                       'service_description': _('Check number of zombie processes on %(fqdn)s') % {'fqdn': host.fqdn, },
-                       'check_command': 'check_nrpe!check_zombie_procs', 'icon_set': 'server',
-                       'notifications_enabled': '0', })
-        result.append({'use': 'generic-service', 'host_name': host.fqdn,
-                       'service_description': _('Check load on %(fqdn)s') % {'fqdn': host.fqdn, },
-                       'check_command': 'check_nrpe!check_load', 'icon_set': 'server',
-                       'notifications_enabled': '0', })
-        result.append({'use': 'local-service', 'host_name': host.fqdn, 'icon_set': 'server',
-                       'service_description': _('Check DNS %(fqdn)s') % {'fqdn': host.fqdn, },
-                       'check_command': 'penates_dig_2!%s!%s' % (host.fqdn, host.main_ip_address),
-                       'notifications_enabled': '0', 'check_interval': text_type(4 * 60), })
-        result.append({'use': 'local-service', 'host_name': host.fqdn, 'icon_set': 'server',
-                       'service_description': _('Check DNS %(fqdn)s') % {'fqdn': host.fqdn, },
-                       'check_command': 'penates_dig_2!%s!%s' % (host.admin_fqdn, host.admin_ip_address),
-                       'notifications_enabled': '0', 'check_interval': text_type(4 * 60), })
-        result.append({'use': 'generic-service', 'host_name': host.fqdn, 'icon_set': 'server',
-                       'service_description': _('Check admin certificate on %(fqdn)s') % {'fqdn': host.fqdn, },
-                       'check_command': 'check_nrpe!check_cert_admin',
-                       'notifications_enabled': '0', 'check_interval': text_type(24 * 60), })
-        result.append({'use': 'generic-service', 'host_name': host.fqdn, 'icon_set': 'server',
-                       'service_description': _('Check host certificate on %(fqdn)s') % {'fqdn': host.fqdn, },
-                       'check_command': 'check_nrpe!check_cert_host',
-                       'notifications_enabled': '0', 'check_interval': text_type(24 * 60), })
-    for service in Service.objects.all():
-        if service.scheme in ('http', 'carddav', 'caldav'):
-            check = 'penates_http!%s!%s' if service.encryption == 'none' else 'penates_https!%s!%s'
-            result.append({'use': 'local-service',
-                           'host_name': service.fqdn,
-                           'service_description': _('HTTP on %(fqdn)s:%(port)s') %
-                           {'fqdn': service.hostname, 'port': service.port, },
-                           'check_command': check % (service.hostname, service.port),
-                           'notifications_enabled': '0', })
-        elif service.scheme == 'ssh':
-            result.append({'use': 'local-service',
-                           'host_name': service.fqdn,
-                           'service_description': _('SSH TCP on %(fqdn)s:%(port)s') %
-                           {'fqdn': service.hostname, 'port': service.port, },
-                           'check_command': 'check_tcp!%s' % service.port,
-                           'notifications_enabled': '0', })
-            result.append({'use': 'generic-service', 'host_name': service.fqdn,
-                           'service_description': _('SSH process on %(fqdn)s:%(port)s') %
-                           {'fqdn': service.hostname, 'port': service.port, },
-                           'check_command': 'check_nrpe!check_sshd', 'notifications_enabled': '0', })
-        elif service.scheme == 'imap':
-            check = 'penates_imaps!%s' if service.encryption == 'tls' else 'penates_imap!%s'
-            result.append({'use': 'local-service',
-                           'host_name': service.fqdn,
-                           'service_description': _('IMAP on %(fqdn)s:%(port)s') %
-                           {'fqdn': service.hostname, 'port': service.port, },
-                           'check_command': check % service.port,
-                           'notifications_enabled': '0', })
-        elif service.scheme == 'ldap':
-            check = 'penates_ldaps!%s' if service.encryption == 'tls' else 'penates_ldap!%s'
-            result.append({'use': 'local-service',
-                           'host_name': service.fqdn,
-                           'service_description': _('LDAP on %(fqdn)s:%(port)s') %
-                           {'fqdn': service.hostname, 'port': service.port, },
-                           'check_command': check % service.port,
-                           'notifications_enabled': '0', })
-        elif service.scheme == 'krb':
-            result.append({'use': 'local-service',
-                           'host_name': service.fqdn,
-                           'service_description': _('Kerberos on %(fqdn)s:%(port)s') %
-                           {'fqdn': service.hostname, 'port': service.port, },
-                           'check_command': 'check_tcp!%s' % service.port,
-                           'notifications_enabled': '0', })
-        elif service.scheme == 'dns':
-            result.append({'use': 'local-service',
-                           'host_name': service.fqdn,
-                           'service_description': _('DNS on %(fqdn)s:%(port)s') %
-                           {'fqdn': service.hostname, 'port': service.port, },
-                           'check_command': 'check_tcp!%s' % service.port,
-                           'notifications_enabled': '0', })
-        elif service.scheme == 'smtp':
-            check = 'penates_smtps!%s' if service.encryption == 'tls' else 'penates_smtp!%s'
-            result.append({'use': 'local-service',
-                           'host_name': service.fqdn,
-                           'service_description': _('SMTP on %(fqdn)s:%(port)s') %
-                           {'fqdn': service.hostname, 'port': service.port, },
-                           'check_command': check % service.port,
-                           'notifications_enabled': '0', })
-        elif service.scheme == 'ntp':
-            result.append({'use': 'local-service',
-                           'host_name': service.fqdn,
-                           'service_description': _('NTP on %(fqdn)s:%(port)s') %
-                           {'fqdn': service.hostname, 'port': service.port, },
-                           'check_command': 'penates_ntp!%s' % service.hostname,
-                           'notifications_enabled': '0', })
-        elif service.scheme == 'dkim':
-            pass
-        elif service.protocol == 'tcp':
-            result.append({'use': 'local-service',
-                           'host_name': service.fqdn,
-                           'service_description': _('TCP on %(fqdn)s:%(port)s') %
-                           {'fqdn': service.hostname, 'port': service.port, },
-                           'check_command': 'check_tcp!%s' % service.port,
-                           'notifications_enabled': '0', })
-    for service in ShinkenService.objects.all():
-        result.append(service.to_dict())
+    admin_suffix = '.%s%s' % (settings.PDNS_ADMIN_PREFIX, settings.PENATES_DOMAIN)
+    for queryset in restrict(Host.objects.all(), 'fqdn', fqdns):
+        for fqdn, main_ip_address, admin_ip_address in queryset.values_list('fqdn', 'main_ip_address',
+                                                                            'admin_ip_address'):
+            hostname = fqdn.partition('.')[0]
+            values = {'fqdn': fqdn, 'hostname': hostname, 'main_ip_address': main_ip_address,
+                      'admin_ip_address': admin_ip_address, 'admin_fqdn': hostname + admin_suffix}
+            for constants, description, command in checks:
+                check = constants.copy()
+                check['host_name'] = fqdn
+                check['service_description'] = description % values
+                check['check_command'] = command % values
+                result.append(check)
+    return result
+
+
+def generate_shinken_services(fqdns=None):
+    """Return the Shinken services of all hosts, or only of the given hosts"""
+    result = expand_check_templates(fqdns)
+    service_checks = {}  # translated rules, only for the schemes that are used
+    for queryset in restrict(Service.objects.all(), 'fqdn', fqdns):
+        for fqdn, scheme, hostname, port, protocol, encryption in \
+                queryset.values_list('fqdn', 'scheme', 'hostname', 'port', 'protocol', 'encryption'):
+            if scheme not in service_checks:
+                rules = SERVICE_CHECKS.get(scheme, TCP_SERVICE_CHECKS)
+                service_checks[scheme] = [(use, text_type(description), command, secure_command, encryptions)
+                                          for (use, description, command, secure_command, encryptions) in rules]
+            if scheme not in SERVICE_CHECKS and protocol != 'tcp':
+                continue
+            values = {'fqdn': hostname, 'port': port}
+            for use, description, command, secure_command, encryptions in service_checks[scheme]:
+                if encryption in encryptions:
+                    command = secure_command
+                result.append({'use': use, 'host_name': fqdn, 'service_description': description % values,
+                               'check_command': command % values, 'notifications_enabled': '0', })
+    field_list = ShinkenService.get_field_list()
+    for queryset in restrict(ShinkenService.objects.all(), 'host_name', fqdns):
+        for values in queryset.values(*field_list):
+            result.append(ShinkenService.values_to_dict(values))
     return result
+
+
+def get_monitoring_delta(kind, since):
+    """Return the objects of the given kind (`hosts`, `services` or `contacts`) modified after the version `since`,
+    as a dict `{'version': current version, 'upserts': [modified objects], 'deleted': [keys of removed objects]}`.
+
+    Services are grouped by host: `deleted` lists the hosts whose services must all be replaced by the ones
+    in `upserts`.
+    """
+    version = MonitoringChange.get_version()
+    keys = MonitoringChange.get_changed_keys(kind, since, version)
+    if kind == MonitoringChange.HOSTS:
+        upserts = list(iter_shinken_hosts(keys))
+        deleted = keys - {x['host_name'] for x in upserts}
+    elif kind == MonitoringChange.SERVICES:
+        upserts = generate_shinken_services(keys)
+        deleted = keys
+    elif kind == MonitoringChange.CONTACTS:
+        upserts = get_shinken_contacts(keys)
+        deleted = keys - {x['contact_name'] for x in upserts}
+    else:
+        raise ValueError('Invalid kind of monitored objects: %s' % kind)
+    return {'version': version, 'upserts': upserts, 'deleted': sorted(deleted)}
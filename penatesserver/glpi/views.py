@@ -1,48 +1,116 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
-import datetime
+import hashlib
 import json
 
-from django.contrib.auth.models import Permission
+from django.conf import settings
 from django.core.exceptions import PermissionDenied
-from django.http import HttpResponse
-from django.utils.crypto import get_random_string
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags, quote_etag
+from django.utils.six import text_type
+from django.utils.translation import get_language
 from penatesserver.glpi.forms import ShinkenServiceForm
-from penatesserver.glpi.models import ShinkenService
+from penatesserver.glpi.models import ShinkenService, record_monitoring_changes, get_monitoring_cache, \
+    get_monitoring_generation, MonitoringChange
 
-from penatesserver.glpi.services import get_shinken_services, year_0, session_duration_in_seconds, signer, check_session
+from penatesserver.glpi.services import get_shinken_services, check_login, create_session, \
+    check_session, get_supervisor, iter_shinken_hosts, get_shinken_commands, get_shinken_contacts, get_monitoring_delta
 
 from penatesserver.glpi.xmlrpc import XMLRPCSite
 from penatesserver.glpi.xmlrpc import register_rpc_method
-from penatesserver.models import Host, User, AdminUser
 from penatesserver.utils import hostname_from_principal, is_admin
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 
 __author__ = 'Matthieu Gallet'
 
-XML_RPC_SITE = XMLRPCSite()
-
-shinken_checks = {
-    # 'penates_dhcp': 'check_dhcp -r $ARG2$ -m $ARG1$',
-    'penates_dig': 'check_dig -l $ARG1$ -a $HOSTADDRESS$',
-    'penates_dig_2': 'check_dig -l $ARG1$ -a $ARG2$',
-    'penates_http': 'check_http -H $ARG1$ -p $ARG2$',
-    'penates_https': 'check_http -S --sni -H $ARG1$ -p $ARG2$ -C 15 -e 401',
-    'penates_imap': 'check_imap -H $HOSTNAME$ -p $ARG1$',
-    'penates_imaps': 'check_simap -H $HOSTNAME$ -p $ARG1$ -D 15',
-    'penates_ldap': 'check_ldap -H $HOSTADDRESS$ -p $ARG1$ -3',
-    'penates_ldaps': 'check_ldaps -H $HOSTADDRESS$ -p $ARG1$ -3',
-    'penates_ntp': 'check_ntp_peer -H $HOSTADDRESS$',
-    'penates_smtp': 'check_smtp -H $HOSTADDRESS$ -p $ARG1$',
-    'penates_smtps': 'check_ssmtp -H $HOSTADDRESS$ -p $ARG1$ -D 15',
-    'penates_udp': 'check_udp -H $HOSTADDRESS$ -p $ARG1$'
+XML_RPC_SITE = XMLRPCSite(multicall_threads=settings.MONITORING_MULTICALL_THREADS)
+
+MSGPACK_CONTENT_TYPE = 'application/x-msgpack'
+# exported monitoring objects: kind -> (function returning the objects, is the result valid for a monitoring generation)
+MONITORING_EXPORTS = {
+    'hosts': (iter_shinken_hosts, True),
+    'services': (get_shinken_services, True),
+    'commands': (get_shinken_commands, True),
+    'contacts': (get_shinken_contacts, False),
 }
+MONITORING_DELTAS = {MonitoringChange.HOSTS, MonitoringChange.SERVICES, MonitoringChange.CONTACTS}
 
 
 def xmlrpc(request):
     return XML_RPC_SITE.dispatch(request)
 
 
+def encode_monitoring_objects(values, use_msgpack=False):
+    if not isinstance(values, (list, dict)):
+        values = list(values)
+    if use_msgpack:
+        return msgpack.packb(values, use_bin_type=True)
+    return json.dumps(values, separators=(',', ':')).encode('utf-8')
+
+
+def monitoring_export(request, kind):
+    """Return the Shinken hosts, services, contacts or commands, as compact JSON (or msgpack when
+    `?format=msgpack` is given or when the client accepts `application/x-msgpack` and msgpack is installed).
+
+    An ETag is sent with each response, so clients can use `If-None-Match` to only download changed configurations.
+    Serialized hosts, services and commands are cached until a monitored object is modified.
+
+    The current version of the configuration is sent in the `X-Monitoring-Version` header. Hosts, services and
+    contacts modified after a given version can be retrieved with `?since=<version>`
+    (see :func:`penatesserver.glpi.services.get_monitoring_delta`).
+    """
+    if not is_admin(request.user.username) and not request.user.has_perm('penatesserver.supervision'):
+        return HttpResponse(status=403)
+    use_msgpack = msgpack is not None and (request.GET.get('format') == 'msgpack' or
+                                           MSGPACK_CONTENT_TYPE in request.META.get('HTTP_ACCEPT', ''))
+    content_type = MSGPACK_CONTENT_TYPE if use_msgpack else 'application/json'
+    if 'since' in request.GET:
+        try:
+            since = int(request.GET['since'])
+        except ValueError:
+            return HttpResponse('since must be an integer', status=400, content_type='text/plain')
+        if kind not in MONITORING_DELTAS:
+            return HttpResponse('%s cannot be incrementally retrieved' % kind, status=400, content_type='text/plain')
+        delta = get_monitoring_delta(kind, since)
+        return HttpResponse(encode_monitoring_objects(delta, use_msgpack=use_msgpack), content_type=content_type)
+    # the version must be read before the objects, so no modification can be missed by the next incremental query;
+    # it is also used in the cache key, so a cached content is never older than the sent version
+    version = MonitoringChange.get_version()
+    get_values, cacheable = MONITORING_EXPORTS[kind]
+    if_none_match = parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
+    if cacheable:
+        # the ETag is cached separately, so conditional requests neither hash nor load the serialized content
+        cache = get_monitoring_cache()
+        key = 'penatesserver.monitoring.export.%s.%s.%s.%s.%s' % (kind, 'msgpack' if use_msgpack else 'json',
+                                                                 get_monitoring_generation(), version,
+                                                                 get_language())
+        etag, content = cache.get(key + '.etag'), None
+        if etag is None or etag not in if_none_match:
+            cached = cache.get(key)  # (etag, content)
+            if cached is None:
+                content = encode_monitoring_objects(get_values(), use_msgpack=use_msgpack)
+                etag = hashlib.md5(content).hexdigest()
+                cache.set_many({key: (etag, content), key + '.etag': etag}, settings.MONITORING_CACHE_TIMEOUT)
+            else:
+                etag, content = cached
+    else:
+        content = encode_monitoring_objects(get_values(), use_msgpack=use_msgpack)
+        etag = hashlib.md5(content).hexdigest()
+    if etag in if_none_match:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(content, content_type=content_type)
+    response['ETag'] = quote_etag(etag)
+    response['X-Monitoring-Version'] = str(version)
+    response['Vary'] = 'Accept'
+    return response
+
+
 def register_service(request, check_command):
     fqdn = hostname_from_principal(request.user.username)
     status = 204
@@ -59,6 +127,7 @@ def register_service(request, check_command):
                 .update(**values) == 0:
             ShinkenService(host_name=fqdn, check_command=check_command, **values).save()
             return HttpResponse(status=201)
+        record_monitoring_changes(services=[fqdn])
     elif request.method == 'GET':
         form = ShinkenServiceForm(request.GET)
         if not form.is_valid():
@@ -68,79 +137,125 @@ def register_service(request, check_command):
                 .update(**values) == 0:
             ShinkenService(host_name=fqdn, check_command=check_command, **values).save()
             return HttpResponse(status=201)
+        record_monitoring_changes(services=[fqdn])
     elif request.method == 'DELETE':
         ShinkenService.objects.filter(host_name=fqdn, check_command=check_command).delete()
         status = 202
     return HttpResponse(status=status)
 
 
-@register_rpc_method(XML_RPC_SITE, name='glpi.doLogin')
+def register_services(request):
+    """Replace all Shinken services of the host by the ones given in the request body, as a JSON list of objects
+    (with at least the `check_command` key). Services that are not in the list are removed.
+    """
+    fqdn = hostname_from_principal(request.user.username)
+    if request.method != 'POST':
+        return HttpResponse('services must be POSTed', status=405)
+    try:
+        definitions = json.loads(request.body.decode('utf-8'))
+        if not isinstance(definitions, list):
+            raise ValueError('a list of services is required')
+        created, updated, deleted = ShinkenService.synchronize(fqdn, definitions)
+    except ValueError as e:
+        return HttpResponse(text_type(e), status=400, content_type='text/plain')
+    return HttpResponse('%d created, %d updated, %d deleted' % (created, updated, deleted), status=200,
+                        content_type='text/plain')
+
+
+@register_rpc_method(XML_RPC_SITE, name='glpi.doLogin', signature=[['struct', 'struct']])
 def do_login(request, args):
+    """Return a new session for the given `login_name` and `login_password`"""
     login_name = args[0]['login_name'].decode('utf-8')
     login_password = args[0]['login_password'].decode('utf-8')
-    users = list(AdminUser.objects.filter(username=login_name, user_permissions__codename='supervision')[0:1])
-    if not users:
+    if not check_login(login_name, login_password):
         raise PermissionDenied
-    user = users[0]
-    if not user.check_password(login_password):
+    return {'session': create_session(login_name), }
+
+
+@register_rpc_method(XML_RPC_SITE, name='glpi.refreshSession', signature=[['struct', 'struct']])
+def refresh_session(request, args):
+    """Return a new session for the user of a (still valid) session, if this user can still log in"""
+    login_name = check_session(request, args)
+    if get_supervisor(login_name) is None:
         raise PermissionDenied
-    Permission.objects.filter()
-    end_time = int((datetime.datetime.utcnow() - year_0).total_seconds()) + session_duration_in_seconds
-    session = '%s:%s' % (end_time, login_name)
-    session = signer.sign(session)
-    return {'session': session, }
+    return {'session': create_session(login_name), }
 
 
-@register_rpc_method(XML_RPC_SITE, name='monitoring.shinkenCommands')
+@register_rpc_method(XML_RPC_SITE, name='monitoring.shinkenCommands', signature=[['array', 'struct']])
 def shinken_commands(request, args):
+    """Return the Shinken commands"""
     check_session(request, args)
-    return [{'command_name': key, 'command_line': '$PLUGINSDIR$/%s' % value} for (key, value) in shinken_checks.items()]
+    return get_shinken_commands()
 
 
-@register_rpc_method(XML_RPC_SITE, name='monitoring.shinkenHosts')
+@register_rpc_method(XML_RPC_SITE, name='monitoring.shinkenHosts', signature=[['array', 'struct']])
 def shinken_hosts(request, args):
+    """Return all Shinken hosts"""
     check_session(request, args)
-    result = []
-    for host in Host.objects.all():
-        # noinspection PyTypeChecker
-        result.append({
-            'host_name': host.fqdn,
-            'alias': '%s,%s' % (host.admin_fqdn, host.fqdn.partition('.')[0]),
-            'display_name': host.fqdn,
-            'address': host.admin_ip_address,
-        })
-    return result
-
-
-@register_rpc_method(XML_RPC_SITE, name='monitoring.shinkenHostgroups')
+    return iter_shinken_hosts()
+
+
+@register_rpc_method(XML_RPC_SITE, name='monitoring.shinkenHostgroups', signature=[['array', 'struct']])
 def shinken_host_groups(request, args):
+    """Return the Shinken host groups (always empty)"""
     check_session(request, args)
     return []
 
 
-@register_rpc_method(XML_RPC_SITE, name='monitoring.shinkenTemplates')
+@register_rpc_method(XML_RPC_SITE, name='monitoring.shinkenTemplates', signature=[['array', 'struct']])
 def shinken_templates(request, args):
+    """Return the Shinken templates (always empty)"""
     check_session(request, args)
     return []
 
-@register_rpc_method(XML_RPC_SITE, name='monitoring.shinkenServices')
+@register_rpc_method(XML_RPC_SITE, name='monitoring.shinkenServices', signature=[['array', 'struct']])
 def shinken_services(request, args):
+    """Return all Shinken services"""
     check_session(request, args)
-    return get_shinken_services()
+    return iter(get_shinken_services())
 
 
-@register_rpc_method(XML_RPC_SITE, name='monitoring.shinkenContacts')
+@register_rpc_method(XML_RPC_SITE, name='monitoring.shinkenContacts', signature=[['array', 'struct']])
 def shinken_contacts(request, args):
+    """Return all Shinken contacts"""
+    check_session(request, args)
+    return get_shinken_contacts()
+
+
+@register_rpc_method(XML_RPC_SITE, name='monitoring.version', signature=[['int', 'struct']], serial=True)
+def monitoring_version(request, args):
+    """Return the current version of the monitoring configuration.
+    In a `system.multicall`, it is evaluated before the next `*Delta` calls (in the same transaction)."""
+    check_session(request, args)
+    return MonitoringChange.get_version()
+
+
+@register_rpc_method(XML_RPC_SITE, name='monitoring.shinkenHostsDelta', signature=[['struct', 'struct']],
+                     serial=True)
+def shinken_hosts_delta(request, args):
+    """Return the hosts modified since the version given as `since` argument"""
+    check_session(request, args)
+    return get_monitoring_delta(MonitoringChange.HOSTS, int(args[0]['since']))
+
+
+@register_rpc_method(XML_RPC_SITE, name='monitoring.shinkenServicesDelta', signature=[['struct', 'struct']],
+                     serial=True)
+def shinken_services_delta(request, args):
+    """Return the services of the hosts modified since the version given as `since` argument"""
+    check_session(request, args)
+    return get_monitoring_delta(MonitoringChange.SERVICES, int(args[0]['since']))
+
+
+@register_rpc_method(XML_RPC_SITE, name='monitoring.shinkenContactsDelta', signature=[['struct', 'struct']],
+                     serial=True)
+def shinken_contacts_delta(request, args):
+    """Return the contacts modified since the version given as `since` argument"""
     check_session(request, args)
-    result = []
-    for user in User.objects.all():
-        result.append({'contact_name': user.name, 'alias': user.display_name, 'use': 'generic-contact',
-                       'password': get_random_string(), 'email': user.mail,
-                       'is_admin': '1' if is_admin(user.name) else '0', })
-    return result
+    return get_monitoring_delta(MonitoringChange.CONTACTS, int(args[0]['since']))
 
 
-@register_rpc_method(XML_RPC_SITE, name='monitoring.shinkenTimeperiods')
+@register_rpc_method(XML_RPC_SITE, name='monitoring.shinkenTimeperiods', signature=[['array', 'struct']])
 def shinken_time_periods(request, args):
+    """Return the Shinken time periods (always empty)"""
     check_session(request, args)
     return []
@@ -1,16 +1,58 @@
 # coding=utf-8
-from xmlrpclib import loads, dumps, Fault
-from django.http.response import HttpResponse
+import inspect
+from multiprocessing.pool import ThreadPool
+import types
+import zlib
+
+from django.db import connections, transaction
+from django.http.response import HttpResponse, StreamingHttpResponse
+from django.utils import translation
+from django.utils.encoding import force_bytes
+from django.utils.six.moves.xmlrpc_client import loads, dumps, Fault, Marshaller
 
 
 class XMLRPCSite(object):
-    def __init__(self):
+    """Minimal XML-RPC server.
+
+    Registered methods can also return a generator (or any iterator): its values are then serialized one by one as
+    an XML-RPC array, in a streamed response, so the memory usage does not depend on the size of the result.
+    Responses are compressed when the client accepts the gzip Content-Encoding.
+
+    The calls of a `system.multicall` are evaluated concurrently by `multicall_threads` threads, except the calls
+    of methods registered with `serial=True`: they are evaluated in the request thread, in their order and in a
+    single transaction (e.g. the current version of a configuration followed by the changes since a version).
+    Methods can be introspected with `system.listMethods`, `system.methodHelp` and `system.methodSignature`.
+    """
+    encoding = 'utf-8'
+    chunk_size = 65536
+    streamed_types = (types.GeneratorType, type(iter([])), type(iter(())))
+
+    def __init__(self, multicall_threads=4):
+        self.multicall_threads = multicall_threads
         self.methods = {}
+        self.signatures = {}
+        self.serial_methods = set()
+        self.register_method(self.multicall, name='system.multicall', signature=[['array', 'array']])
+        self.register_method(self.list_methods, name='system.listMethods', signature=[['array']])
+        self.register_method(self.method_help, name='system.methodHelp', signature=[['string', 'string']])
+        self.register_method(self.method_signature, name='system.methodSignature',
+                             signature=[['array', 'string']])
+
+    def register_method(self, func, name=None, signature=None, serial=False):
+        """Register a method, called with the request and the list of RPC arguments.
 
-    def register_method(self, func, name=None):
+        :param name: name of the RPC method (the name of the function by default)
+        :param signature: list of the possible signatures (lists of XML-RPC types, starting with the returned
+            type), e.g. `[['struct', 'struct']]`, only used by `system.methodSignature`
+        :param serial: never evaluate this method concurrently with other serial methods of the same
+            `system.multicall`
+        """
         if name is None:
             name = func.__name__
         self.methods[name] = func
+        self.signatures[name] = signature
+        if serial:
+            self.serial_methods.add(name)
 
     def dispatch(self, request, *args, **kwargs):
         rpc_call = loads(request.body.decode('utf-8'))
@@ -19,15 +61,146 @@ class XMLRPCSite(object):
         try:
             # noinspection PyCallingNonCallable
             src_result = self.methods[method_name](request, rpc_args, *args, **kwargs)
+            if isinstance(src_result, self.streamed_types):
+                # the first value is computed here, so errors raised before the first yield are reported as faults
+                first_values = [x for x in [next(src_result, StopIteration)] if x is not StopIteration]
+                chunks = self.stream_array(first_values, src_result)
+                return self.get_response(request, chunks, streaming=True)
             result = src_result,
         except Exception as e:
             result = Fault(e.__class__.__name__, str(e))
-        data = dumps(result, method_name, True)
-        return HttpResponse(data, content_type='application/xml+rpc')
+        data = dumps(result, method_name, True, encoding=self.encoding)
+        return self.get_response(request, [force_bytes(data, self.encoding)])
+
+    def multicall(self, request, args, *extra_args, **kwargs):
+        """Evaluate several calls in a single request. `args[0]` is a list of `{'methodName': name, 'params': [...]}`
+        and the result is the list of the results of each call (as a single-element list) or of faults
+        (as `{'faultCode': ..., 'faultString': ...}`)"""
+        calls = args[0]
+        results = [None] * len(calls)
+        serial_indexes = [index for (index, call) in enumerate(calls)
+                          if isinstance(call, dict) and call.get('methodName') in self.serial_methods]
+        concurrent_indexes = [index for index in range(len(calls)) if index not in set(serial_indexes)]
+        if self.multicall_threads <= 1 or len(concurrent_indexes) <= 1:
+            serial_indexes, concurrent_indexes = list(range(len(calls))), []
+        pool, async_result = None, None
+        if concurrent_indexes:
+            language = translation.get_language()
+
+            def evaluate(index):
+                translation.activate(language)
+                try:
+                    return self.evaluate_call(request, calls[index], extra_args, kwargs)
+                finally:
+                    translation.deactivate()
+                    # each thread has its own database connections, that must not be left open
+                    for connection in connections.all():
+                        connection.close()
+
+            pool = ThreadPool(min(self.multicall_threads, len(concurrent_indexes)))
+            async_result = pool.map_async(evaluate, concurrent_indexes)
+        try:
+            # serial methods are evaluated in this thread, in their order and in a single transaction;
+            # each call has its own savepoint, so a database error does not break the next calls
+            with transaction.atomic():
+                for index in serial_indexes:
+                    results[index] = self.evaluate_call(request, calls[index], extra_args, kwargs, savepoint=True)
+            if async_result is not None:
+                for index, result in zip(concurrent_indexes, async_result.get()):
+                    results[index] = result
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return results
+
+    def evaluate_call(self, request, call, args, kwargs, savepoint=False):
+        """Return the result of a call of a `system.multicall` (as a single-element list) or its fault.
+
+        :param savepoint: evaluate the call in its own savepoint, rolled back when it raises an exception
+        """
+        try:
+            method_name = call['methodName']
+            if method_name == 'system.multicall':
+                raise ValueError('Recursive system.multicall calls are forbidden')
+            if savepoint:
+                with transaction.atomic():
+                    return [self.call_method(request, method_name, call.get('params', []), args, kwargs)]
+            return [self.call_method(request, method_name, call.get('params', []), args, kwargs)]
+        except Exception as e:
+            return {'faultCode': e.__class__.__name__, 'faultString': str(e)}
+
+    def call_method(self, request, method_name, params, args, kwargs):
+        # noinspection PyCallingNonCallable
+        result = self.methods[method_name](request, params, *args, **kwargs)
+        if isinstance(result, self.streamed_types):
+            result = list(result)
+        return result
+
+    # noinspection PyUnusedLocal
+    def list_methods(self, request, args, *extra_args, **kwargs):
+        """Return the list of the available methods"""
+        return sorted(self.methods)
+
+    # noinspection PyUnusedLocal
+    def method_help(self, request, args, *extra_args, **kwargs):
+        """Return the documentation of the given method"""
+        return inspect.getdoc(self.methods[args[0]]) or ''
+
+    # noinspection PyUnusedLocal
+    def method_signature(self, request, args, *extra_args, **kwargs):
+        """Return the list of the possible signatures of the given method, or 'undef'"""
+        if args[0] not in self.methods:
+            raise KeyError(args[0])
+        return self.signatures[args[0]] or 'undef'
+
+    def get_response(self, request, chunks, streaming=False):
+        gzipped = 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', '')
+        if gzipped:
+            chunks = self.gzip_chunks(chunks)
+        if streaming:
+            response = StreamingHttpResponse(chunks, content_type='application/xml+rpc')
+        else:
+            response = HttpResponse(b''.join(chunks), content_type='application/xml+rpc')
+        if gzipped:
+            response['Content-Encoding'] = 'gzip'
+        response['Vary'] = 'Accept-Encoding'
+        return response
+
+    def stream_array(self, *iterables):
+        """Serialize the values of the given iterables as a single XML-RPC array, by chunks of at least
+        :attr:`chunk_size` bytes"""
+        marshaller = Marshaller(self.encoding, allow_none=True)
+        buffer_ = ["<?xml version='1.0' encoding='%s'?>\n<methodResponse>\n<params>\n<param>\n"
+                   "<value><array><data>\n" % self.encoding]
+        size = [0]
+
+        def write(text):
+            buffer_.append(text)
+            size[0] += len(text)
+
+        for iterable in iterables:
+            for value in iterable:
+                marshaller.dispatch[type(value)](marshaller, value, write)
+                if size[0] >= self.chunk_size:
+                    yield force_bytes(''.join(buffer_), self.encoding)
+                    del buffer_[:]
+                    size[0] = 0
+        buffer_.append('</data></array></value>\n</param>\n</params>\n</methodResponse>\n')
+        yield force_bytes(''.join(buffer_), self.encoding)
+
+    @staticmethod
+    def gzip_chunks(chunks):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
 
 
-def register_rpc_method(site, name=None):
+def register_rpc_method(site, name=None, signature=None, serial=False):
     def decorated(func):
-        site.register_method(func, name=name)
+        site.register_method(func, name=name, signature=signature, serial=serial)
         return func
     return decorated
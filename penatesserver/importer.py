@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""Bulk import of LDAP users, with their primary groups, GroupOfNames mirrors and Kerberos principals.
+
+Rows are dicts with the following keys (only `name` is required):
+name, display_name, phone, uid_number, gid_number, groups (list, or ;-separated string), password.
+"""
+from __future__ import unicode_literals
+import csv
+import json
+import re
+
+from django.utils import six
+from django.utils.encoding import force_text
+
+from penatesserver.kerb import add_principals
+from penatesserver.models import User, Group, GroupOfNames, name_pattern
+from penatesserver.utils import chunks, password_hash
+
+__author__ = 'Matthieu Gallet'
+name_re = re.compile('^%s$' % name_pattern)
+
+
+class UserImporter(object):
+    """Create many users at once.
+
+    Instead of the 6-10 LDAP/Kerberos round trips of each `User.save()`, existing users and groups are fetched
+    once, uid and gid numbers are reserved by blocks, each entry is created with a single LDAP add, memberships
+    are added once per group and all Kerberos principals are created in a single kadmin session.
+
+    :param progress: optional callable, called as `progress(done, total)` after each created user
+    """
+    def __init__(self, progress=None):
+        self.progress = progress
+        self.created = []
+        self.errors = []
+
+    @staticmethod
+    def read_csv(content):
+        """Read rows from a CSV content (the first line must be the header)"""
+        lines = content.splitlines()
+        if six.PY2:
+            lines = [x.encode('utf-8') for x in lines]
+        result = []
+        for row in csv.DictReader(lines):
+            result.append({force_text(k).strip(): (None if v is None else force_text(v).strip())
+                           for (k, v) in row.items() if k})
+        return result
+
+    @staticmethod
+    def read_json(content):
+        """Read rows from a JSON content (a list of dicts)"""
+        rows = json.loads(content)
+        if not isinstance(rows, list) or not all(isinstance(x, dict) for x in rows):
+            raise ValueError('A list of objects is expected')
+        return rows
+
+    def add_error(self, index, name, message):
+        self.errors.append({'row': index, 'name': name, 'error': message})
+
+    def clean_rows(self, rows):
+        """Validate rows, returning a list of (index, values) for valid rows only"""
+        result = []
+        seen_names = set()
+        seen_uids = set()
+        for index, row in enumerate(rows):
+            name = force_text(row.get('name') or '').strip()
+            try:
+                if not name_re.match(name):
+                    raise ValueError('Invalid username')
+                elif name in seen_names:
+                    raise ValueError('Duplicated username')
+                values = {'name': name, 'display_name': row.get('display_name') or name,
+                          'phone': row.get('phone') or None, 'password': row.get('password') or None}
+                for key in ('uid_number', 'gid_number'):
+                    values[key] = int(row[key]) if row.get(key) not in (None, '') else None
+                if values['uid_number'] is not None and values['uid_number'] in seen_uids:
+                    raise ValueError('Duplicated uid number')
+                groups = row.get('groups') or []
+                if isinstance(groups, six.string_types):
+                    groups = [x.strip() for x in groups.split(';') if x.strip()]
+                for group_name in groups:
+                    if not name_re.match(group_name):
+                        raise ValueError('Invalid group name %s' % group_name)
+                values['groups'] = groups
+            except (ValueError, TypeError) as e:
+                self.add_error(index, name, force_text(e))
+                continue
+            seen_names.add(name)
+            seen_uids.add(values['uid_number'])
+            result.append((index, values))
+        return result
+
+    def run(self, rows):
+        """Import the given rows and return a report {'created': [names], 'errors': [{row, name, error}]}"""
+        rows = self.clean_rows(rows)
+        # a single search per chunk of 200 names to detect existing users
+        existing_users = set()
+        for names in chunks([values['name'] for (index, values) in rows], 200):
+            existing_users |= {x.name for x in User.objects.filter(name__in=names)}
+        valid_rows = []
+        for index, values in rows:
+            if values['name'] in existing_users:
+                self.add_error(index, values['name'], 'User already exists')
+            else:
+                valid_rows.append((index, values))
+        groups_by_name = {}
+        groups_by_gid = {}
+        for group in Group.objects.all():
+            groups_by_name[group.name] = group
+            groups_by_gid[group.gid] = group
+        group_of_names = {x.name for x in GroupOfNames.objects.all()}
+
+        # find or plan primary and supplementary groups
+        new_groups = []  # created groups
+        added_members = {}  # added_members[group name] = [new usernames] for existing groups
+        primary_groups = {}
+        for index, values in list(valid_rows):
+            name = values['name']
+            if values['gid_number'] is not None:
+                group = groups_by_gid.get(values['gid_number'])
+            else:
+                group = groups_by_name.get(name)
+            if group is None:
+                if name in groups_by_name:
+                    self.add_error(index, name, 'Group %s already exists with another gid' % name)
+                    valid_rows.remove((index, values))
+                    continue
+                group = Group(name=name, gid=values['gid_number'], members=[])
+                groups_by_name[name] = group
+                if group.gid is not None:
+                    groups_by_gid[group.gid] = group
+                new_groups.append(group)
+            primary_groups[name] = group
+            for group_name in values['groups']:
+                if group_name not in groups_by_name:
+                    group = Group(name=group_name, gid=None, members=[])
+                    groups_by_name[group_name] = group
+                    new_groups.append(group)
+
+        # reserve all required uid and gid numbers at once, after the explicitly given ones
+        gid_allocator = Group.get_id_allocator('gid', default=10000)
+        explicit_gids = [x.gid for x in new_groups if x.gid is not None]
+        if explicit_gids:
+            gid_allocator.reserve(max(explicit_gids))
+        groups_without_gid = [x for x in new_groups if x.gid is None]
+        if groups_without_gid:
+            first_gid = gid_allocator.allocate(len(groups_without_gid))
+            for offset, group in enumerate(groups_without_gid):
+                group.gid = first_gid + offset
+        uid_allocator = User.get_id_allocator('uid_number')
+        explicit_uids = [values['uid_number'] for (index, values) in valid_rows if values['uid_number'] is not None]
+        if explicit_uids:
+            uid_allocator.reserve(max(explicit_uids))
+        rows_without_uid = [values for (index, values) in valid_rows if values['uid_number'] is None]
+        if rows_without_uid:
+            first_uid = uid_allocator.allocate(len(rows_without_uid))
+            for offset, values in enumerate(rows_without_uid):
+                values['uid_number'] = first_uid + offset
+
+        # create users, with their primary group when it does not exist yet
+        new_group_names = {x.name for x in new_groups}
+        created_groups = set()
+        passwords = {}
+        rows_by_principal = {}
+        total = len(valid_rows)
+        for done, (index, values) in enumerate(valid_rows, start=1):
+            name = values['name']
+            primary_group = primary_groups[name]
+            try:
+                if primary_group.name in new_group_names and primary_group.name not in created_groups:
+                    self.create_group(primary_group, [name], group_of_names)
+                    created_groups.add(primary_group.name)
+                else:
+                    added_members.setdefault(primary_group.name, []).append(name)
+                user = User(name=name, display_name=values['display_name'], phone=values['phone'],
+                            uid_number=values['uid_number'], gid_number=primary_group.gid)
+                user.saved_ids = {'uid_number': values['uid_number']}  # already reserved
+                if values['password']:
+                    user.user_password = password_hash(values['password'])
+                user.save(sync_group=False, sync_principal=False)
+            except Exception as e:
+                self.add_error(index, name, force_text(e))
+                continue
+            if values['password']:
+                passwords[user.principal_name] = values['password']
+                user.store_cleartext_password(values['password'])
+            for group_name in values['groups']:
+                added_members.setdefault(group_name, []).append(name)
+            self.created.append(user)
+            rows_by_principal[user.principal_name] = index
+            if self.progress:
+                self.progress(done, total)
+
+        # supplementary groups: a single modification (of the new values only) per group
+        for group_name, usernames in added_members.items():
+            group = groups_by_name[group_name]
+            if group_name in new_group_names and group_name not in created_groups:
+                self.create_group(group, usernames, group_of_names)
+                created_groups.add(group_name)
+                continue
+            group.add_members(usernames)
+
+        # all Kerberos principals in one session
+        errors = add_principals([x.principal_name for x in self.created], passwords=passwords)
+        for user in [x for x in self.created if x.principal_name in errors]:
+            self.add_error(rows_by_principal[user.principal_name], user.name,
+                           'Kerberos: %s' % errors[user.principal_name])
+            self.created.remove(user)
+        return self.report()
+
+    @staticmethod
+    def create_group(group, members, group_of_names):
+        group.members = list(members)
+        group.saved_ids = {'gid': group.gid}  # already reserved
+        group.save(sync_group_of_names=False)
+        if group.name not in group_of_names:
+            GroupOfNames(name=group.name, members=GroupOfNames.get_member_dns(group.members)).save()
+            group_of_names.add(group.name)
+        else:
+            # the GroupOfNames mirror already exists: let the group synchronize it
+            group.save()
+
+    def report(self):
+        return {'created': [x.name for x in self.created], 'errors': self.errors}
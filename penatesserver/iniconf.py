@@ -24,6 +24,11 @@ INI_MAPPING = [
     OptionParser('LDAP_NAME', 'ldap.name'),
     OptionParser('LDAP_USER', 'ldap.user'),
     OptionParser('LDAP_PASSWORD', 'ldap.password'),
+    OptionParser('LDAP_POOL_SIZE', 'ldap.pool_size', int),
+    OptionParser('LDAP_POOL_MAX_LIFETIME', 'ldap.pool_max_lifetime', int),
+    OptionParser('LDAP_POOL_CHECK_INTERVAL', 'ldap.pool_check_interval', int),
+    OptionParser('LDAP_TIMEOUT', 'ldap.timeout', int),
+    OptionParser('LDAP_CACHE_TIMEOUT', 'ldap.cache_timeout', int),
 
     OptionParser('PENATES_DOMAIN', 'penates.domain'),
     OptionParser('PENATES_COUNTRY', 'penates.country'),
@@ -48,4 +53,6 @@ INI_MAPPING = [
     OptionParser('FLOOR_DEFAULT_GROUP_NAME', 'global.default_group'),
     OptionParser('DEBUG', 'global.debug', bool_setting),
 
+    OptionParser('MONITORING_SESSION_DURATION', 'monitoring.session_duration', int),
+
     ]
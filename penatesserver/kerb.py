@@ -3,6 +3,8 @@ from __future__ import unicode_literals
 import codecs
 import subprocess
 from django.conf import settings
+from django.utils.six import text_type
+from penatesserver.utils import chunks
 
 __author__ = 'Matthieu Gallet'
 
@@ -21,6 +23,46 @@ def mit_command(*args):
     return p
 
 
+def heimdal_batch(commands):
+    """Run several kadmin commands in a single Heimdal kadmin session.
+    Return True if kadmin did not report any error (the failing command is not identified otherwise)."""
+    args_list = ['kadmin', '-p', settings.PENATES_PRINCIPAL, '-K', settings.PENATES_KEYTAB, ]
+    p = subprocess.Popen(args_list, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = p.communicate(('\n'.join(commands) + '\nexit\n').encode('utf-8'))
+    return p.returncode == 0 and not stderr.strip()
+
+
+def mit_batch(commands):
+    """Run several kadmin commands in a single MIT kadmin session.
+    Return True if kadmin did not report any error (the failing command is not identified otherwise)."""
+    arg_list = ['kadmin', '-p', settings.PENATES_PRINCIPAL, '-k', '-t', settings.PENATES_KEYTAB, ]
+    p = subprocess.Popen(arg_list, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = p.communicate(('\n'.join(commands) + '\nquit\n').encode('utf-8'))
+    return p.returncode == 0 and not stderr.strip()
+
+
+def kadmin_quote(password):
+    """Quote a password for a kadmin command line (both parsers understand double quotes, Heimdal also uses
+    backslashes as escape character)
+
+    >>> print(kadmin_quote('pass word'))
+    "pass word"
+    >>> kadmin_quote('pass"word')
+    Traceback (most recent call last):
+    ...
+    ValueError: Passwords cannot contain double quotes, backslashes or control characters
+    """
+    if '"' in password or '\\' in password or any(ord(x) < 32 or ord(x) == 127 for x in password):
+        raise ValueError('Passwords cannot contain double quotes, backslashes or control characters')
+    return '"%s"' % password
+
+
+def mit_change_password(principal, password):
+    """Set the password of a principal, return True on success"""
+    p = mit_command('change_password -pw %s %s' % (kadmin_quote(password), principal))
+    return p.returncode == 0
+
+
 def add_principal_to_keytab(principal, filename):
     if settings.RUNNING_TESTS:
         from penatesserver.models import PrincipalTest
@@ -41,8 +83,9 @@ def change_password(principal, password):
         PrincipalTest.objects.get(name=principal)
         return
     if settings.KERBEROS_IMPL == 'mit':
-        mit_command('change_password -pw %s %s' % (password, principal))
+        mit_change_password(principal, password)
     else:
+        # a single argument: the password is not parsed by kadmin
         heimdal_command('passwd', '--password=%s' % password, principal)
 
 
@@ -81,6 +124,67 @@ def add_principal(principal):
                         '--expiration-time=never', '--pw-expiration-time=never', '--policy=default', principal)
 
 
+def add_principals(principals, passwords=None):
+    """Create several principals and set their passwords at once, in a single kadmin session (principals are
+    created in LDAP with MIT). When this session fails, commands are run again one principal at a time,
+    to identify the failing ones.
+
+    :param principals: list of principal names; existing principals are ignored
+    :param passwords: optional dict {principal: password}; other principals get a random key
+    :return: dict {principal: error message} of the principals that could not be created (or get their password)
+    """
+    passwords = passwords or {}
+    errors = {}
+    if settings.RUNNING_TESTS:
+        from penatesserver.models import PrincipalTest
+        existing = set(PrincipalTest.objects.filter(name__in=principals).values_list('name', flat=True))
+        PrincipalTest.objects.bulk_create([PrincipalTest(name=x) for x in principals if x not in existing])
+        return errors
+    quoted_passwords = {}
+    for principal, password in passwords.items():
+        try:
+            quoted_passwords[principal] = kadmin_quote(password)
+        except ValueError as e:
+            errors[principal] = text_type(e)
+    principals = [x for x in principals if x not in errors]
+    from penatesserver.models import Principal
+    if settings.KERBEROS_IMPL == 'mit':
+        existing = set()
+        for values in chunks(principals, 200):
+            existing |= {x.name for x in Principal.objects.filter(name__in=values)}
+        for principal in principals:
+            if principal in existing:
+                continue
+            try:
+                Principal(name=principal).save()
+            except Exception as e:
+                errors[principal] = text_type(e)
+        commands = [(principal, 'change_password -pw %s %s' % (quoted_passwords[principal], principal))
+                    for principal in principals if principal in quoted_passwords and principal not in errors]
+        if commands and not mit_batch([x[1] for x in commands]):
+            for principal, command in commands:
+                if mit_command(command).returncode != 0:
+                    errors[principal] = 'Unable to set the password'
+        return errors
+    options = ['--max-ticket-life=1d', '--max-renewable-life=1w', '--attributes=', '--expiration-time=never',
+               '--pw-expiration-time=never', '--policy=default']
+    batch_options = ' '.join(x if x != '--attributes=' else '--attributes=""' for x in options)
+    commands = ['add %s %s %s' % ('--password=%s' % quoted_passwords[principal] if principal in quoted_passwords
+                                  else '--random-key', batch_options, principal) for principal in principals]
+    if commands and not heimdal_batch(commands):
+        # existing principals or real errors: retry each principal (the password is then a single argument)
+        for principal in principals:
+            password = passwords.get(principal)
+            key_option = '--random-key' if password is None else '--password=%s' % password
+            if heimdal_command('add', key_option, *(options + [principal])).returncode == 0:
+                continue
+            if not principal_exists(principal):
+                errors[principal] = 'Unable to create the principal'
+            elif password is not None and heimdal_command('passwd', key_option, principal).returncode != 0:
+                errors[principal] = 'Unable to set the password'
+    return errors
+
+
 def principal_exists(principal_name):
     if settings.RUNNING_TESTS:
         from penatesserver.models import PrincipalTest
@@ -103,3 +207,29 @@ def delete_principal(principal):
         Principal.objects.filter(name=principal).delete()
     else:
         heimdal_command('delete', principal)
+
+
+def delete_principals(principals):
+    """Delete several principals at once (in a single kadmin session with Heimdal).
+    When this session fails, principals are deleted one at a time to identify the failing ones.
+
+    :return: dict {principal: error message} of the principals that could not be deleted
+    """
+    errors = {}
+    if settings.RUNNING_TESTS:
+        from penatesserver.models import PrincipalTest
+        for values in chunks(principals, 200):
+            PrincipalTest.objects.filter(name__in=values).delete()
+        return errors
+    from penatesserver.models import Principal
+    if settings.KERBEROS_IMPL == 'mit':
+        for principal in principals:
+            try:
+                Principal.objects.filter(name=principal).delete()
+            except Exception as e:
+                errors[principal] = text_type(e)
+    elif principals and not heimdal_batch(['delete %s' % principal for principal in principals]):
+        for principal in principals:
+            if heimdal_command('delete', principal).returncode != 0 and principal_exists(principal):
+                errors[principal] = 'Unable to delete the principal'
+    return errors
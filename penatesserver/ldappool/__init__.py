@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""Pool of bound LDAP connections, shared by all threads of a worker process.
+
+Use "penatesserver.ldappool" as engine of the LDAP database (instead of "ldapdb.backends.ldap") and
+:class:`penatesserver.routers.LdapRouter` as database router.
+The NAME of the database can contain several space-separated URIs: they are tried in order when a new connection
+is required.
+Pool parameters are read from the OPTIONS of the database:
+
+  * POOL_SIZE: maximum number of idle connections kept in the pool (10),
+  * MAX_LIFETIME: connections older than this (in seconds) are closed (3600),
+  * CHECK_INTERVAL: idle connections are checked (with a "Who am I?" request) when they have not been used for
+    this number of seconds (60),
+  * TIMEOUT: network timeout (in seconds) when connecting to a server (5).
+"""
+from __future__ import unicode_literals
+import os
+import threading
+import time
+
+import ldap
+
+__author__ = 'Matthieu Gallet'
+
+
+class PooledConnection(object):
+    def __init__(self, connection, uri):
+        self.connection = connection
+        self.uri = uri
+        self.created_at = time.time()
+        self.last_used_at = self.created_at
+
+
+class LdapConnectionPool(object):
+    """Keep bound LDAP connections between requests.
+
+    Connections are checked before being reused (when idle for too long) and replaced when they are too old.
+    If more than `size` connections are simultaneously used, extra connections are created and closed when
+    released.
+    """
+
+    def __init__(self, uris, bind_dn, bind_pw, tls=False, connection_options=None, size=10, max_lifetime=3600,
+                 check_interval=60, timeout=5):
+        self.uris = uris.split() if uris else []
+        self.bind_dn = bind_dn
+        self.bind_pw = bind_pw
+        self.tls = tls
+        self.connection_options = connection_options or {}
+        self.size = size
+        self.max_lifetime = max_lifetime
+        self.check_interval = check_interval
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.idle = []
+        self.used = {}  # used[id(connection)] = PooledConnection
+        self.current_uri_index = 0
+        self.stats = {'created': 0, 'reused': 0, 'closed': 0, 'failed_checks': 0, 'failovers': 0,
+                      'connection_errors': 0, }
+
+    def acquire(self):
+        """Return a bound python-ldap connection"""
+        self.check_pid()
+        now = time.time()
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                pooled = self.idle.pop()
+            if now - pooled.created_at > self.max_lifetime:
+                self.close(pooled)
+                continue
+            if now - pooled.last_used_at > self.check_interval and not self.is_alive(pooled):
+                self.increment('failed_checks')
+                self.close(pooled)
+                continue
+            self.increment('reused')
+            return self.mark_used(pooled)
+        return self.mark_used(self.create())
+
+    def release(self, connection):
+        """Give back a connection returned by :meth:`acquire`"""
+        with self.lock:
+            pooled = self.used.pop(id(connection), None)
+            if pooled is None:
+                return
+            pooled.last_used_at = time.time()
+            if len(self.idle) < self.size and os.getpid() == self.pid:
+                self.idle.append(pooled)
+                return
+        self.close(pooled)
+
+    def discard(self, connection):
+        """Close a connection returned by :meth:`acquire` instead of giving it back (e.g. after a network error)"""
+        with self.lock:
+            pooled = self.used.pop(id(connection), None)
+        if pooled is not None:
+            self.close(pooled)
+
+    def increment(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def get_stats(self):
+        with self.lock:
+            result = dict(self.stats)
+            result.update({'idle': len(self.idle), 'used': len(self.used), 'size': self.size,
+                           'current_uri': self.uris[self.current_uri_index] if self.uris else None})
+        return result
+
+    def mark_used(self, pooled):
+        with self.lock:
+            self.used[id(pooled.connection)] = pooled
+        return pooled.connection
+
+    def create(self):
+        """Connect and bind to the first available server, starting with the last working one"""
+        last_exception = None
+        for offset in range(len(self.uris)):
+            index = (self.current_uri_index + offset) % len(self.uris)
+            uri = self.uris[index]
+            try:
+                connection = self.connect(uri)
+            except (ldap.SERVER_DOWN, ldap.TIMEOUT, ldap.CONNECT_ERROR) as e:
+                self.increment('connection_errors')
+                last_exception = e
+                continue
+            with self.lock:
+                if index != self.current_uri_index:
+                    self.stats['failovers'] += 1
+                    self.current_uri_index = index
+                self.stats['created'] += 1
+            return PooledConnection(connection, uri)
+        if last_exception is None:
+            raise ldap.SERVER_DOWN({'desc': 'No LDAP server configured'})
+        raise last_exception
+
+    def connect(self, uri):
+        connection = ldap.initialize(uri)
+        connection.set_option(ldap.OPT_NETWORK_TIMEOUT, self.timeout)
+        for option, value in self.connection_options.items():
+            connection.set_option(option, value)
+        if self.tls:
+            connection.start_tls_s()
+        connection.simple_bind_s(self.bind_dn, self.bind_pw)
+        return connection
+
+    @staticmethod
+    def is_alive(pooled):
+        try:
+            pooled.connection.whoami_s()
+        except ldap.LDAPError:
+            return False
+        return True
+
+    def close(self, pooled):
+        self.increment('closed')
+        try:
+            pooled.connection.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+    def check_pid(self):
+        """Connections must not be shared between forked processes: forget connections of the parent process"""
+        if os.getpid() == self.pid:
+            return
+        with self.lock:
+            if os.getpid() != self.pid:
+                self.pid = os.getpid()
+                self.idle = []
+                self.used = {}
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, settings_dict):
+    """Return the pool of the given LDAP database
+    :rtype: :class:`penatesserver.ldappool.LdapConnectionPool`
+    """
+    if alias not in _pools:
+        with _pools_lock:
+            if alias not in _pools:
+                options = settings_dict.get('OPTIONS') or {}
+                _pools[alias] = LdapConnectionPool(
+                    settings_dict['NAME'], settings_dict['USER'], settings_dict['PASSWORD'],
+                    tls=settings_dict.get('TLS', False), connection_options=settings_dict.get('CONNECTION_OPTIONS'),
+                    size=int(options.get('POOL_SIZE', 10)), max_lifetime=int(options.get('MAX_LIFETIME', 3600)),
+                    check_interval=int(options.get('CHECK_INTERVAL', 60)), timeout=int(options.get('TIMEOUT', 5)))
+    return _pools[alias]
+
+
+def get_pool_stats():
+    """Return the statistics of all LDAP connection pools of this process, indexed by database alias"""
+    return {alias: pool.get_stats() for (alias, pool) in _pools.items()}
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import ldap
+from ldapdb.backends.ldap.base import DatabaseWrapper as LdapDatabaseWrapper
+
+from penatesserver.ldappool import get_pool
+
+__author__ = 'Matthieu Gallet'
+
+
+def track_errors(name):
+    """Wrap a LDAP method of the database, so failures are remembered (like Django does for SQL databases)"""
+    def method(self, *args, **kwargs):
+        try:
+            return getattr(super(DatabaseWrapper, self), name)(*args, **kwargs)
+        except ldap.LDAPError:
+            self.errors_occurred = True
+            raise
+    method.__name__ = str(name)
+    return method
+
+
+class DatabaseWrapper(LdapDatabaseWrapper):
+    """LDAP database whose connections are taken from (and given back to) a :class:`LdapConnectionPool`
+    instead of being bound and unbound by each thread.
+    Connections that raised an error are only given back when they are still usable.
+    """
+    errors_occurred = False
+    add_s = track_errors('add_s')
+    delete_s = track_errors('delete_s')
+    modify_s = track_errors('modify_s')
+    rename_s = track_errors('rename_s')
+    search_s = track_errors('search_s')
+
+    @property
+    def pool(self):
+        return get_pool(self.alias, self.settings_dict)
+
+    def ensure_connection(self):
+        if self.connection is None:
+            self.connection = self.pool.acquire()
+            self.errors_occurred = False
+
+    def close(self):
+        if hasattr(self, 'validate_thread_sharing'):
+            self.validate_thread_sharing()
+        if self.connection is None:
+            return
+        if self.errors_occurred and not self.is_usable():
+            self.pool.discard(self.connection)
+        else:
+            self.pool.release(self.connection)
+        self.connection = None
+        self.errors_occurred = False
+
+    def close_if_unusable_or_obsolete(self):
+        # called at the beginning and at the end of each request: the connection goes back to the pool,
+        # without unbinding it (unless it is broken)
+        self.close()
+
+    def is_usable(self):
+        try:
+            self.connection.whoami_s()
+        except ldap.LDAPError:
+            return False
+        return True
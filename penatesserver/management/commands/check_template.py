@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import argparse
+
+from django.core.exceptions import ValidationError
+from django.core.management import BaseCommand
+
+from penatesserver.glpi.models import CheckTemplate
+
+__author__ = 'Matthieu Gallet'
+
+
+class Command(BaseCommand):
+    help = 'Create, update or delete a Shinken check applied to all hosts (list all checks without argument)'
+
+    def add_arguments(self, parser):
+        assert isinstance(parser, argparse.ArgumentParser)
+        parser.add_argument('name', nargs='?', default=None, help='Name of the check template')
+        parser.add_argument('--delete', default=False, action='store_true')
+        parser.add_argument('--use', default=None)
+        parser.add_argument('--service_description', default=None,
+                            help='Can use %%(fqdn)s, %%(hostname)s, %%(main_ip_address)s, %%(admin_ip_address)s and '
+                                 '%%(admin_fqdn)s')
+        parser.add_argument('--check_command', default=None, help='Can use the same values as service_description')
+        parser.add_argument('--icon_set', default=None)
+        parser.add_argument('--check_interval', default=None, type=int)
+        parser.add_argument('--notifications_enabled', default=None, choices=['0', '1'])
+        parser.add_argument('--position', default=None, type=int)
+        parser.add_argument('--enable', dest='enabled', default=None, action='store_true')
+        parser.add_argument('--disable', dest='enabled', default=None, action='store_false')
+
+    def handle(self, *args, **options):
+        name = options['name']
+        if name is None:
+            for template in CheckTemplate.objects.all():
+                self.stdout.write('%s%s: %s [%s]' % (template.name, '' if template.enabled else ' (disabled)',
+                                                     template.service_description, template.check_command))
+            return
+        if options['delete']:
+            CheckTemplate.objects.filter(name=name).delete()
+            self.stdout.write(self.style.ERROR('%s deleted') % name)
+            return
+        template = CheckTemplate.objects.filter(name=name).first() or CheckTemplate(name=name)
+        created = template.pk is None
+        for key in ('use', 'service_description', 'check_command', 'icon_set', 'check_interval',
+                    'notifications_enabled', 'position', 'enabled'):
+            if options[key] is not None:
+                setattr(template, key, options[key])
+        try:
+            template.full_clean()
+        except ValidationError as e:
+            for field, messages in e.message_dict.items():
+                self.stderr.write('%s: %s' % (field, ' '.join(messages)))
+            return
+        template.save()
+        if created:
+            self.stdout.write(self.style.WARNING('%s created') % name)
@@ -4,6 +4,7 @@ import argparse
 
 from django.core.management import BaseCommand
 
+from penatesserver.glpi.models import record_monitoring_changes
 from penatesserver.models import Host
 
 __author__ = 'Matthieu Gallet'
@@ -40,4 +41,5 @@ class Command(BaseCommand):
             host.save()
             self.stdout.write(self.style.WARNING('Host %s created') % fqdn)
         else:
+            record_monitoring_changes(hosts=[fqdn])
             self.stdout.write(self.style.WARNING('Host %s updated') % fqdn)
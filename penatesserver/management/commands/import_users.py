@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from argparse import ArgumentParser
+import codecs
+from django.core.management import BaseCommand
+from penatesserver.importer import UserImporter
+
+__author__ = 'Matthieu Gallet'
+
+
+class Command(BaseCommand):
+    help = 'Create many users at once from a CSV or JSON file ' \
+           '(fields: name, display_name, phone, uid_number, gid_number, groups, password)'
+
+    def add_arguments(self, parser):
+        assert isinstance(parser, ArgumentParser)
+        parser.add_argument('filename')
+        parser.add_argument('--format', default=None, choices=('csv', 'json'),
+                            help='guessed from the file extension by default')
+
+    def handle(self, *args, **options):
+        filename = options['filename']
+        file_format = options['format'] or ('json' if filename.endswith('.json') else 'csv')
+        with codecs.open(filename, 'r', encoding='utf-8') as fd:
+            content = fd.read()
+        if file_format == 'json':
+            rows = UserImporter.read_json(content)
+        else:
+            rows = UserImporter.read_csv(content)
+        importer = UserImporter(progress=self.show_progress)
+        report = importer.run(rows)
+        self.stdout.write(self.style.SUCCESS('%d user(s) created' % len(report['created'])))
+        for error in report['errors']:
+            self.stdout.write(self.style.ERROR('row %(row)s (%(name)s): %(error)s' % error))
+
+    def show_progress(self, done, total):
+        if done % 100 == 0 or done == total:
+            self.stdout.write('%d/%d' % (done, total))
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.management import BaseCommand
+
+from penatesserver.pki.ocsp import OcspResponder
+from penatesserver.pki.service import PKI
+
+__author__ = 'Matthieu Gallet'
+
+
+class Command(BaseCommand):
+    help = 'Sign in advance the OCSP responses of all valid certificates (to be run from a cron job, ' \
+           'e.g. every hour), so the OCSP responder only serves pre-signed responses.'
+
+    def handle(self, *args, **options):
+        count = OcspResponder(PKI()).presign()
+        self.stdout.write(self.style.SUCCESS('%d OCSP responses are up-to-date.' % count))
@@ -2,21 +2,31 @@
 from __future__ import unicode_literals
 import argparse
 from django.core.management.base import BaseCommand
-from penatesserver.models import Host
+from penatesserver.decommission import HostDecommission
 
 __author__ = 'mgallet'
 
 
 class Command(BaseCommand):
+    help = 'Remove hosts with their DNS records, services, Shinken checks, mount points, principals and certificates'
+
     def add_arguments(self, parser):
         assert isinstance(parser, argparse.ArgumentParser)
-        parser.add_argument('fqdn')
+        parser.add_argument('fqdn', nargs='+')
+        parser.add_argument('--dry-run', default=False, action='store_true',
+                            help='only display the objects that would be removed')
 
     def handle(self, *args, **options):
-        fqdn = options['fqdn']
-        if Host.objects.filter(fqdn=fqdn).count() == 0:
-            self.stdout.write(self.style.WARNING('Host %s unknown') % fqdn)
-        else:
-            for host in Host.objects.filter(fqdn=fqdn):
-                host.delete()
-                self.stdout.write(self.style.WARNING('Host %s deleted') % fqdn)
+        report = HostDecommission(options['fqdn']).run(dry_run=options['dry_run'])
+        for fqdn in report['unknown_hosts']:
+            self.stdout.write(self.style.WARNING('Host %s unknown' % fqdn))
+        for key in ('services', 'principals', 'records', 'certificates'):
+            for value in report[key]:
+                self.stdout.write('%s: %s' % (key, value))
+        self.stdout.write('%(shinken_services)d Shinken service(s), %(mount_points)d mount point(s), '
+                          '%(zones)d DNS zone(s)' % report)
+        verb = 'would be deleted' if options['dry_run'] else 'deleted'
+        for fqdn in report['hosts']:
+            self.stdout.write(self.style.WARNING('Host %s %s' % (fqdn, verb)))
+        for principal, error in sorted(report['principal_errors'].items()):
+            self.stdout.write(self.style.ERROR('Principal %s not deleted: %s' % (principal, error)))
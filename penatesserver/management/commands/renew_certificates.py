@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from argparse import ArgumentParser
+import datetime
+
+from django.core.management import BaseCommand, CommandError
+from django.utils.timezone import now, localtime
+
+from penatesserver.models import CertificateRenewal
+from penatesserver.pki.service import PKI
+
+__author__ = 'Matthieu Gallet'
+
+
+def parse_hours(value):
+    """Return the set of hours of a range like "1-5" (ranges can wrap around midnight, like "22-5")
+
+    >>> sorted(parse_hours('22-1'))
+    [0, 1, 22, 23]
+    >>> sorted(parse_hours('3'))
+    [3]
+    """
+    first_hour, sep, last_hour = value.partition('-')
+    first_hour, last_hour = int(first_hour), int(last_hour or first_hour)
+    if not (0 <= first_hour <= 23 and 0 <= last_hour <= 23):
+        raise ValueError('hours must be between 0 and 23')
+    if first_hour <= last_hour:
+        return set(range(first_hour, last_hour + 1))
+    return set(range(first_hour, 24)) | set(range(0, last_hour + 1))
+
+
+class Command(BaseCommand):
+    help = 'Renew in advance the certificates that are about to expire (to be run from a cron job, ' \
+           'e.g. each night). Certificates are renewed by order of expiration date, with at most --batch ' \
+           'certificates per run, so certificates issued on the same day are spread over several runs.'
+
+    def add_arguments(self, parser):
+        assert isinstance(parser, ArgumentParser)
+        parser.add_argument('--days', default=45, type=int,
+                            help='renew certificates expiring in less than this number of days (default: 45, '
+                                 'certificates are renewed on request when expiring in less than 30 days)')
+        parser.add_argument('--batch', default=50, type=int, help='max number of renewed certificates')
+        parser.add_argument('--hours', default=None,
+                            help='only renew certificates during these hours (e.g. "1-5" for 1:00 to 5:59, '
+                                 'or "22-5" for 22:00 to 5:59)')
+        parser.add_argument('--dry-run', default=False, action='store_true', help='only display certificates')
+
+    def handle(self, *args, **options):
+        if options['hours']:
+            try:
+                hours = parse_hours(options['hours'])
+            except ValueError:
+                raise CommandError('Invalid --hours value "%s" (e.g. "1-5" or "22-5" are expected)' %
+                                   options['hours'])
+            if localtime(now()).hour not in hours:
+                self.stdout.write(self.style.WARNING('Outside of the allowed hours (%s).' % options['hours']))
+                return
+        pki = PKI()
+        limit = now() + datetime.timedelta(days=options['days'])
+        expiring = [x for x in pki.get_expiry_index() if x[0] < limit][:options['batch']]
+        for end_date, serial, entry in expiring:
+            self.stdout.write('%s (%s, serial %s) expires on %s' % (entry.commonName, entry.role, serial, end_date))
+            if options['dry_run']:
+                continue
+            new_serial = pki.renew_certificate(entry)
+            CertificateRenewal(common_name=entry.commonName, role=entry.role, old_serial=serial,
+                               old_end_date=end_date, new_serial=new_serial or '').save()
+        self.stdout.write(self.style.SUCCESS('%d certificate(s) %s.' %
+                                             (len(expiring), 'to renew' if options['dry_run'] else 'renewed')))
@@ -6,6 +6,7 @@ from django.conf import settings
 from django.core.management import BaseCommand, call_command
 from django.utils.translation import ugettext as _
 
+from penatesserver.glpi.models import record_monitoring_changes
 from penatesserver.models import Service
 from penatesserver.pki.service import CertificateEntry
 from penatesserver.powerdns.models import Domain
@@ -59,6 +60,7 @@ class Command(BaseCommand):
         Service.objects.filter(pk=service.pk).update(kerberos_service=kerberos_service,
                                                      description=options['description'], dns_srv=srv_field,
                                                      encryption=encryption)
+        record_monitoring_changes(services=[fqdn])
 
         # certificate part
         if options['role']:
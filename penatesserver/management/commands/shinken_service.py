@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 import argparse
+import codecs
+import json
 
-from django.core.management import BaseCommand
+from django.core.management import BaseCommand, CommandError
 
-from penatesserver.glpi.models import ShinkenService
+from penatesserver.glpi.models import ShinkenService, record_monitoring_changes
 
 __author__ = 'Matthieu Gallet'
 
@@ -12,8 +14,11 @@ __author__ = 'Matthieu Gallet'
 class Command(BaseCommand):
     def add_arguments(self, parser):
         assert isinstance(parser, argparse.ArgumentParser)
-        parser.add_argument('host_name', help='Host fqdn')
-        parser.add_argument('check_command', help='Nagios check_command')
+        parser.add_argument('host_name', nargs='?', default=None, help='Host fqdn')
+        parser.add_argument('check_command', nargs='?', default=None, help='Nagios check_command')
+        parser.add_argument('--from-file', dest='from_file', default=None,
+                            help='JSON file: list of services of the given host, or {host fqdn: [services]}. '
+                                 'All Shinken services of these hosts are replaced.')
         parser.add_argument('--delete', help='Service description', default=False, action='store_true')
         parser.add_argument('--hostgroup_name', default=None)
         parser.add_argument('--service_description', default=None)
@@ -75,6 +80,11 @@ class Command(BaseCommand):
         parser.add_argument('--trigger_broker_raise_enabled', default=None, choices=['0', '1'])
 
     def handle(self, *args, **options):
+        if options['from_file']:
+            self.handle_file(options['from_file'], options['host_name'])
+            return
+        if not options['host_name'] or not options['check_command']:
+            raise CommandError('host_name and check_command are required')
         values = {k: options[k] for k in ShinkenService.get_field_list() if options[k] is not None}
         check_command = options['check_command']
         host_name = options['host_name']
@@ -85,4 +95,21 @@ class Command(BaseCommand):
         elif options['delete']:
             ShinkenService.objects.filter(host_name=host_name, check_command=check_command).delete()
             self.stdout.write(self.style.ERROR('%s:%s deleted') % (host_name, check_command))
+        else:
+            record_monitoring_changes(services=[host_name])
 
+    def handle_file(self, filename, host_name):
+        with codecs.open(filename, 'r', encoding='utf-8') as fd:
+            content = json.load(fd)
+        if isinstance(content, list):
+            if not host_name:
+                raise CommandError('host_name is required when the file contains a list of services')
+            content = {host_name: content}
+        elif not isinstance(content, dict):
+            raise CommandError('%s must contain a list or a dict' % filename)
+        for host_name_, definitions in sorted(content.items()):
+            try:
+                created, updated, deleted = ShinkenService.synchronize(host_name_, definitions)
+            except ValueError as e:
+                raise CommandError('%s: %s' % (host_name_, e))
+            self.stdout.write('%s: %d created, %d updated, %d deleted' % (host_name_, created, updated, deleted))
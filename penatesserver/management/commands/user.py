@@ -40,9 +40,6 @@ class Command(BaseCommand):
         for group_name in options['group']:
             groups = list(Group.objects.filter(name=group_name)[0:1])
             if groups:
-                group = groups[0]
+                groups[0].add_members([username])
             else:
-                group = Group(name=group_name)
-            if username not in group.members:
-                group.members.append(username)
-            group.save()
+                Group(name=group_name, members=[username]).save()
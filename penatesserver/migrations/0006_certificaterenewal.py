@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('penatesserver', '0005_auto_20151226_1601'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CertificateRenewal',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('common_name', models.CharField(db_index=True, max_length=255, verbose_name='common name')),
+                ('role', models.CharField(db_index=True, max_length=255, verbose_name='role')),
+                ('old_serial', models.CharField(max_length=255, verbose_name='old serial')),
+                ('old_end_date', models.DateTimeField(verbose_name='old expiration date')),
+                ('new_serial', models.CharField(blank=True, default='', max_length=255, verbose_name='new serial')),
+                ('renewal_date', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='renewal date')),
+            ],
+        ),
+    ]
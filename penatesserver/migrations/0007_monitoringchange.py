@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('penatesserver', '0006_certificaterenewal'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonitoringChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('hosts', 'hosts'), ('services', 'services'),
+                                                   ('contacts', 'contacts')], max_length=20, verbose_name='kind')),
+                ('key', models.CharField(max_length=255, verbose_name='key')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='monitoringchange',
+            index_together=set([('kind', 'key')]),
+        ),
+    ]
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+# checks that were previously hard-coded: (name, template, description, check command, icon set, check interval)
+DEFAULT_CHECK_TEMPLATES = [
+    ('ssh', 'local-service', 'Check SSH %(fqdn)s', 'check_ssh', None, None),
+    ('ping', 'local-service', 'Ping %(fqdn)s', 'check_ping!100.0,20%%!500.0,60%%', 'server', None),
+    ('disks', 'generic-service', 'Check all disks on %(fqdn)s', 'check_nrpe!check_all_disk', 'disk', None),
+    ('swap', 'generic-service', 'Check swap on %(fqdn)s', 'check_nrpe!check_swap', None, None),
+    ('procs', 'generic-service', 'Check number of processes on %(fqdn)s', 'check_nrpe!check_total_procs',
+     'server', None),
+    ('zombies', 'generic-service', 'Check number of zombie processes on %(fqdn)s', 'check_nrpe!check_zombie_procs',
+     'server', None),
+    ('load', 'generic-service', 'Check load on %(fqdn)s', 'check_nrpe!check_load', 'server', None),
+    ('dns', 'local-service', 'Check DNS %(fqdn)s', 'penates_dig_2!%(fqdn)s!%(main_ip_address)s', 'server', 240),
+    ('admin_dns', 'local-service', 'Check DNS %(fqdn)s', 'penates_dig_2!%(admin_fqdn)s!%(admin_ip_address)s',
+     'server', 240),
+    ('admin_certificate', 'generic-service', 'Check admin certificate on %(fqdn)s', 'check_nrpe!check_cert_admin',
+     'server', 1440),
+    ('host_certificate', 'generic-service', 'Check host certificate on %(fqdn)s', 'check_nrpe!check_cert_host',
+     'server', 1440),
+]
+
+
+def create_default_templates(apps, schema_editor):
+    check_template_model = apps.get_model('penatesserver', 'CheckTemplate')
+    check_template_model.objects.using(schema_editor.connection.alias).bulk_create(
+        [check_template_model(name=name, use=use, service_description=description, check_command=command,
+                              icon_set=icon_set, check_interval=check_interval, position=index)
+         for (index, (name, use, description, command, icon_set, check_interval))
+         in enumerate(DEFAULT_CHECK_TEMPLATES)])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('penatesserver', '0007_monitoringchange'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CheckTemplate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True, verbose_name='name')),
+                ('use', models.CharField(default='generic-service', max_length=255, verbose_name='use')),
+                ('service_description', models.CharField(max_length=255, verbose_name='service_description')),
+                ('check_command', models.CharField(max_length=255, verbose_name='check_command')),
+                ('icon_set', models.CharField(blank=True, default=None, max_length=255, null=True,
+                                              verbose_name='icon_set')),
+                ('check_interval', models.IntegerField(blank=True, default=None, null=True,
+                                                       verbose_name='check_interval')),
+                ('notifications_enabled', models.IntegerField(choices=[(0, '0'), (1, '1')], default=0,
+                                                              verbose_name='notifications_enabled')),
+                ('enabled', models.BooleanField(db_index=True, default=True, verbose_name='enabled')),
+                ('position', models.IntegerField(default=0, verbose_name='position')),
+            ],
+            options={
+                'ordering': ('position', 'pk'),
+            },
+        ),
+        migrations.RunPython(create_default_templates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import F, Max
+
+
+def init_versions(apps, schema_editor):
+    alias = schema_editor.connection.alias
+    change_model = apps.get_model('penatesserver', 'MonitoringChange')
+    version_model = apps.get_model('penatesserver', 'MonitoringVersion')
+    change_model.objects.using(alias).update(version=F('pk'))
+    value = change_model.objects.using(alias).aggregate(value=Max('pk'))['value'] or 0
+    version_model.objects.using(alias).create(pk=1, value=value)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('penatesserver', '0008_checktemplate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonitoringVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.IntegerField(default=0, verbose_name='value')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='monitoringchange',
+            name='version',
+            field=models.IntegerField(db_index=True, default=0, verbose_name='version'),
+        ),
+        migrations.RunPython(init_versions, migrations.RunPython.noop),
+    ]
@@ -1,31 +1,39 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 import codecs
+from collections import OrderedDict
+import copy
 import os
+import random
+import time
 
 from django.conf import settings
+from django.core.cache import caches
 from django.contrib.auth.models import PermissionsMixin, UserManager, Permission
 from django.contrib.auth.models import AbstractBaseUser
 from django.core import validators
 from django.core.mail import send_mail
 from django.core.validators import RegexValidator
-from django.db.models import Q
-from django.db.models.signals import post_delete
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
+from django.http import Http404
 from django.utils import timezone
-from django.utils.lru_cache import lru_cache
+from django.utils.encoding import force_text
+from django.utils.six import text_type
 from django.utils.translation import ugettext as _
-from django.db import models
+from django.db import models, transaction, connections, router
 from ldapdb.models.fields import CharField, IntegerField, ListField, ImageField as ImageField_
 import ldapdb.models
-from penatesserver.glpi.models import ShinkenService
+import ldap
+from ldap.controls import SimplePagedResultsControl
+from ldap.filter import escape_filter_chars
 
+from penatesserver.glpi.models import ShinkenService, record_monitoring_changes, CheckTemplate
 from penatesserver.kerb import change_password, delete_principal, add_principal
 from penatesserver.pki.constants import USER, EMAIL, SIGNATURE, ENCIPHERMENT
 from penatesserver.pki.service import CertificateEntry
-from penatesserver.powerdns.models import Record
 from penatesserver.utils import force_bytestrings, force_bytestring, password_hash, ensure_location, \
-    principal_from_hostname
+    principal_from_hostname, chunks
 
 
 __author__ = 'flanker'
@@ -38,7 +46,30 @@ class ImageField(ImageField_):
         return 'CharField'
 
 
+ldap_cache_stats = {'hits': 0, 'misses': 0, 'invalidations': 0, }
+
+
+def get_ldap_cache():
+    return caches[settings.LDAP_CACHE]
+
+
 class BaseLdapModel(ldapdb.models.Model):
+    """Base class of LDAP models.
+
+    Lookups on the primary key or on unique fields (listed in `cached_fields`) can use a read-through cache
+    (:meth:`get_cached`), which is invalidated by :meth:`save` and :meth:`delete`.
+    Fields listed in `uncached_fields` (secrets, large attributes) are not stored in this cache.
+    Values of the `allocated_fields` (uid or gid numbers) read from LDAP are remembered, so the id counter is only
+    updated when they are explicitly set or modified.
+    """
+    cached_fields = ('name', )
+    uncached_fields = ()
+    allocated_fields = ()
+
+    def __init__(self, *args, **kwargs):
+        super(BaseLdapModel, self).__init__(*args, **kwargs)
+        self.saved_ids = {x: getattr(self, x) for x in self.allocated_fields} if self.dn else {}
+
     def __str__(self):
         return self.name
 
@@ -48,17 +79,178 @@ class BaseLdapModel(ldapdb.models.Model):
     def __repr__(self):
         return '%s("%s")' % (self.__class__.__name__, self.name)
 
+    ldap_page_size = 500
+
     class Meta(object):
         abstract = True
 
+    def save(self, using=None):
+        super(BaseLdapModel, self).save(using=using)
+        self.saved_ids = {x: getattr(self, x) for x in self.allocated_fields}
+        self.invalidate_cache()
+
+    def delete(self, using=None):
+        super(BaseLdapModel, self).delete(using=using)
+        self.invalidate_cache()
+
+    @classmethod
+    def get_cache_key(cls, field_name, value):
+        return 'penates:ldap:%s:%s:%s' % (cls.__name__.lower(), field_name, value)
+
+    @classmethod
+    def get_cached(cls, **kwargs):
+        """Return the object matching the given primary key or unique field (e.g. `Group.get_cached(gid=10000)`)
+        or `None`. Objects are kept in the `settings.LDAP_CACHE` cache for `settings.LDAP_CACHE_TIMEOUT` seconds.
+        Returned objects do not contain the `uncached_fields`, so they must not be saved (load a fresh object instead).
+        """
+        if len(kwargs) != 1:
+            raise ValueError('A single lookup is allowed')
+        field_name, value = list(kwargs.items())[0]
+        if field_name not in cls.cached_fields:
+            raise ValueError('%s is not a cached field' % field_name)
+        obj = get_ldap_cache().get(cls.get_cache_key(field_name, value))
+        if obj is not None:
+            ldap_cache_stats['hits'] += 1
+            return obj
+        ldap_cache_stats['misses'] += 1
+        objs = list(cls.objects.filter(**{field_name: value})[0:1])
+        if not objs:
+            return None
+        return objs[0].store_in_cache()
+
+    @classmethod
+    def get_cached_or_404(cls, **kwargs):
+        obj = cls.get_cached(**kwargs)
+        if obj is None:
+            raise Http404('No %s matches the given query.' % cls.__name__)
+        return obj
+
+    def get_cache_keys(self):
+        return [self.get_cache_key(x, getattr(self, x)) for x in self.cached_fields if getattr(self, x) is not None]
+
+    def store_in_cache(self):
+        """Store a copy of this object, without its `uncached_fields`, and return this copy"""
+        obj = copy.copy(self)
+        for field_name in self.uncached_fields:
+            setattr(obj, field_name, None)
+        get_ldap_cache().set_many({key: obj for key in self.get_cache_keys()}, settings.LDAP_CACHE_TIMEOUT)
+        return obj
+
+    def invalidate_cache(self):
+        """Remove this object from the cache (also using the previous values of its unique fields)"""
+        cache = get_ldap_cache()
+        keys = set(self.get_cache_keys()) | {self.get_cache_key('sorted_names', '')}
+        previous = cache.get(self.get_cache_key('name', self.name))
+        if previous is not None:
+            keys |= set(previous.get_cache_keys())
+        cache.delete_many(list(keys))
+        ldap_cache_stats['invalidations'] += 1
+
     def set_next_free_value(self, attr_name, default=2000):
-        if getattr(self, attr_name) is not None:
-            return
-        values = list(self.__class__.objects.all().order_by(b'-' + attr_name.encode('utf-8'))[0:1])
+        value = getattr(self, attr_name)
+        if value is None:
+            setattr(self, attr_name, self.get_id_allocator(attr_name, default=default).allocate())
+        elif self.saved_ids.get(attr_name) != value:
+            # explicitly set on a new entry, or modified: no LDAP access for unchanged existing entries
+            self.get_id_allocator(attr_name, default=default).reserve(value)
+
+    @classmethod
+    def get_id_allocator(cls, attr_name, default=2000):
+        """Return the allocator of free values for the given integer attribute (uid or gid number)
+        :rtype: :class:`penatesserver.models.IdAllocator`
+        """
+        return IdAllocator(cls, attr_name, default=default)
+
+    @classmethod
+    def get_ldap_filter(cls, *filters):
+        """Return a LDAP filter matching the entries of this model (and the extra filters)"""
+        return '(&%s)' % ''.join(['(objectClass=%s)' % force_text(x) for x in cls.object_classes] + list(filters))
+
+    @classmethod
+    def paged_search(cls, filterstr, attr_names, page_size=None):
+        """Iterate over the (dn, attrs) LDAP entries matching the given filter, only fetching the given
+        attributes. Results are retrieved by pages of `page_size` entries (RFC 2696 paged results control),
+        so the server size limit is never hit.
+        """
+        connection = get_ldap_connection(cls)
+        control = SimplePagedResultsControl(True, size=page_size or cls.ldap_page_size, cookie='')
+        attr_names = [force_bytestring(x) for x in attr_names]
+        while True:
+            msgid = connection.search_ext(force_bytestring(cls.base_dn), ldap.SCOPE_SUBTREE,
+                                          force_bytestring(filterstr), attr_names, serverctrls=[control])
+            rtype, rdata, rmsgid, serverctrls = connection.result3(msgid)
+            for dn, attrs in rdata:
+                if dn is not None:  # search references
+                    yield dn, attrs
+            cookies = [x.cookie for x in serverctrls if x.controlType == SimplePagedResultsControl.controlType]
+            if not cookies or not cookies[0]:
+                break
+            control.cookie = cookies[0]
+
+    @classmethod
+    def get_ldap_attributes(cls, field_names):
+        # noinspection PyProtectedMember
+        return [force_text(cls._meta.get_field(x).db_column) for x in field_names]
+
+    @classmethod
+    def from_ldap_entry(cls, dn, attrs, field_names):
+        """Build an object from a LDAP entry that only contains the attributes of the given fields.
+        Other fields keep their default values, so such objects must not be saved."""
+        connection = connections[router.db_for_read(cls)]
+        attrs = {force_text(key).lower(): values for (key, values) in attrs.items()}
+        values = {}
+        for field_name in field_names:
+            # noinspection PyProtectedMember
+            field = cls._meta.get_field(field_name)
+            values[field.attname] = field.from_ldap(attrs.get(force_text(field.db_column).lower(), []),
+                                                    connection=connection)
+        return cls(dn=force_text(dn), **values)
+
+    @classmethod
+    def get_cached_sorted_names(cls):
+        """Return the result of :meth:`get_sorted_names`, kept in the `settings.LDAP_CACHE` cache until an object
+        of this model is saved or deleted (or for `settings.LDAP_CACHE_TIMEOUT` seconds)"""
+        cache = get_ldap_cache()
+        key = cls.get_cache_key('sorted_names', '')
+        names = cache.get(key)
+        if names is None:
+            names = cls.get_sorted_names()
+            cache.set(key, names, settings.LDAP_CACHE_TIMEOUT)
+        return names
+
+    @classmethod
+    def get_sorted_names(cls):
+        """Return the sorted list of all primary keys, only transferring the primary key attribute"""
+        attr_name = cls.get_ldap_attributes(['name'])[0].lower()
+        names = []
+        for dn, attrs in cls.paged_search(cls.get_ldap_filter(), [attr_name]):
+            for key, values in attrs.items():
+                if force_text(key).lower() == attr_name and values:
+                    names.append(force_text(values[0]))
+        names.sort()
+        return names
+
+    @classmethod
+    def get_projected_objects(cls, names, field_names):
+        """Return the objects with the given primary keys (in the same order), only loading the given fields
+        (e.g. no `jpegPhoto` when it is not displayed)"""
+        field_names = ['name'] + [x for x in field_names if x != 'name']
+        attr_names = cls.get_ldap_attributes(field_names)
+        objects = {}
+        for values in chunks(names, 100):
+            name_filter = '(|%s)' % ''.join(['(%s=%s)' % (attr_names[0], escape_filter_chars(x)) for x in values])
+            for dn, attrs in cls.paged_search(cls.get_ldap_filter(name_filter), attr_names):
+                obj = cls.from_ldap_entry(dn, attrs, field_names)
+                objects[obj.name] = obj
+        return [objects[x] for x in names if x in objects]
+
+    @classmethod
+    def get_max_value(cls, attr_name):
+        """Return the highest value of the given attribute (requires a server-side sort on the whole OU)"""
+        values = list(cls.objects.all().order_by(b'-' + attr_name.encode('utf-8'))[0:1])
         if not values:
-            setattr(self, attr_name, default)
-        else:
-            setattr(self, attr_name, getattr(values[0], attr_name) + 1)
+            return None
+        return getattr(values[0], attr_name)
 
 
 class SambaDomain(BaseLdapModel):
@@ -68,15 +260,154 @@ class SambaDomain(BaseLdapModel):
     sid = CharField(db_column=force_bytestring('sambaSID'))
     name = CharField(db_column=force_bytestring('sambaDomainName'), primary_key=True)
 
+    def get_cache_keys(self):
+        return super(SambaDomain, self).get_cache_keys() + [self.get_cache_key('domain', '')]
+
+
+def get_samba_domain():
+    """Return the (cached) Samba domain
+    :rtype: :class:`penatesserver.models.SambaDomain`
+    """
+    cache = get_ldap_cache()
+    key = SambaDomain.get_cache_key('domain', '')
+    domain = cache.get(key)
+    if domain is not None:
+        ldap_cache_stats['hits'] += 1
+        return domain
+    ldap_cache_stats['misses'] += 1
+    domain = SambaDomain.objects.all()[0]
+    cache.set(key, domain, settings.LDAP_CACHE_TIMEOUT)
+    return domain
+
 
-# noinspection PyCallingNonCallable
-@lru_cache()
 def get_samba_sid():
-    return SambaDomain.objects.all()[0].sid
+    return get_samba_domain().sid
+
+
+def get_samba_domain_dn():
+    return get_samba_domain().dn
+
+
+def get_ldap_connection(model):
+    """Return the raw python-ldap connection used by the given LDAP model"""
+    connection = connections[router.db_for_write(model)]
+    connection.ensure_connection()
+    return connection.connection
+
+
+def modify_ldap_values(connection, dn, ldap_attr_name, mod_op, values):
+    """Add (`ldap.MOD_ADD`) or remove (`ldap.MOD_DELETE`) some values of a multi-valued attribute, without
+    sending the other values.
+    If the server rejects the whole modification (some values already added or already removed by someone
+    else), values are sent one by one and these conflicts are ignored.
+    """
+    dn = force_bytestring(dn)
+    attr_name = force_bytestring(ldap_attr_name)
+    values = [force_bytestring(x) for x in values]
+    ignored_errors = (ldap.TYPE_OR_VALUE_EXISTS, ) if mod_op == ldap.MOD_ADD else (ldap.NO_SUCH_ATTRIBUTE, )
+    try:
+        connection.modify_s(dn, [(mod_op, attr_name, values)])
+    except ignored_errors:
+        for value in values:
+            try:
+                connection.modify_s(dn, [(mod_op, attr_name, [value])])
+            except ignored_errors:
+                pass
+
+
+class IdAllocator(object):
+    """Allocate uidNumber/gidNumber values from a counter stored on the sambaDomain entry (with the sambaUnixIdPool
+    auxiliary object class, like smbldap-tools).
+
+    The counter is incremented with an atomic modify (delete the old value, add the new one): if another worker
+    has modified it in the meantime, the LDAP server rejects the whole modification and we retry.
+    Allocating a block of `count` values costs the same as allocating a single value.
+    The counter is initialized from the highest existing value on first use, and moved past explicitly set values
+    (:meth:`reserve`).
+    """
+    pool_object_class = 'sambaUnixIdPool'
+    max_attempts = 20
+
+    def __init__(self, model, attr_name, default=2000):
+        self.model = model
+        self.attr_name = attr_name
+        # noinspection PyProtectedMember
+        self.ldap_attr_name = force_text(model._meta.get_field(attr_name).db_column)
+        self.default = default
+
+    def allocate(self, count=1):
+        """Reserve `count` consecutive free values and return the first one
+        :rtype: :class:`int`
+        """
+        connection = get_ldap_connection(SambaDomain)
+        dn = force_bytestring(get_samba_domain_dn())
+        for attempt in range(self.max_attempts):
+            current_value = self.read_counter(connection, dn)
+            if current_value is None:
+                self.initialize_counter(connection, dn)
+                continue
+            if self.set_counter(connection, dn, current_value, current_value + count):
+                return current_value
+            # concurrent allocation: retry with the new counter value
+            time.sleep(random.random() * 0.05 * (attempt + 1))
+        raise ValueError('Unable to allocate a new %s value' % self.ldap_attr_name)
+
+    def reserve(self, value):
+        """Move the counter past an explicitly set value, so this value is never allocated again"""
+        connection = get_ldap_connection(SambaDomain)
+        dn = force_bytestring(get_samba_domain_dn())
+        for attempt in range(self.max_attempts):
+            current_value = self.read_counter(connection, dn)
+            if current_value is None:
+                self.initialize_counter(connection, dn)
+                continue
+            if current_value > value or self.set_counter(connection, dn, current_value, value + 1):
+                return
+            time.sleep(random.random() * 0.05 * (attempt + 1))
+        raise ValueError('Unable to reserve the %s value %s' % (self.ldap_attr_name, value))
+
+    def set_counter(self, connection, dn, current_value, new_value):
+        """Atomically replace the counter value, return False if it has been modified by another worker"""
+        attr_name = force_bytestring(self.ldap_attr_name)
+        modlist = [(ldap.MOD_DELETE, attr_name, [force_bytestring(text_type(current_value))]),
+                   (ldap.MOD_ADD, attr_name, [force_bytestring(text_type(new_value))])]
+        try:
+            connection.modify_s(dn, modlist)
+        except (ldap.NO_SUCH_ATTRIBUTE, ldap.TYPE_OR_VALUE_EXISTS):
+            return False
+        return True
+
+    @staticmethod
+    def read_attribute(connection, dn, ldap_attr_name):
+        """Return the list of values of an attribute of the given LDAP entry"""
+        result = connection.search_s(dn, ldap.SCOPE_BASE, b'(objectClass=*)', [force_bytestring(ldap_attr_name)])
+        for entry_dn, attrs in result:
+            for key, values in attrs.items():
+                if force_text(key).lower() == ldap_attr_name.lower():
+                    return values
+        return []
+
+    def read_counter(self, connection, dn):
+        values = self.read_attribute(connection, dn, self.ldap_attr_name)
+        return int(values[0]) if values else None
+
+    def initialize_counter(self, connection, dn):
+        max_value = self.model.get_max_value(self.attr_name)
+        value = self.default if max_value is None else max(self.default, max_value + 1)
+        object_classes = {force_text(x).lower() for x in self.read_attribute(connection, dn, 'objectClass')}
+        modlist = [(ldap.MOD_ADD, force_bytestring(self.ldap_attr_name), [force_bytestring(text_type(value))])]
+        if self.pool_object_class.lower() not in object_classes:
+            modlist.insert(0, (ldap.MOD_ADD, b'objectClass', [force_bytestring(self.pool_object_class)]))
+        try:
+            connection.modify_s(dn, modlist)
+        except (ldap.TYPE_OR_VALUE_EXISTS, ldap.CONSTRAINT_VIOLATION):
+            pass  # initialized by another worker
 
 
 class Group(BaseLdapModel):
     base_dn = 'ou=Groups,' + settings.LDAP_BASE_DN
+    cached_fields = ('name', 'gid', )
+    allocated_fields = ('gid', )
     object_classes = force_bytestrings(['posixGroup', 'sambaGroupMapping'])
     # posixGroup attributes
     name = CharField(db_column=force_bytestring('cn'), max_length=200, primary_key=True,
@@ -87,21 +418,71 @@ class Group(BaseLdapModel):
     group_type = IntegerField(db_column=force_bytestring('sambaGroupType'), default=None)
     samba_sid = CharField(db_column=force_bytestring('sambaSID'), unique=True, default='')
 
-    def save(self, using=None):
+    def save(self, using=None, sync_group_of_names=True):
+        """
+        :param sync_group_of_names: also create or update the matching :class:`GroupOfNames`
+            (bulk imports do it by themselves)
+        """
         self.group_type = 2
         self.set_next_free_value('gid', default=10000)
         self.samba_sid = '%s-%d' % (get_samba_sid(), self.gid)
         super(Group, self).save(using=using)
+        if not sync_group_of_names:
+            return
         group_of_names = list(GroupOfNames.objects.filter(name=self.name)[0:1])
         if not group_of_names:
-            group = GroupOfNames(name=self.name, members=['cn=admin,' + settings.LDAP_BASE_DN])
+            group = GroupOfNames(name=self.name, members=[GroupOfNames.admin_dn])
             group.save()
         else:
             group = group_of_names[0]
-        new_members = ['cn=admin,' + settings.LDAP_BASE_DN] + ['uid=%s,%s' % (x, User.base_dn) for x in self.members]
-        if new_members != group.members:
-            group.members = new_members
-            group.save()
+        new_members = GroupOfNames.get_member_dns(self.members)
+        connection = get_ldap_connection(GroupOfNames)
+        added_members = [x for x in new_members if x not in group.members]
+        removed_members = [x for x in group.members if x not in new_members]
+        if added_members:
+            modify_ldap_values(connection, group.dn, 'member', ldap.MOD_ADD, added_members)
+        if removed_members:
+            modify_ldap_values(connection, group.dn, 'member', ldap.MOD_DELETE, removed_members)
+
+    def add_members(self, usernames):
+        """Add the given users to this group (and to its :class:`GroupOfNames`), only sending the new values to
+        the LDAP server (the group is never rewritten as a whole). Users that are already members are ignored by
+        the server, so this group may be a (possibly stale) cached copy.
+
+        :return: the list of (de-duplicated) usernames
+        """
+        usernames = list(OrderedDict.fromkeys(usernames))
+        if usernames:
+            self.update_member_values(ldap.MOD_ADD, usernames,
+                                      self.members + [x for x in usernames if x not in self.members])
+        return usernames
+
+    def remove_members(self, usernames):
+        """Remove the given users from this group (and from its :class:`GroupOfNames`), only sending the removed
+        values to the LDAP server. Users that are not members are ignored by the server.
+
+        :return: the list of (de-duplicated) usernames
+        """
+        usernames = list(OrderedDict.fromkeys(usernames))
+        if usernames:
+            self.update_member_values(ldap.MOD_DELETE, usernames, [x for x in self.members if x not in usernames])
+        return usernames
+
+    def update_member_values(self, mod_op, usernames, new_members):
+        connection = get_ldap_connection(Group)
+        modify_ldap_values(connection, self.build_dn(), 'memberUid', mod_op, usernames)
+        self.members = new_members
+        self.invalidate_cache()
+        group_of_names = GroupOfNames(name=self.name)
+        try:
+            modify_ldap_values(connection, group_of_names.build_dn(), 'member', mod_op,
+                               GroupOfNames.get_member_dns(usernames)[1:])
+        except ldap.NO_SUCH_OBJECT:
+            # the mirror is rebuilt from the current members, not from this (possibly cached) copy
+            fresh_groups = list(Group.objects.filter(name=self.name)[0:1])
+            members = fresh_groups[0].members if fresh_groups else new_members
+            group_of_names.members = GroupOfNames.get_member_dns(members)
+            group_of_names.save()
 
 
 class GroupOfNames(BaseLdapModel):
@@ -110,10 +491,19 @@ class GroupOfNames(BaseLdapModel):
     name = CharField(db_column=force_bytestring('cn'), max_length=200, primary_key=True,
                      validators=list(name_validators))
     members = ListField(db_column=force_bytestring('member'))
+    admin_dn = 'cn=admin,' + settings.LDAP_BASE_DN
+
+    @classmethod
+    def get_member_dns(cls, usernames):
+        """Return the `member` values matching the given `memberUid` values (the admin is always a member)"""
+        return [cls.admin_dn] + ['uid=%s,%s' % (x, User.base_dn) for x in usernames]
 
 
 class User(BaseLdapModel):
     base_dn = 'ou=Users,' + settings.LDAP_BASE_DN
+    cached_fields = ('name', 'uid_number', )
+    allocated_fields = ('uid_number', )
+    uncached_fields = ('user_password', 'jpeg_photo', )
     object_classes = force_bytestrings(['posixAccount', 'shadowAccount', 'inetOrgPerson', 'sambaSamAccount', 'person',
                                         'AsteriskSIPUser'])
     name = CharField(db_column=force_bytestring('uid'), max_length=200, primary_key=True,
@@ -151,8 +541,13 @@ class User(BaseLdapModel):
     ast_account_allowed_codec = CharField(db_column=force_bytestring('AstAccountAllowedCodec'), default='ulaw')
     ast_account_music_on_hold = CharField(db_column=force_bytestring('AstAccountMusicOnHold'), default='default')
 
-    def save(self, using=None):
-        group = self.set_gid_number()
+    def save(self, using=None, sync_group=True, sync_principal=True):
+        """
+        :param sync_group: find (or create) the primary group and add this user to it
+        :param sync_principal: create the Kerberos principal
+        Bulk imports disable both and do it by themselves, for many users at once.
+        """
+        group = self.set_gid_number() if sync_group else None
         self.cn = self.name
         self.sn = self.name
         self.gecos = self.display_name
@@ -165,10 +560,11 @@ class User(BaseLdapModel):
         self.samba_sid = '%s-%d' % (get_samba_sid(), self.uid_number)
         self.primary_group_samba_sid = '%s-%d' % (get_samba_sid(), self.gid_number)
         super(User, self).save(using=using)
-        if group and self.name not in group.members:
-            group.members.append(self.name)
-            group.save()
-        add_principal(self.principal_name)
+        if group:
+            group.add_members([self.name])
+        if sync_principal:
+            add_principal(self.principal_name)
+        record_monitoring_changes(contacts=[self.name])
 
     @property
     def principal_name(self):
@@ -176,14 +572,12 @@ class User(BaseLdapModel):
 
     def set_gid_number(self):
         if self.gid_number is not None:
-            groups = list(Group.objects.filter(gid=self.gid_number)[0:1])
+            group = Group.get_cached(gid=self.gid_number)
         else:
-            groups = list(Group.objects.filter(name=self.name)[0:1])
-        if not groups:
+            group = Group.get_cached(name=self.name)
+        if group is None:
             group = Group(name=self.name, gid=self.gid_number)
             group.save()
-        else:
-            group = groups[0]
         self.gid_number = group.gid
         return group
 
@@ -191,6 +585,9 @@ class User(BaseLdapModel):
         self.user_password = password_hash(password)
         self.save()
         change_password(self.principal_name, password)
+        self.store_cleartext_password(password)
+
+    def store_cleartext_password(self, password):
         if settings.STORE_CLEARTEXT_PASSWORDS:
             ensure_location(self.password_filename)
             with codecs.open(self.password_filename, 'w', encoding='utf-8') as fd:
@@ -210,6 +607,7 @@ class User(BaseLdapModel):
     def delete(self, using=None):
         super(User, self).delete(using=using)
         delete_principal(self.principal_name)
+        record_monitoring_changes(contacts=[self.name])
 
     @property
     def user_certificate_entry(self):
@@ -318,11 +716,13 @@ def delete_host(sender, instance=None, **kwargs):
     assert isinstance(instance, Host)
     # noinspection PyUnusedLocal
     kwargs = kwargs  # kwargs is required by Django
-    fqdn = instance.fqdn
-    Service.objects.filter(fqdn=fqdn).delete()
-    ShinkenService.objects.filter(host_name=fqdn).delete()
-    delete_principal(principal_from_hostname(fqdn, settings.PENATES_REALM))
-    Record.objects.filter(Q(name=fqdn) | Q(content=fqdn)).delete()
+    from penatesserver.decommission import HostDecommission, decommission_state
+    if getattr(decommission_state, 'active', False):  # already handled by HostDecommission
+        return
+    decommission = HostDecommission([instance.fqdn], ip_addresses=[instance.main_ip_address,
+                                                                   instance.admin_ip_address])
+    decommission.collect()
+    decommission.apply(delete_hosts=False)
 
 
 class WifiNetwork(models.Model):
@@ -343,6 +743,16 @@ class RecoveryKey(models.Model):
     recovery_key = models.TextField(verbose_name=_('recovery key'), default='', blank=True)
 
 
+class CertificateRenewal(models.Model):
+    """Certificates renewed in advance by the `renew_certificates` command"""
+    common_name = models.CharField(verbose_name=_('common name'), max_length=255, db_index=True)
+    role = models.CharField(verbose_name=_('role'), max_length=255, db_index=True)
+    old_serial = models.CharField(verbose_name=_('old serial'), max_length=255)
+    old_end_date = models.DateTimeField(verbose_name=_('old expiration date'))
+    new_serial = models.CharField(verbose_name=_('new serial'), max_length=255, blank=True, default='')
+    renewal_date = models.DateTimeField(verbose_name=_('renewal date'), auto_now_add=True, db_index=True)
+
+
 class MountPoint(models.Model):
     host = models.ForeignKey(Host, db_index=True)
     mount_point = models.CharField(_('mount point'), max_length=255, default='/')
@@ -350,6 +760,67 @@ class MountPoint(models.Model):
     fs_type = models.CharField(_('fs type'), max_length=100, default='ext2')
     options = models.CharField(_('options'), max_length=100, blank=True, default='')
 
+    @staticmethod
+    def parse_mount_table(content):
+        """Parse a mount table, in the /proc/mounts (or fstab) format
+
+        >>> MountPoint.parse_mount_table('/dev/sda1 / ext4 rw,relatime 0 0\\n# comment\\ntmpfs /tmp tmpfs rw 0 0') == \
+[('/', '/dev/sda1', 'ext4', 'rw,relatime'), ('/tmp', 'tmpfs', 'tmpfs', 'rw')]
+        True
+
+        :param content: text content, one mount point per line
+        :return: list of (mount_point, device, fs_type, options)
+        :raise ValueError: if a line is invalid
+        """
+        result = []
+        for line in content.splitlines():
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            values = line.split()
+            if len(values) < 4:
+                raise ValueError('Invalid mount point: %s' % line)
+            result.append((values[1], values[0], values[2], values[3]))
+        return result
+
+    @classmethod
+    def synchronize(cls, host, mount_points):
+        """Replace the mount points of the given host by the provided ones.
+
+        Existing mount points are fetched with a single query, then new ones are created with `bulk_create`,
+        removed ones are deleted with a single query and only modified ones are updated.
+
+        :param host: the host
+        :type host: :class:`penatesserver.models.Host`
+        :param mount_points: complete mount table, as a list of (mount_point, device, fs_type, options)
+        :return: (created, updated, deleted) counts
+        """
+        new_values = {}
+        for mount_point, device, fs_type, options in mount_points:
+            new_values[mount_point] = (device, fs_type, options[:100])
+        with transaction.atomic():
+            existing = {}
+            to_delete = []
+            for pk, mount_point, device, fs_type, options in cls.objects.filter(host=host)\
+                    .values_list('pk', 'mount_point', 'device', 'fs_type', 'options'):
+                if mount_point in existing or mount_point not in new_values:
+                    to_delete.append(pk)
+                else:
+                    existing[mount_point] = (pk, (device, fs_type, options))
+            updated = 0
+            for mount_point, (pk, values) in existing.items():
+                if values != new_values[mount_point]:
+                    device, fs_type, options = new_values[mount_point]
+                    cls.objects.filter(pk=pk).update(device=device, fs_type=fs_type, options=options)
+                    updated += 1
+            if to_delete:
+                cls.objects.filter(pk__in=to_delete).delete()
+            to_create = [cls(host=host, mount_point=mount_point, device=device, fs_type=fs_type, options=options)
+                         for (mount_point, (device, fs_type, options)) in new_values.items()
+                         if mount_point not in existing]
+            cls.objects.bulk_create(to_create)
+        return len(to_create), updated, len(to_delete)
+
 
 class Netgroup(BaseLdapModel):
     base_dn = 'ou=netgroups,' + settings.LDAP_BASE_DN
@@ -469,3 +940,20 @@ class Service(models.Model):
 
     def __repr__(self):
         return '%s://%s%s/' % (self.smart_scheme, self.hostname, self.smart_port)
+
+
+@receiver([post_save, post_delete], sender=Host)
+@receiver([post_save, post_delete], sender=Service)
+@receiver([post_save, post_delete], sender=ShinkenService)
+@receiver([post_save, post_delete], sender=CheckTemplate)
+def invalidate_monitoring(sender, instance=None, **kwargs):
+    # noinspection PyUnusedLocal
+    kwargs = kwargs  # kwargs is required by Django
+    if sender == Host:
+        record_monitoring_changes(hosts=[instance.fqdn])
+    elif sender == Service:
+        record_monitoring_changes(services=[instance.fqdn])
+    elif sender == ShinkenService:
+        record_monitoring_changes(services=[instance.host_name])
+    elif sender == CheckTemplate:  # the services of all hosts are modified
+        record_monitoring_changes(services=Host.objects.values_list('fqdn', flat=True))
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from base64 import b64decode, b64encode
+import bisect
+from collections import OrderedDict
+import json
+
+from django.utils.encoding import force_text
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+__author__ = 'Matthieu Gallet'
+
+
+class LdapCursorPagination(BasePagination):
+    """Cursor pagination for LDAP models (:class:`penatesserver.models.BaseLdapModel`).
+
+    All primary keys are first retrieved (and only them, using the LDAP paged results control) and cached until
+    the model is modified, then only the entries of the requested page are fetched, with only the attributes
+    required by the serializer.
+    The cursor is the last (or first, for the previous page) displayed name, so it remains valid when entries
+    are added or removed.
+    Pagination is only used when the client gives a cursor or a page size: otherwise, the whole list is returned
+    (without the `next`/`previous` envelope), but entries are still fetched by pages and with projected attributes.
+    Filters of the view queryset are ignored: the whole OU is listed.
+    """
+    cursor_query_param = 'cursor'
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+    invalid_cursor_message = 'Invalid cursor'
+
+    def __init__(self):
+        self.base_url = None
+        self.next_position = None
+        self.previous_position = None
+        self.paginated = True
+
+    def paginate_queryset(self, queryset, request, view=None):
+        model = queryset.model
+        if self.cursor_query_param not in request.query_params and \
+                self.page_size_query_param not in request.query_params:
+            self.paginated = False
+            return model.get_projected_objects(model.get_cached_sorted_names(), self.get_field_names(model, view))
+        self.base_url = request.build_absolute_uri()
+        page_size = self.get_page_size(request)
+        position, reverse = self.decode_cursor(request)
+        names = model.get_cached_sorted_names()
+        if position is None:
+            start, end = 0, page_size
+        elif reverse:
+            end = bisect.bisect_left(names, position)
+            start = max(0, end - page_size)
+        else:
+            start = bisect.bisect_right(names, position)
+            end = start + page_size
+        page_names = names[start:end]
+        self.next_position = page_names[-1] if page_names and end < len(names) else None
+        self.previous_position = page_names[0] if page_names and start > 0 else None
+        return model.get_projected_objects(page_names, self.get_field_names(model, view))
+
+    @staticmethod
+    def get_field_names(model, view):
+        """Only fetch the model fields that are displayed by the serializer"""
+        # noinspection PyProtectedMember
+        model_field_names = {x.name for x in model._meta.fields}
+        if view is None:
+            return [x for x in model_field_names if x != 'dn']
+        return [x for x in view.get_serializer().fields if x in model_field_names]
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def decode_cursor(self, request):
+        """Return the (position, reverse) tuple encoded in the cursor of the request"""
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None, False
+        try:
+            values = json.loads(force_text(b64decode(encoded.encode('ascii'))))
+            return force_text(values['p']), bool(values.get('r'))
+        except (TypeError, ValueError, KeyError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, position, reverse):
+        encoded = force_text(b64encode(json.dumps({'p': position, 'r': 1 if reverse else 0}).encode('utf-8')))
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        return self.encode_cursor(self.next_position, False)
+
+    def get_previous_link(self):
+        if self.previous_position is None:
+            return None
+        return self.encode_cursor(self.previous_position, True)
+
+    def get_paginated_response(self, data):
+        if not self.paginated:
+            return Response(data)
+        return Response(OrderedDict([('next', self.get_next_link()), ('previous', self.get_previous_link()),
+                                     ('results', data)]))
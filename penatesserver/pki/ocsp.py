@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""OCSP responder (RFC 6960) backed by the openssl CA database.
+
+Responses are signed by a dedicated certificate (:data:`penatesserver.pki.constants.OCSPSIGNING` role) issued by
+each CA, pre-signed by openssl for a single serial number and stored in `<PKI_PATH>/ocsp/`, so most requests only
+require a dict lookup and a file read. A response is signed again when it is half-way through its validity window
+or when the status of the certificate has changed.
+"""
+from __future__ import unicode_literals, with_statement, print_function
+import base64
+import binascii
+import codecs
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+
+from django.conf import settings
+
+from penatesserver.filelocks import Lock
+from penatesserver.pki.constants import OCSPSIGNING
+from penatesserver.pki.service import CertificateEntry, get_mtime, serial_to_text
+
+__author__ = 'Matthieu Gallet'
+
+OCSP_KINDS = ('ca', 'users', 'hosts', 'services')
+# DER-encoded OCSPResponse without responseBytes
+MALFORMED_REQUEST = b'\x30\x03\x0a\x01\x01'
+UNAUTHORIZED = b'\x30\x03\x0a\x01\x06'
+PEM_RE = re.compile(r'-----BEGIN CERTIFICATE-----(.*?)-----END CERTIFICATE-----', re.S)
+
+
+def der_read(data, offset):
+    """Return the (tag, start of value, end of value) tuple of the DER element at the given offset of a bytearray
+
+    >>> der_read(bytearray(b'\\x30\\x03\\x0a\\x01\\x01'), 0)
+    (48, 2, 5)
+    """
+    tag = data[offset]
+    length = data[offset + 1]
+    offset += 2
+    if length & 0x80:
+        count = length & 0x7f
+        length = int(binascii.hexlify(bytes(data[offset:offset + count])), 16)
+        offset += count
+    if offset + length > len(data):
+        raise ValueError('Truncated DER element')
+    return tag, offset, offset + length
+
+
+def der_children(data, start, end):
+    """Iterate over the (tag, start of value, end of value) of the DER elements between start and end"""
+    while start < end:
+        element = der_read(data, start)
+        yield element
+        start = element[2]
+
+
+def pem_to_der(pem_content):
+    """Return the first certificate of a PEM file, DER-encoded"""
+    matcher = PEM_RE.search(pem_content)
+    if not matcher:
+        raise ValueError('No PEM certificate')
+    return base64.b64decode(''.join(matcher.group(1).split()))
+
+
+def get_public_key_hashes(certificate_der):
+    """Return the SHA-1 and SHA-256 hashes of the public key of a certificate (issuerKeyHash of the CertID of the
+    certificates it has issued)"""
+    data = bytearray(certificate_der)
+    __, start, end = der_read(data, 0)  # Certificate
+    __, start, end = der_read(data, start)  # tbsCertificate
+    children = list(der_children(data, start, end))
+    if children[0][0] == 0xa0:  # explicit version
+        children = children[1:]
+    __, start, end = children[5]  # subjectPublicKeyInfo
+    __, algorithm, bit_string = list(der_children(data, start, end))
+    # skip the "unused bits" byte of the BIT STRING
+    public_key = bytes(data[bit_string[1] + 1:bit_string[2]])
+    return hashlib.sha1(public_key).digest(), hashlib.sha256(public_key).digest()
+
+
+def parse_ocsp_request(request_der):
+    """Return the list of (issuerKeyHash, serial number) requested by a DER-encoded OCSP request
+
+    :raise ValueError: if the request is invalid
+    """
+    data = bytearray(request_der)
+    try:
+        __, start, end = der_read(data, 0)  # OCSPRequest
+        __, start, end = der_read(data, start)  # tbsRequest
+        request_list = [x for x in der_children(data, start, end) if x[0] == 0x30][0]
+        result = []
+        for __, request_start, request_end in der_children(data, request_list[1], request_list[2]):
+            __, cert_id_start, cert_id_end = der_read(data, request_start)  # CertID
+            algorithm, name_hash, key_hash, serial = list(der_children(data, cert_id_start, cert_id_end))
+            result.append((bytes(data[key_hash[1]:key_hash[2]]),
+                           int(binascii.hexlify(bytes(data[serial[1]:serial[2]])), 16)))
+    except (IndexError, ValueError, TypeError):
+        raise ValueError('Invalid OCSP request')
+    if not result:
+        raise ValueError('Empty OCSP request')
+    return result
+
+
+class OcspResponder(object):
+    validity_days = 1
+    max_certificates = 4  # max number of certificates in a single request (such requests are signed on the fly)
+    _issuers = {}  # _issuers[dirname] = (mtimes, {key hash: kind})
+    _statuses = {}  # _statuses[index path] = (mtime, {serial: status})
+
+    def __init__(self, pki):
+        """
+        :type pki: :class:`penatesserver.pki.service.PKI`
+        """
+        self.pki = pki
+        self.responses_dirname = os.path.join(pki.dirname, 'ocsp')
+
+    def get_ca_paths(self, kind):
+        if kind == 'ca':
+            return self.pki.cacrt_path, self.pki.cakey_path
+        return getattr(self.pki, '%s_crt_path' % kind), getattr(self.pki, '%s_key_path' % kind)
+
+    def get_issuers(self):
+        """Return a dict {issuerKeyHash: kind of CA}, rebuilt when a CA certificate is modified"""
+        mtimes = [get_mtime(self.get_ca_paths(kind)[0]) for kind in OCSP_KINDS]
+        cached = self._issuers.get(self.pki.dirname)
+        if cached is not None and cached[0] == mtimes:
+            return cached[1]
+        issuers = {}
+        for kind in OCSP_KINDS:
+            path = self.get_ca_paths(kind)[0]
+            if not os.path.isfile(path):
+                continue
+            with codecs.open(path, 'r', encoding='utf-8') as fd:
+                for key_hash in get_public_key_hashes(pem_to_der(fd.read())):
+                    issuers[key_hash] = kind
+        self._issuers[self.pki.dirname] = (mtimes, issuers)
+        return issuers
+
+    def get_status(self, serial):
+        """Return the status of a certificate in the CA database: 'V' (valid), 'R' (revoked), 'E' (expired),
+        or 'U' (unknown). The index is only read again when it is modified."""
+        mtime = get_mtime(self.pki.index_path)
+        cached = self._statuses.get(self.pki.index_path)
+        if cached is None or cached[0] != mtime:
+            statuses = {}
+            with codecs.open(self.pki.index_path, 'r', encoding='utf-8') as fd:
+                for line in fd:
+                    values = line.split('\t')
+                    if len(values) > 3:
+                        statuses[values[3]] = values[0]
+            cached = (mtime, statuses)
+            self._statuses[self.pki.index_path] = cached
+        return cached[1].get(serial_to_text(serial), 'U')
+
+    def get_signer_entry(self, kind):
+        """Return the entry of the OCSP signing certificate of the given CA"""
+        return CertificateEntry('%s-ocsp.%s' % (kind, settings.PENATES_DOMAIN),
+                                organizationName=settings.PENATES_ORGANIZATION,
+                                organizationalUnitName='OCSP', emailAddress=settings.PENATES_EMAIL_ADDRESS,
+                                localityName=settings.PENATES_LOCALITY, countryName=settings.PENATES_COUNTRY,
+                                stateOrProvinceName=settings.PENATES_STATE, altNames=[], role=OCSPSIGNING,
+                                dirname=self.pki.dirname)
+
+    def respond(self, request_der):
+        """Return the DER-encoded OCSP response to a DER-encoded OCSP request"""
+        try:
+            requested = parse_ocsp_request(request_der)
+        except ValueError:
+            return MALFORMED_REQUEST
+        issuers = self.get_issuers()
+        kinds = {issuers.get(key_hash) for (key_hash, serial) in requested}
+        if None in kinds or len(kinds) != 1:
+            return UNAUTHORIZED
+        kind = kinds.pop()
+        if len(requested) == 1:
+            return self.get_response(kind, requested[0][1])
+        # several certificates in a single request: cannot use pre-signed responses, so only small requests about
+        # known certificates are signed
+        if len(requested) > self.max_certificates or 'U' in {self.get_status(x[1]) for x in requested}:
+            return UNAUTHORIZED
+        return self.sign(kind, request_der)
+
+    def get_response(self, kind, serial):
+        """Return the pre-signed response for the given serial, signing it if required.
+        Serials that are unknown to the CA database are never signed (nor stored), so they cannot fill the disk."""
+        status = self.get_status(serial)
+        if status == 'U':
+            return UNAUTHORIZED
+        path = os.path.join(self.responses_dirname, '%s_%s_%s.der' % (kind, serial_to_text(serial), status))
+        mtime = get_mtime(path)
+        if mtime is None or mtime + self.validity_days * 43200 < time.time():
+            tmp_dirname = tempfile.mkdtemp()
+            try:
+                request_path = os.path.join(tmp_dirname, 'request.der')
+                subprocess.check_output([settings.OPENSSL_PATH, 'ocsp', '-issuer', self.get_ca_paths(kind)[0],
+                                         '-serial', '0x%s' % serial_to_text(serial), '-no_nonce', '-reqout',
+                                         request_path], stderr=subprocess.PIPE)
+                with open(request_path, 'rb') as fd:
+                    content = self.sign(kind, fd.read())
+            finally:
+                shutil.rmtree(tmp_dirname)
+            if not os.path.isdir(self.responses_dirname):
+                os.makedirs(self.responses_dirname)
+            with open(path + '.tmp', 'wb') as fd:
+                fd.write(content)
+            os.rename(path + '.tmp', path)
+            return content
+        with open(path, 'rb') as fd:
+            return fd.read()
+
+    def sign(self, kind, request_der):
+        """Let openssl answer the given request"""
+        signer = self.get_signer_entry(kind)
+        self.pki.ensure_certificate(signer)
+        ca_crt_path = self.get_ca_paths(kind)[0]
+        tmp_dirname = tempfile.mkdtemp()
+        try:
+            request_path = os.path.join(tmp_dirname, 'request.der')
+            response_path = os.path.join(tmp_dirname, 'response.der')
+            with open(request_path, 'wb') as fd:
+                fd.write(request_der)
+            with Lock(settings.PENATES_LOCKFILE):
+                subprocess.check_output([settings.OPENSSL_PATH, 'ocsp', '-index', self.pki.index_path,
+                                         '-CA', ca_crt_path, '-rsigner', signer.crt_filename, '-rkey',
+                                         signer.key_filename, '-reqin', request_path, '-respout', response_path,
+                                         '-ndays', str(self.validity_days)], stderr=subprocess.PIPE)
+            with open(response_path, 'rb') as fd:
+                return fd.read()
+        finally:
+            shutil.rmtree(tmp_dirname)
+
+    def get_kind(self, entry):
+        """Return the kind of the CA that issues the certificate of the given entry"""
+        ca_crt_path = self.pki.get_subca_infos(entry)[0]
+        return [x for x in OCSP_KINDS if self.get_ca_paths(x)[0] == ca_crt_path][0]
+
+    def get_stapling_response(self, entry):
+        """Return the OCSP response of the current certificate of the given entry (for OCSP stapling)"""
+        with codecs.open(entry.crt_filename, 'r', encoding='utf-8') as fd:
+            certificate = bytearray(pem_to_der(fd.read()))
+        __, start, end = der_read(certificate, 0)  # Certificate
+        __, start, end = der_read(certificate, start)  # tbsCertificate
+        children = list(der_children(certificate, start, end))
+        if children[0][0] == 0xa0:
+            children = children[1:]
+        serial = int(binascii.hexlify(bytes(certificate[children[0][1]:children[0][2]])), 16)
+        return self.get_response(self.get_kind(entry), serial)
+
+    def presign(self):
+        """Sign again the responses of all valid certificates that are about to expire (e.g. from a cron job)
+
+        :return: the number of checked responses
+        """
+        count = 0
+        for end_date, serial, entry in self.pki.get_expiry_index():
+            self.get_response(self.get_kind(entry), int(serial, 16))
+            count += 1
+        return count
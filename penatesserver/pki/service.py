@@ -7,7 +7,9 @@ my_ca.gen_ca(CertificateEntry("ca.19pouces.net", role=CA))
 from __future__ import unicode_literals, with_statement, print_function
 import base64
 import codecs
+from collections import OrderedDict
 import hashlib
+import json
 import os
 import datetime
 import re
@@ -16,24 +18,44 @@ import shutil
 from subprocess import CalledProcessError
 import subprocess
 import tempfile
+import threading
 
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.template.loader import render_to_string
 from django.utils.text import slugify
 from django.utils.timezone import utc
+from django.utils import six
 from penatesserver.filelocks import Lock
 
 from penatesserver.pki.constants import ROLES, RSA, RESOURCE, USER, ENCIPHERMENT, SIGNATURE, EMAIL, COMPUTER_TEST,\
-    COMPUTER, CA
+    COMPUTER, CA, OCSPSIGNING, CRL_REASONS
 from penatesserver.utils import t61_to_time, ensure_location
 
 
+def get_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def serial_to_text(serial):
+    """Format a serial number like in the openssl index
+
+    >>> serial_to_text(10) == '0A'
+    True
+    """
+    value = '%X' % serial
+    return '0' + value if len(value) % 2 else value
+
+
 def local(command, cwd=None):
     return subprocess.check_output(shlex.split(command), shell=False, cwd=cwd, stderr=subprocess.PIPE)
 
 
 __author__ = 'Matthieu Gallet'
+fingerprints_cache = {}  # fingerprints_cache[fingerprints filename] = (mtime, fingerprints)
 
 
 class CertificateEntry(object):
@@ -57,6 +79,25 @@ class CertificateEntry(object):
         basename = '%s_%s' % (self.role, self.commonName)
         return slugify(basename)
 
+    def to_dict(self):
+        return {'commonName': self.commonName, 'organizationName': self.organizationName,
+                'organizationalUnitName': self.organizationalUnitName, 'emailAddress': self.emailAddress,
+                'localityName': self.localityName, 'countryName': self.countryName,
+                'stateOrProvinceName': self.stateOrProvinceName, 'altNames': [list(x) for x in self.altNames],
+                'role': self.role, }
+
+    @classmethod
+    def from_dict(cls, values, dirname=None):
+        values = dict(values)
+        values['altNames'] = [tuple(x) for x in values.get('altNames', [])]
+        return cls(dirname=dirname, **values)
+
+    @property
+    def entry_filename(self):
+        """JSON description of the entry, written at issuance (required to renew the certificate without the
+        object that created it)"""
+        return os.path.join(self.dirname, 'entries', self.filename + '.json')
+
     @property
     def values(self):
         return ROLES[self.role]
@@ -75,19 +116,11 @@ class CertificateEntry(object):
 
     @property
     def sshfp_sha1(self):
-        with codecs.open(self.ssh_filename, 'r', encoding='utf-8') as fd:
-            method, content = fd.read().split(' ')
-        value = hashlib.sha1(base64.b64decode(content)).hexdigest()
-        code = {'ssh-rsa': 1, 'ssh-dss': 2, 'ecdsa-sha2-nistp256': 3, 'ssh-ed25519': 4, }.get(method, 0)
-        return '%s 1 %s' % (code, value)
+        return self.get_fingerprint('sshfp_sha1')
 
     @property
     def sshfp_sha256(self):
-        with codecs.open(self.ssh_filename, 'r', encoding='utf-8') as fd:
-            method, content = fd.read().split(' ')
-        value = hashlib.sha256(base64.b64decode(content)).hexdigest()
-        code = {'ssh-rsa': 1, 'ssh-dss': 2, 'ecdsa-sha2-nistp256': 3, 'ssh-ed25519': 4, }.get(method, 0)
-        return '%s 2 %s' % (code, value)
+        return self.get_fingerprint('sshfp_sha256')
 
     @property
     def crt_filename(self):
@@ -103,29 +136,89 @@ class CertificateEntry(object):
 
     @property
     def crt_sha256(self):
-        return self.pem_hash(self.crt_filename, hashlib.sha256)
+        return self.get_fingerprint('crt_sha256')
 
     @property
     def pub_sha256(self):
-        return self.pem_hash(self.pub_filename, hashlib.sha256)
+        return self.get_fingerprint('pub_sha256')
 
     @property
     def crt_sha512(self):
-        return self.pem_hash(self.crt_filename, hashlib.sha512)
+        return self.get_fingerprint('crt_sha512')
 
     @property
     def pub_sha512(self):
-        return self.pem_hash(self.pub_filename, hashlib.sha512)
+        return self.get_fingerprint('pub_sha512')
 
     @staticmethod
-    def pem_hash(filename, hash_cls=None):
-        if hash_cls is None:
-            hash_cls = hashlib.sha256
+    def pem_der(filename):
         with codecs.open(filename, 'r', encoding='utf-8') as fd:
             content = fd.read()
         b64_der = ''.join(content.splitlines()[1:-1])
-        der = base64.b64decode(b64_der)
-        return hash_cls(der).hexdigest()
+        return base64.b64decode(b64_der)
+
+    @staticmethod
+    def pem_hash(filename, hash_cls=None):
+        if hash_cls is None:
+            hash_cls = hashlib.sha256
+        return hash_cls(CertificateEntry.pem_der(filename)).hexdigest()
+
+    @property
+    def fingerprints_filename(self):
+        """Fingerprints of the certificate and of the keys (TLSA and SSHFP values), written at issuance"""
+        return os.path.join(self.dirname, 'entries', self.filename + '.fingerprints.json')
+
+    def get_source_mtimes(self):
+        return [get_mtime(x) for x in (self.crt_filename, self.pub_filename, self.ssh_filename)]
+
+    def compute_fingerprints(self):
+        """Read the certificate and the public keys (each file is read only once) and return all their fingerprints"""
+        result = {'mtimes': self.get_source_mtimes()}
+        for prefix, filename in (('crt', self.crt_filename), ('pub', self.pub_filename)):
+            if os.path.isfile(filename):
+                der = self.pem_der(filename)
+                result[prefix + '_sha256'] = hashlib.sha256(der).hexdigest()
+                result[prefix + '_sha512'] = hashlib.sha512(der).hexdigest()
+        if os.path.isfile(self.ssh_filename):
+            with codecs.open(self.ssh_filename, 'r', encoding='utf-8') as fd:
+                method, content = fd.read().split(' ')
+            content = base64.b64decode(content)
+            code = {'ssh-rsa': 1, 'ssh-dss': 2, 'ecdsa-sha2-nistp256': 3, 'ssh-ed25519': 4, }.get(method, 0)
+            result['sshfp_sha1'] = '%s 1 %s' % (code, hashlib.sha1(content).hexdigest())
+            result['sshfp_sha256'] = '%s 2 %s' % (code, hashlib.sha256(content).hexdigest())
+        return result
+
+    def write_fingerprints(self):
+        fingerprints = self.compute_fingerprints()
+        ensure_location(self.fingerprints_filename)
+        with codecs.open(self.fingerprints_filename, 'w', encoding='utf-8') as fd:
+            json.dump(fingerprints, fd)
+        fingerprints_cache[self.fingerprints_filename] = (get_mtime(self.fingerprints_filename), fingerprints)
+        return fingerprints
+
+    @property
+    def fingerprints(self):
+        """Fingerprints of the certificate and of the keys, cached in memory until the fingerprints file is modified.
+        They are computed again only if the certificate or the keys are modified."""
+        mtime = get_mtime(self.fingerprints_filename)
+        cached = fingerprints_cache.get(self.fingerprints_filename)
+        if mtime is None:
+            fingerprints = None
+        elif cached is not None and cached[0] == mtime:
+            fingerprints = cached[1]
+        else:
+            with codecs.open(self.fingerprints_filename, 'r', encoding='utf-8') as fd:
+                fingerprints = json.load(fd)
+            fingerprints_cache[self.fingerprints_filename] = (mtime, fingerprints)
+        if fingerprints is None or fingerprints['mtimes'] != self.get_source_mtimes():
+            fingerprints = self.write_fingerprints()
+        return fingerprints
+
+    def get_fingerprint(self, name):
+        fingerprints = self.fingerprints
+        if name not in fingerprints:
+            raise IOError('%s: missing file for %s' % (self.commonName, name))
+        return fingerprints[name]
 
     def __repr__(self):
         return self.commonName
@@ -137,10 +230,64 @@ class CertificateEntry(object):
         return self.commonName
 
 
+class Pkcs12Cache(object):
+    """In-memory LRU cache of PKCS#12 bundles, indexed by (entry, certificate fingerprint, password hash).
+    A reissued certificate has a new fingerprint, so its old bundles are never returned.
+    """
+    max_size = 256
+
+    def __init__(self):
+        self.values = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_key(entry, fingerprint, password):
+        return entry.dirname, entry.filename, fingerprint, hashlib.sha256(password.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            value = self.values.pop(key, None)
+            if value is not None:
+                self.values[key] = value
+        return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.values.pop(key, None)
+            self.values[key] = value
+            while len(self.values) > self.max_size:
+                self.values.popitem(last=False)
+
+    def invalidate(self, dirname, filename):
+        """Remove all bundles of the given entry (after a reissue or a revocation)"""
+        with self.lock:
+            for key in [x for x in self.values if x[0:2] == (dirname, filename)]:
+                del self.values[key]
+
+
+pkcs12_cache = Pkcs12Cache()
+
+
+class CachedCrl(object):
+    def __init__(self, content, mtime, next_update):
+        self.content = content
+        self.mtime = mtime
+        self.next_update = next_update or datetime.datetime.now(utc)
+        self.etag = hashlib.sha1(content).hexdigest()
+        self.last_modified = datetime.datetime.fromtimestamp(mtime, utc)
+
+
+crl_cache = {}  # crl_cache[path] = CachedCrl
+
+
 class PKI(object):
     def __init__(self, dirname=None):
         self.dirname = dirname or settings.PKI_PATH
         self.cacrl_path = os.path.join(self.dirname, 'cacrl.pem')
+        self.delta_crl_path = os.path.join(self.dirname, 'deltacrl.pem')
+        self.crl_base_path = os.path.join(self.dirname, 'cacrl.base')  # number and date of the last full CRL
+        self.crlnumber_path = os.path.join(self.dirname, 'crlnumber.txt')
+        self.index_path = os.path.join(self.dirname, 'index.txt')
         self.careq_path = os.path.join(self.dirname, 'private', 'careq.pem')
         self.crt_sources_path = os.path.join(self.dirname, 'crt_sources.txt')
         self.cacrt_path = os.path.join(self.dirname, 'cacert.pem')
@@ -160,6 +307,13 @@ class PKI(object):
             return self.hosts_crt_path, self.hosts_key_path
         elif entry.role == CA:
             return self.cacrt_path, self.cakey_path
+        elif entry.role == OCSPSIGNING:
+            # each CA has its own OCSP responder, named "<kind>-ocsp.<domain>"
+            kind = entry.commonName.partition('-ocsp.')[0]
+            if kind == 'ca':
+                return self.cacrt_path, self.cakey_path
+            elif kind in ('users', 'hosts', 'services'):
+                return getattr(self, '%s_crt_path' % kind), getattr(self, '%s_key_path' % kind)
         return self.services_crt_path, self.services_key_path
 
     def initialize(self):
@@ -173,6 +327,9 @@ class PKI(object):
             if not os.path.isfile(index):
                 with codecs.open(index, 'w', encoding='utf-8') as fd:
                     fd.write("")
+            if not os.path.isfile(self.crlnumber_path):
+                with codecs.open(self.crlnumber_path, 'w', encoding='utf-8') as fd:
+                    fd.write("01\n")
             ensure_location(os.path.join(self.dirname, 'new_certs', '0'))
 
     def ensure_key(self, entry):
@@ -209,7 +366,46 @@ class PKI(object):
                 self.__gen_request(entry)
                 self.__gen_certificate(entry)
 
-    def __gen_openssl_conf(self, entry=None, ca_infos=None):
+    def renew_certificate(self, entry):
+        """Issue a new certificate for the given entry (with the same key), even if the current one is still valid
+
+        :type entry: :class:`penatesserver.pki.service.CertificateEntry`
+        :return: the serial of the new certificate
+        """
+        self.ensure_key(entry)
+        with Lock(settings.PENATES_LOCKFILE):
+            self.__gen_request(entry)
+            self.__gen_certificate(entry)
+        return self.__get_certificate_serial(entry.crt_filename)
+
+    def get_expiry_index(self):
+        """Return the current valid certificates, sorted by expiration date, as a list of
+        (end date, serial, entry) tuples. Only the last certificate of each entry is returned, and only entries
+        with a known description (see :attr:`CertificateEntry.entry_filename`).
+        """
+        last_certificates = {}  # last_certificates[crt filename] = (serial, infos)
+        for serial, infos in self.__get_index_file().items():
+            if infos[1] != 'V' or not infos[7]:
+                continue
+            crt_filename = infos[7].strip()
+            previous = last_certificates.get(crt_filename)
+            if previous is None or int(previous[0], 16) < int(serial, 16):
+                last_certificates[crt_filename] = (serial, infos)
+        result = []
+        for crt_filename, (serial, infos) in last_certificates.items():
+            filename = os.path.basename(crt_filename)[:-len('.crt.pem')]
+            entry_filename = os.path.join(self.dirname, 'entries', filename + '.json')
+            if not os.path.isfile(entry_filename):
+                continue
+            with codecs.open(entry_filename, 'r', encoding='utf-8') as fd:
+                entry = CertificateEntry.from_dict(json.load(fd), dirname=self.dirname)
+            date_format = '%y%m%d%H%M%SZ' if len(infos[2]) == 13 else '%Y%m%d%H%M%SZ'
+            end_date = datetime.datetime.strptime(infos[2], date_format).replace(tzinfo=utc)
+            result.append((end_date, serial, entry))
+        result.sort(key=lambda x: (x[0], x[1]))
+        return result
+
+    def __gen_openssl_conf(self, entry=None, ca_infos=None, database_path=None, delta_crl_number=None):
         """
         principal: used to define values
         ca: used to define issuer values for settings.CA_POINT, settings.CRL_POINT, settings.OCSP_POINT
@@ -226,7 +422,8 @@ class PKI(object):
             ca_crt_path, ca_key_path = ca_infos
         context = {'dirname': self.dirname, 'policy_details': [], 'crlPoint': '', 'caPoint': '', 'altSection': '',
                    'altNamesString': '', 'krbRealm': '', 'krbClientName': '', 'ca_key_path': ca_key_path,
-                   'ca_crt_path': ca_crt_path, }  # contain all template values
+                   'ca_crt_path': ca_crt_path, 'database': database_path or '$dir/index.txt',
+                   'deltaCrl': delta_crl_number, 'deltaCrlPoint': '', 'ocspPoint': '', }  # contain all template values
         if entry is not None:
             assert isinstance(entry, CertificateEntry)
             role = ROLES[entry.role]
@@ -251,9 +448,12 @@ class PKI(object):
                 context['altSection'] = "subjectAltName=@alt_section"
                 if settings.SERVER_NAME:
                     context['crlPoint'] = '%s://%s%s' % (settings.PROTOCOL, settings.SERVER_NAME, reverse('get_crl'))
+                    context['deltaCrlPoint'] = '%s://%s%s' % (settings.PROTOCOL, settings.SERVER_NAME,
+                                                              reverse('get_delta_crl'))
                     context['caPoint'] = '%s://%s%s' % (settings.PROTOCOL, settings.SERVER_NAME,
                                                         reverse('get_ca_certificate', kwargs={'kind': 'ca'}))
-                    # context['ocspPoint'] = config.ocsp_url
+                    context['ocspPoint'] = '%s://%s%s' % (settings.PROTOCOL, settings.SERVER_NAME,
+                                                          reverse('ocsp_responder'))
                     # build a file structure which is compatible with ``openssl ca'' commands
         # noinspection PyUnresolvedReferences
         conf_content = render_to_string('penatesserver/pki/openssl.cnf', context)
@@ -343,6 +543,11 @@ class PKI(object):
                '-notext -days {days} -md {digest} -batch -utf8 ').format(openssl=settings.OPENSSL_PATH, cfg=conf_path,
                                                                          req=entry.req_filename, crt=entry.crt_filename,
                                                                          days=role['days'], digest=role['digest']))
+        pkcs12_cache.invalidate(entry.dirname, entry.filename)
+        ensure_location(entry.entry_filename)
+        with codecs.open(entry.entry_filename, 'w', encoding='utf-8') as fd:
+            json.dump(entry.to_dict(), fd)
+        entry.write_fingerprints()
         serial = self.__get_certificate_serial(entry.crt_filename)
         with codecs.open(self.crt_sources_path, 'a', encoding='utf-8') as fd:
             fd.write('%s\t%s\t%s\t%s\n' % (serial, os.path.relpath(entry.key_filename, self.dirname),
@@ -500,13 +705,10 @@ class PKI(object):
             # logging.warning(_('Certificate %(path)s of %(cn)s not found') % {'cn': common_name, 'path': path})
             return False
         try:
-            stdout = local('"{openssl}" x509 -enddate -noout -in "{path}"'.format(openssl=settings.OPENSSL_PATH,
-                                                                                  path=path))
+            end_date = self.__get_certificate_end_date(path)
         except CalledProcessError:
             # logging.warning(_('Invalid certificate %(path)s for %(cn)s') % {'cn': common_name, 'path': path})
             return False
-        stdout = stdout.decode('utf-8')
-        end_date = t61_to_time(stdout.partition('=')[2].strip())
         after_now = datetime.datetime.now(tz=utc) + datetime.timedelta(30)
         if end_date is None or end_date < after_now:
             # logging.warning(_('Certificate %(path)s for %(cn)s is about to expire') %
@@ -519,34 +721,82 @@ class PKI(object):
             return False
         return True
 
-    def revoke_certificate(self, crt_content, regen_crl=True):
+    @staticmethod
+    def __get_certificate_end_date(path):
+        stdout = local('"{openssl}" x509 -enddate -noout -in "{path}"'.format(openssl=settings.OPENSSL_PATH,
+                                                                              path=path))
+        return t61_to_time(stdout.decode('utf-8').partition('=')[2].strip())
+
+    def revoke_certificate(self, crt_content, regen_crl=True, reason=None):
+        with tempfile.NamedTemporaryFile() as fd:
+            fd.write(crt_content.encode('utf-8'))
+            fd.flush()
+            serial = self.__get_certificate_serial(fd.name)
+        self.revoke_certificates([serial], reason=reason, regen_crl=regen_crl)
+
+    def revoke_certificates(self, serials_or_entries, reason=None, regen_crl=True):
+        """Revoke several certificates at once: the CA database is written once, and the CRL is regenerated once.
+
+        :param serials_or_entries: serials (as hexadecimal strings or integers) or
+            :class:`penatesserver.pki.service.CertificateEntry` (all their valid certificates are revoked)
+        :param reason: one of the values of :data:`penatesserver.pki.constants.CRL_REASONS` (or `None`)
+        :return: the list of revoked serials
+        """
+        if reason is not None and reason not in {x[0] for x in CRL_REASONS}:
+            raise ValueError('Invalid CRL reason: %s' % reason)
         with Lock(settings.PENATES_LOCKFILE):
-            with tempfile.NamedTemporaryFile() as fd:
-                fd.write(crt_content.encode('utf-8'))
-                fd.flush()
-                serial = self.__get_certificate_serial(fd.name)
-                infos = self.__get_index_file()[serial]
-                if infos[1] != 'V':
-                    return
-                conf_path = self.__gen_openssl_conf()
-                local('"{openssl}" ca -config "{cfg}" -revoke {filename}'.format(openssl=settings.OPENSSL_PATH,
-                                                                                 cfg=conf_path, filename=fd.name))
-        key_filename = os.path.join(self.dirname, infos[5])
-        if os.path.isfile(key_filename):
-            with open(key_filename, 'rb') as fd:
-                content = fd.read()
-            os.remove(key_filename)
-            with open(key_filename + '.bak', 'ab') as fd:
-                fd.write(content)
-        req_filename = os.path.join(self.dirname, infos[6])
-        if os.path.isfile(req_filename):
-            os.remove(req_filename)
-        crt_filename = os.path.join(self.dirname, infos[7])
-        if os.path.isfile(crt_filename):
-            os.remove(crt_filename)
-        if regen_crl:
-            with Lock(settings.PENATES_LOCKFILE):
+            index = self.__get_index_file()
+            revoked = self.get_valid_serials(serials_or_entries, index=index)
+            if not revoked:
+                return revoked
+            revoked_set = set(revoked)
+            revoke_date = datetime.datetime.now(utc).strftime('%y%m%d%H%M%SZ')
+            if reason is not None:
+                revoke_date += ',' + reason
+            with codecs.open(self.index_path, 'r', encoding='utf-8') as fd:
+                lines = fd.read().splitlines(True)
+            shutil.copy(self.index_path, self.index_path + '.old')
+            with codecs.open(self.index_path + '.tmp', 'w', encoding='utf-8') as fd:
+                for line in lines:
+                    values = line.split('\t')
+                    if len(values) > 3 and values[3] in revoked_set and values[0] == 'V':
+                        values[0], values[2] = 'R', revoke_date
+                    fd.write('\t'.join(values))
+            os.rename(self.index_path + '.tmp', self.index_path)
+            for serial in revoked:
+                infos = index[serial]
+                if infos[5]:
+                    key_filename = os.path.join(self.dirname, infos[5])
+                    if os.path.isfile(key_filename):
+                        with open(key_filename, 'rb') as fd:
+                            content = fd.read()
+                        os.remove(key_filename)
+                        with open(key_filename + '.bak', 'ab') as fd:
+                            fd.write(content)
+                for filename in infos[6:8]:
+                    if filename and os.path.isfile(os.path.join(self.dirname, filename.strip())):
+                        os.remove(os.path.join(self.dirname, filename.strip()))
+                if infos[7]:
+                    pkcs12_cache.invalidate(self.dirname, os.path.basename(infos[7].strip())[:-len('.crt.pem')])
+            if regen_crl:
                 self.__gen_crl(20)
+        return revoked
+
+    def get_valid_serials(self, serials_or_entries, index=None):
+        """Return the serials of the valid certificates among the given serials (as hexadecimal strings or integers)
+        or :class:`penatesserver.pki.service.CertificateEntry` (all their valid certificates)"""
+        serials, crt_filenames = set(), set()
+        for value in serials_or_entries:
+            if isinstance(value, CertificateEntry):
+                crt_filenames.add(os.path.relpath(value.crt_filename, self.dirname))
+            elif isinstance(value, six.integer_types):
+                serials.add(serial_to_text(value))
+            else:
+                serials.add(value.upper())
+        if index is None:
+            index = self.__get_index_file()
+        return [serial for (serial, infos) in index.items()
+                if infos[1] == 'V' and (serial in serials or (infos[7] and infos[7].strip() in crt_filenames))]
 
     @staticmethod
     def __get_certificate_serial(filename):
@@ -562,24 +812,104 @@ class PKI(object):
             with Lock(settings.PENATES_LOCKFILE):
                 self.__gen_crl(20)
 
-    def __check_crl(self):
+    def ensure_delta_crl(self):
+        """Regenerate the delta CRL if the CA database has been modified since, or if it is about to expire"""
+        if not os.path.isfile(self.crl_base_path):
+            with Lock(settings.PENATES_LOCKFILE):
+                self.__gen_crl(20)
+        else:
+            self.ensure_crl()
+        if not os.path.isfile(self.delta_crl_path) or \
+                get_mtime(self.delta_crl_path) < get_mtime(self.index_path) or \
+                get_mtime(self.delta_crl_path) < get_mtime(self.cacrl_path) or \
+                not self.__check_crl(self.delta_crl_path, datetime.timedelta(seconds=3600)):
+            with Lock(settings.PENATES_LOCKFILE):
+                self.__gen_delta_crl()
+
+    def get_crl(self, delta=False):
+        """Return the content of the (delta) CRL, regenerated if required, with its ETag and its modification date.
+        The content is kept in memory and only checked again with openssl when it is about to expire.
+
+        :rtype: :class:`penatesserver.pki.service.CachedCrl`
+        """
+        path = self.delta_crl_path if delta else self.cacrl_path
+        cached = crl_cache.get(path)
+        min_next_update = datetime.datetime.now(utc) + datetime.timedelta(seconds=3600 if delta else 86400)
+        if cached is not None and cached.next_update > min_next_update and cached.mtime == get_mtime(path) \
+                and (not delta or cached.mtime >= get_mtime(self.index_path)):
+            return cached
+        if delta:
+            self.ensure_delta_crl()
+        else:
+            self.ensure_crl()
+        with Lock(settings.PENATES_LOCKFILE):
+            with open(path, 'rb') as fd:
+                content = fd.read()
+            mtime = os.path.getmtime(path)
+        cached = CachedCrl(content, mtime, self.__get_crl_next_update(path))
+        crl_cache[path] = cached
+        return cached
+
+    @staticmethod
+    def __get_crl_next_update(path):
         try:
-            content = subprocess.check_output([settings.OPENSSL_PATH, 'crl', '-noout', '-nextupdate', '-in',
-                                               self.cacrl_path], stderr=subprocess.PIPE)
+            content = subprocess.check_output([settings.OPENSSL_PATH, 'crl', '-noout', '-nextupdate', '-in', path],
+                                              stderr=subprocess.PIPE)
         except CalledProcessError:
-            return False
+            return None
         key, sep, value = content.decode('utf-8').partition('=')
         if key != 'nextUpdate' or sep != '=':
+            return None
+        return t61_to_time(value.strip())
+
+    def __check_crl(self, path=None, margin=None):
+        next_update = self.__get_crl_next_update(path or self.cacrl_path)
+        if next_update is None:
             return False
-        return t61_to_time(value.strip()) > (datetime.datetime.now(utc) + datetime.timedelta(seconds=86400))
+        return next_update > (datetime.datetime.now(utc) + (margin or datetime.timedelta(seconds=86400)))
 
     def __gen_crl(self, crldays):
         config = self.__gen_openssl_conf()
+        if not os.path.isfile(self.crlnumber_path):
+            with codecs.open(self.crlnumber_path, 'w', encoding='utf-8') as fd:
+                fd.write("01\n")
+        with codecs.open(self.crlnumber_path, 'r', encoding='utf-8') as fd:
+            crl_number = fd.read().strip()
+        generation_date = datetime.datetime.now(utc).strftime('%y%m%d%H%M%SZ')
         content = subprocess.check_output([settings.OPENSSL_PATH, 'ca', '-gencrl', '-utf8', '-config', config,
                                            '-keyfile', self.cakey_path, '-cert', self.cacrt_path, '-crldays',
                                            str(crldays)], stderr=subprocess.PIPE)
         with open(self.cacrl_path, 'wb') as fd:
             fd.write(content)
+        with codecs.open(self.crl_base_path, 'w', encoding='utf-8') as fd:
+            fd.write('%s\t%s\n' % (crl_number, generation_date))
+
+    def __gen_delta_crl(self):
+        """Generate a delta CRL (RFC 5280, with a deltaCRLIndicator extension) only containing the certificates
+        revoked since the last full CRL. openssl has no native support for delta CRLs, so it is run on a temporary
+        copy of the CA database that only contains these revocations."""
+        with codecs.open(self.crl_base_path, 'r', encoding='utf-8') as fd:
+            base_number, sep, base_date = fd.read().strip().partition('\t')
+        tmp_dirname = tempfile.mkdtemp()
+        try:
+            database_path = os.path.join(tmp_dirname, 'index.txt')
+            with codecs.open(self.index_path, 'r', encoding='utf-8') as in_fd:
+                with codecs.open(database_path, 'w', encoding='utf-8') as out_fd:
+                    for line in in_fd:
+                        values = line.split('\t')
+                        # revocation date may be followed by the reason: "YYMMDDHHMMSSZ,reason"
+                        if len(values) > 2 and values[0] == 'R' and values[2].partition(',')[0] >= base_date:
+                            out_fd.write(line)
+            with codecs.open(database_path + '.attr', 'w', encoding='utf-8') as fd:
+                fd.write('unique_subject = no\n')
+            config = self.__gen_openssl_conf(database_path=database_path, delta_crl_number=int(base_number, 16))
+            content = subprocess.check_output([settings.OPENSSL_PATH, 'ca', '-gencrl', '-utf8', '-config', config,
+                                               '-keyfile', self.cakey_path, '-cert', self.cacrt_path, '-crldays', '1'],
+                                              stderr=subprocess.PIPE)
+        finally:
+            shutil.rmtree(tmp_dirname)
+        with open(self.delta_crl_path, 'wb') as fd:
+            fd.write(content)
 
     def __get_index_file(self):
         """Return a dict ["serial"] = ["serial", "V|R", "valid_date", "revoke_date", "cn", "key filename",
@@ -606,12 +936,29 @@ class PKI(object):
         return result
 
     def gen_pkcs12(self, entry, filename, password):
+        content = self.get_pkcs12(entry, password)
+        with open(filename, 'wb') as fd:
+            fd.write(content)
+
+    def get_pkcs12(self, entry, password):
+        """Return the PKCS#12 bundle (certificate, key and CA certificate) of the given entry, encrypted with
+        the given password. The certificate is created or renewed when required. Bundles are cached, so a valid
+        bundle is returned without running openssl.
+
+        :rtype: :class:`bytes`
+        """
         assert isinstance(entry, CertificateEntry)
+        if os.path.isfile(entry.crt_filename):
+            cached = pkcs12_cache.get(pkcs12_cache.get_key(entry, entry.crt_sha256, password))
+            if cached is not None and cached[1] > datetime.datetime.now(tz=utc) + datetime.timedelta(30):
+                return cached[0]
         self.ensure_certificate(entry)
-        with tempfile.NamedTemporaryFile() as fd:
-            fd.write(password.encode('utf-8'))
-            fd.flush()
-            p = subprocess.Popen([settings.OPENSSL_PATH, 'pkcs12', '-export', '-out', filename, '-passout',
-                                  'file:%s' % fd.name, '-aes256', '-in', entry.crt_filename, '-inkey',
-                                  entry.key_filename, '-certfile', self.cacrt_path, '-name', entry.filename, ])
-            p.communicate()
+        cmd = [settings.OPENSSL_PATH, 'pkcs12', '-export', '-passout', 'stdin', '-aes256', '-in', entry.crt_filename,
+               '-inkey', entry.key_filename, '-certfile', self.cacrt_path, '-name', entry.filename, ]
+        p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        content, stderr = p.communicate((password + '\n').encode('utf-8'))
+        if p.returncode != 0:
+            raise CalledProcessError(p.returncode, cmd, stderr)
+        end_date = self.__get_certificate_end_date(entry.crt_filename)
+        pkcs12_cache.set(pkcs12_cache.get_key(entry, entry.crt_sha256, password), (content, end_date))
+        return content
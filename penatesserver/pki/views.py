@@ -1,17 +1,20 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals, with_statement, print_function
+import base64
 
 from django.conf import settings
 from django.core.exceptions import PermissionDenied
 from django.http import HttpResponse
-from django.shortcuts import get_object_or_404
 from django.utils.translation import ugettext as _
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition
 
 from penatesserver.models import User, Service
 from penatesserver.pki.constants import SERVICE_1024, PRINTER, KERBEROS_DC, SERVICE, TIME_SERVER
+from penatesserver.pki.ocsp import OcspResponder
 from penatesserver.pki.service import PKI, CertificateEntry
 from penatesserver.powerdns.models import Domain
-from penatesserver.utils import hostname_from_principal
+from penatesserver.utils import hostname_from_principal, BackgroundCall
 from penatesserver.views import entry_from_hostname, admin_entry_from_hostname
 
 __author__ = 'Matthieu Gallet'
@@ -51,6 +54,13 @@ def get_admin_certificate(request):
     return CertificateEntryResponse(entry)
 
 
+def service_entry(hostname, role):
+    return CertificateEntry(hostname, organizationName=settings.PENATES_ORGANIZATION,
+                            organizationalUnitName=_('Services'), emailAddress=settings.PENATES_EMAIL_ADDRESS,
+                            localityName=settings.PENATES_LOCALITY, countryName=settings.PENATES_COUNTRY,
+                            stateOrProvinceName=settings.PENATES_STATE, altNames=[], role=role)
+
+
 def get_service_certificate(request, scheme, hostname, port):
     fqdn = hostname_from_principal(request.user.username)
     role = request.GET.get('role', SERVICE)
@@ -61,25 +71,73 @@ def get_service_certificate(request, scheme, hostname, port):
         return HttpResponse(status=404, content='%s://%s:%s/ unknown' % (scheme, hostname, port))
     if role not in (SERVICE, KERBEROS_DC, PRINTER, TIME_SERVER, SERVICE_1024):
         return HttpResponse(status=401, content='Role %s is not allowed' % role)
-    entry = CertificateEntry(hostname, organizationName=settings.PENATES_ORGANIZATION,
-                             organizationalUnitName=_('Services'), emailAddress=settings.PENATES_EMAIL_ADDRESS,
-                             localityName=settings.PENATES_LOCALITY, countryName=settings.PENATES_COUNTRY,
-                             stateOrProvinceName=settings.PENATES_STATE, altNames=[], role=role)
-    pki = PKI()
-    pki.ensure_certificate(entry)
+    entry = service_entry(hostname, role)
+    certificate_call = BackgroundCall(PKI().ensure_certificate, entry)
     record_name, sep, domain_name = hostname.partition('.')
     domain = Domain.objects.get(name=domain_name)
+    certificate_call.join()
     domain.set_certificate_records(entry, protocol, hostname, port)
-    return CertificateEntryResponse(entry)
+    return CertificateEntryResponse(entry, ensure_entry=False)
+
+
+# noinspection PyUnusedLocal
+def crl_etag(request, delta=False):
+    return PKI().get_crl(delta=delta).etag
+
 
+# noinspection PyUnusedLocal
+def crl_last_modified(request, delta=False):
+    return PKI().get_crl(delta=delta).last_modified
+
+
+@condition(etag_func=crl_etag, last_modified_func=crl_last_modified)
+def get_crl(request, delta=False):
+    """Return the full CRL, or the delta CRL (only the revocations since the last full CRL)"""
+    return HttpResponse(PKI().get_crl(delta=delta).content, content_type='text/plain')
+
+
+class OcspResponse(HttpResponse):
+    def __init__(self, content, **kwargs):
+        super(OcspResponse, self).__init__(content=content, content_type='application/ocsp-response', **kwargs)
+        self['Cache-Control'] = 'max-age=%d, public, no-transform, must-revalidate' % \
+            (OcspResponder.validity_days * 43200)
+
+
+@csrf_exempt
+def ocsp_responder(request, encoded_request=None):
+    """OCSP responder: DER-encoded request in the body (POST) or base64-encoded in the URL (GET)"""
+    if request.method == 'POST':
+        request_der = request.body
+    elif encoded_request:
+        try:
+            request_der = base64.b64decode(encoded_request)
+        except (TypeError, ValueError):
+            return HttpResponse(status=400, content='Invalid OCSP request')
+    else:
+        return HttpResponse(status=405)
+    return OcspResponse(OcspResponder(PKI()).respond(request_der))
 
-def get_crl(request):
+
+def get_service_ocsp_response(request, scheme, hostname, port):
+    """Return the OCSP response of a service certificate, to be stapled by the web server"""
+    fqdn = hostname_from_principal(request.user.username)
+    role = request.GET.get('role', SERVICE)
+    protocol = request.GET.get('protocol', 'tcp')
+    if not Service.objects.filter(fqdn=fqdn, scheme=scheme, hostname=hostname, port=int(port),
+                                  protocol=protocol).exists():
+        return HttpResponse(status=404, content='%s://%s:%s/ unknown' % (scheme, hostname, port))
+    entry = service_entry(hostname, role)
     pki = PKI()
-    pki.ensure_crl()
-    # noinspection PyTypeChecker
-    with open(pki.cacrl_path, 'rb') as fd:
-        content = fd.read()
-    return HttpResponse(content, content_type='text/plain')
+    pki.ensure_certificate(entry)
+    return OcspResponse(OcspResponder(pki).get_stapling_response(entry))
+
+
+def get_host_ocsp_response(request):
+    """Return the OCSP response of the host certificate, to be stapled by the web server"""
+    entry = entry_from_hostname(hostname_from_principal(request.user.username))
+    pki = PKI()
+    pki.ensure_certificate(entry)
+    return OcspResponse(OcspResponder(pki).get_stapling_response(entry))
 
 
 def get_ca_certificate(request, kind='ca'):
@@ -101,20 +159,20 @@ def get_ca_certificate(request, kind='ca'):
 
 
 def get_user_certificate(request):
-    ldap_user = get_object_or_404(User, name=request.user.username)
+    ldap_user = User.get_cached_or_404(name=request.user.username)
     return CertificateEntryResponse(ldap_user.user_certificate_entry)
 
 
 def get_email_certificate(request):
-    ldap_user = get_object_or_404(User, name=request.user.username)
+    ldap_user = User.get_cached_or_404(name=request.user.username)
     return CertificateEntryResponse(ldap_user.email_certificate_entry)
 
 
 def get_signature_certificate(request):
-    ldap_user = get_object_or_404(User, name=request.user.username)
+    ldap_user = User.get_cached_or_404(name=request.user.username)
     return CertificateEntryResponse(ldap_user.signature_certificate_entry)
 
 
 def get_encipherment_certificate(request):
-    ldap_user = get_object_or_404(User, name=request.user.username)
+    ldap_user = User.get_cached_or_404(name=request.user.username)
     return CertificateEntryResponse(ldap_user.encipherment_certificate_entry)
@@ -8,7 +8,7 @@ from django.conf import settings
 from django.utils.six import text_type
 import netaddr
 from penatesserver.pki.service import CertificateEntry
-from django.db import models
+from django.db import models, router, transaction
 from penatesserver.subnets import get_subnets
 
 __author__ = 'Matthieu Gallet'
@@ -109,6 +109,48 @@ class Domain(models.Model):
         if Record.objects.filter(name=record_name, domain=self, type='TLSA').update(content=content) == 0:
             Record(name=record_name, domain=self, type='TLSA', content=content).save()
 
+    def set_sshfp_records(self, name, sshfp_values, replace=True):
+        """Reconcile the SSHFP RRset of `name` with the given values in a single transaction.
+
+        :param name: record name (usually the admin fqdn of the host)
+        :param sshfp_values: dict {(algorithm, digest type): content}, as returned by
+            :func:`penatesserver.utils.sshfp_values`
+        :param replace: if True, remove SSHFP records whose (algorithm, digest type) is not in `sshfp_values`
+            (and unparsable SSHFP records)
+        :return: True if at least one record has been modified (the SOA serial is then updated once)
+        """
+        modified = False
+        with transaction.atomic(using=router.db_for_write(Record)):
+            existing = {}
+            to_delete = []
+            for pk, content in Record.objects.filter(domain=self, name=name, type='SSHFP').values_list('pk', 'content'):
+                values = (content or '').split()
+                key = None
+                if len(values) == 3 and values[0].isdigit() and values[1].isdigit():
+                    key = (int(values[0]), int(values[1]))
+                if key in existing or (replace and key not in sshfp_values):
+                    to_delete.append(pk)
+                elif key in sshfp_values:
+                    existing[key] = (pk, content)
+            if to_delete:
+                Record.objects.filter(pk__in=to_delete).delete()
+                modified = True
+            to_create = []
+            for key, content in sshfp_values.items():
+                if key not in existing:
+                    to_create.append(Record(domain=self, name=name, type='SSHFP', content=content, ttl=86400))
+                elif existing[key][1] != content:
+                    Record.objects.filter(pk=existing[key][0]).update(content=content)
+                    modified = True
+            for record in to_create:
+                record.set_ordername()
+            if to_create:
+                Record.objects.bulk_create(to_create)
+                modified = True
+            if modified:
+                self.update_soa()
+        return modified
+
     @staticmethod
     def get_soa_serial():
         return datetime.datetime.now().strftime(text_type('%Y%m%d%H'))
@@ -208,8 +250,8 @@ class Record(models.Model):
             return 'Record("%s [%s] -> %s")' % (self.name, self.type, self.content)
         return 'Record("%s [%s] -> %s")' % (self.name, self.type, self.content)
 
-    def save(self, force_insert=False, force_update=False, using=None,
-             update_fields=None):
+    def set_ordername(self):
+        """Set the `auth` and `ordername` values, as expected by PowerDNS (also required before a `bulk_create`)"""
         domain_name = self.domain.name
         # noinspection PyTypeChecker
         self.auth = self.name.endswith(domain_name)
@@ -217,6 +259,10 @@ class Record(models.Model):
             comp = self.name[:-(1 + len(domain_name))].split(text_type('.'))
             comp.reverse()
             self.ordername = ' '.join(comp)
+
+    def save(self, force_insert=False, force_update=False, using=None,
+             update_fields=None):
+        self.set_ordername()
         super(Record, self).save(force_insert=force_insert, force_update=force_update, using=using, update_fields=update_fields)
 
     class Meta(object):
@@ -1,6 +1,21 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
+from django.conf import settings
+from ldapdb.router import Router
+
 __author__ = 'Matthieu Gallet'
+LDAP_ENGINES = {'ldapdb.backends.ldap', 'penatesserver.ldappool'}
+
+
+class LdapRouter(Router):
+    """Same as :class:`ldapdb.router.Router`, but also recognize databases using the pooled LDAP engine"""
+
+    def __init__(self):
+        super(LdapRouter, self).__init__()
+        for alias, settings_dict in settings.DATABASES.items():
+            if settings_dict['ENGINE'] in LDAP_ENGINES:
+                self.ldap_alias = alias
+                break
 
 
 # noinspection PyMethodMayBeStatic,PyProtectedMember,PyUnusedLocal
@@ -60,8 +60,8 @@ class GroupSerializer(serializers.Serializer):
     def update(self, instance, validated_data):
         assert isinstance(instance, Group)
         members = self.check_members(instance.members, validated_data)
-        instance.members = members
-        instance.save()
+        instance.remove_members([x for x in instance.members if x not in members])
+        instance.add_members(members)
         return instance
 
     @staticmethod
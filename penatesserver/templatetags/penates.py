@@ -77,6 +77,7 @@ def generate_uuid():
     return text_type(uuid.uuid4()).upper()
 
 
+@register.filter
 def base64_encode(binary_content):
     """
     >>> base64_encode('VW1JWWhQTlBPcXMwPQotLS0tLUVORCBDRVJUSUZJQ0FURS0tLS0tQWI0WGdCNTlpUGxkekRoeGUxNE51UHZ1eDZVCkNjUHdxbTNXaGFw')[0:50]
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from django.test import TestCase
+
+from penatesserver.decommission import HostDecommission
+from penatesserver.glpi.models import ShinkenService
+from penatesserver.models import Host, MountPoint, Service
+from penatesserver.powerdns.models import Domain, Record
+
+__author__ = 'Matthieu Gallet'
+
+
+class TestHostDecommission(TestCase):
+    def setUp(self):
+        self.domain = Domain.objects.get_or_create(name='infra.test.example.org')[0]
+        self.reverse_domain = Domain.objects.get_or_create(name='1.168.192.in-addr.arpa')[0]
+        for domain in (self.domain, self.reverse_domain):
+            Record(domain=domain, type='SOA', name=domain.name,
+                   content='ns.test.example.org admin@test.example.org 2000010100 10800 3600 604800 3600').save()
+        for index in (1, 2):
+            fqdn = 'vm%02d.infra.test.example.org' % index
+            host = Host(fqdn=fqdn, main_ip_address='192.168.1.%d' % index)
+            host.save()
+            MountPoint(host=host, mount_point='/', device='/dev/sda1', fs_type='ext4', options='rw').save()
+            Service(fqdn=fqdn, scheme='http', hostname='www%d.infra.test.example.org' % index, port=80).save()
+            ShinkenService(host_name=fqdn, check_command='check_http').save()
+            Record(domain=self.domain, type='A', name=fqdn, content='192.168.1.%d' % index).save()
+            Record(domain=self.domain, type='CNAME', name='www%d.infra.test.example.org' % index,
+                   content=fqdn).save()
+            Record(domain=self.reverse_domain, type='PTR', name='%d.1.168.192.in-addr.arpa' % index,
+                   content=fqdn).save()
+
+    def test_dry_run(self):
+        report = HostDecommission(['vm01.infra.test.example.org', 'unknown.infra.test.example.org'])\
+            .run(dry_run=True)
+        self.assertEqual(['vm01.infra.test.example.org'], report['hosts'])
+        self.assertEqual(['unknown.infra.test.example.org'], report['unknown_hosts'])
+        self.assertEqual(3, len(report['records']))
+        self.assertEqual(2, report['zones'])
+        self.assertEqual(2, Host.objects.count())
+        self.assertEqual(6, Record.objects.exclude(type='SOA').count())
+
+    def test_run(self):
+        HostDecommission(['vm01.infra.test.example.org']).run()
+        self.assertEqual(['vm02.infra.test.example.org'], list(Host.objects.values_list('fqdn', flat=True)))
+        self.assertEqual(1, MountPoint.objects.count())
+        self.assertEqual(1, Service.objects.count())
+        self.assertEqual(1, ShinkenService.objects.count())
+        self.assertEqual({'vm02.infra.test.example.org', 'www2.infra.test.example.org', '2.1.168.192.in-addr.arpa'},
+                         set(Record.objects.exclude(type='SOA').values_list('name', flat=True)))
+        for soa in Record.objects.filter(type='SOA').values_list('content', flat=True):
+            self.assertNotIn('2000010100', soa)
+
+    def test_delete_signal(self):
+        Host.objects.get(fqdn='vm02.infra.test.example.org').delete()
+        self.assertEqual(0, Record.objects.filter(content='vm02.infra.test.example.org').count())
+        self.assertEqual(1, Service.objects.count())
+
+    def test_srv_records(self):
+        for index in (1, 2):
+            Record(domain=self.domain, type='SRV', name='_http._tcp.infra.test.example.org', prio=0,
+                   content='0 80 www%d.infra.test.example.org' % index).save()
+        report = HostDecommission(['vm01.infra.test.example.org']).run(dry_run=True)
+        self.assertIn('_http._tcp.infra.test.example.org SRV 0 80 www1.infra.test.example.org', report['records'])
+        self.assertNotIn('_http._tcp.infra.test.example.org SRV 0 80 www2.infra.test.example.org', report['records'])
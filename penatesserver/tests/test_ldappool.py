@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from django.test import TestCase
+import ldap
+
+from penatesserver.ldappool import LdapConnectionPool
+
+__author__ = 'Matthieu Gallet'
+
+
+class FakeConnection(object):
+    def __init__(self, uri):
+        self.uri = uri
+        self.alive = True
+        self.unbound = False
+
+    def whoami_s(self):
+        if not self.alive:
+            raise ldap.SERVER_DOWN({'desc': 'down'})
+        return 'dn:cn=admin'
+
+    def unbind_s(self):
+        self.unbound = True
+
+
+class FakePool(LdapConnectionPool):
+    down_uris = set()
+
+    def connect(self, uri):
+        if uri in self.down_uris:
+            raise ldap.SERVER_DOWN({'desc': 'down'})
+        return FakeConnection(uri)
+
+
+class TestLdapConnectionPool(TestCase):
+
+    def test_reuse(self):
+        pool = FakePool('ldap://ldap1/ ldap://ldap2/', 'cn=admin', 'toto', size=1)
+        connection_1 = pool.acquire()
+        connection_2 = pool.acquire()
+        self.assertIsNot(connection_1, connection_2)
+        pool.release(connection_1)
+        pool.release(connection_2)
+        self.assertTrue(connection_2.unbound)  # only one idle connection is kept
+        self.assertIs(connection_1, pool.acquire())
+        stats = pool.get_stats()
+        self.assertEqual(2, stats['created'])
+        self.assertEqual(1, stats['reused'])
+        self.assertEqual(1, stats['used'])
+
+    def test_checks(self):
+        pool = FakePool('ldap://ldap1/', 'cn=admin', 'toto', check_interval=-1)
+        connection = pool.acquire()
+        pool.release(connection)
+        connection.alive = False
+        self.assertIsNot(connection, pool.acquire())
+        self.assertEqual(1, pool.get_stats()['failed_checks'])
+        pool = FakePool('ldap://ldap1/', 'cn=admin', 'toto', max_lifetime=-1)
+        connection = pool.acquire()
+        pool.release(connection)
+        self.assertIsNot(connection, pool.acquire())
+
+    def test_failover(self):
+        pool = FakePool('ldap://ldap1/ ldap://ldap2/', 'cn=admin', 'toto')
+        pool.down_uris = {'ldap://ldap1/'}
+        self.assertEqual('ldap://ldap2/', pool.acquire().uri)
+        self.assertEqual(1, pool.get_stats()['failovers'])
+        pool.down_uris = {'ldap://ldap1/', 'ldap://ldap2/'}
+        self.assertRaises(ldap.SERVER_DOWN, pool.acquire)
+
+    def test_discard(self):
+        pool = FakePool('ldap://ldap1/', 'cn=admin', 'toto')
+        connection = pool.acquire()
+        pool.discard(connection)
+        self.assertTrue(connection.unbound)
+        self.assertIsNot(connection, pool.acquire())
+        stats = pool.get_stats()
+        self.assertEqual(1, stats['closed'])
+        self.assertEqual(0, stats['idle'])
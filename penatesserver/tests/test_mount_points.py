@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+from django.test import TestCase
+
+from penatesserver.models import Host, MountPoint
+
+__author__ = 'Matthieu Gallet'
+
+
+class TestMountPoints(TestCase):
+
+    def test_synchronize(self):
+        host = Host(fqdn='vm01.infra.test.example.org')
+        host.save()
+        other_host = Host(fqdn='vm02.infra.test.example.org')
+        other_host.save()
+        MountPoint(host=other_host, mount_point='/', device='/dev/sdb1', fs_type='ext4', options='rw').save()
+        result = MountPoint.synchronize(host, [('/', '/dev/sda1', 'ext4', 'rw'), ('/tmp', 'tmpfs', 'tmpfs', 'rw')])
+        self.assertEqual((2, 0, 0), result)
+        result = MountPoint.synchronize(host, [('/', '/dev/sda1', 'ext4', 'ro'), ('/home', '/dev/sda2', 'xfs', 'rw')])
+        self.assertEqual((1, 1, 1), result)
+        self.assertEqual({('/', 'ro'), ('/home', 'rw')},
+                         set(MountPoint.objects.filter(host=host).values_list('mount_point', 'options')))
+        self.assertEqual((0, 0, 0), MountPoint.synchronize(host, [('/', '/dev/sda1', 'ext4', 'ro'),
+                                                                  ('/home', '/dev/sda2', 'xfs', 'rw')]))
+        self.assertEqual(1, MountPoint.objects.filter(host=other_host).count())
+
+    def test_parse_mount_table(self):
+        content = '/dev/sda1 / ext4 rw,relatime 0 0\nproc /proc proc rw,nosuid 0 0\n\n'
+        self.assertEqual([('/', '/dev/sda1', 'ext4', 'rw,relatime'), ('/proc', 'proc', 'proc', 'rw,nosuid')],
+                         MountPoint.parse_mount_table(content))
+        self.assertRaises(ValueError, MountPoint.parse_mount_table, '/dev/sda1 /')
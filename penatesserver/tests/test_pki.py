@@ -1,15 +1,19 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 import codecs
+import hashlib
 import os
 import tempfile
 import shutil
 from django.conf import settings
+from django.core.management import call_command, CommandError
 
 from django.test import TestCase
 import subprocess
 
-from penatesserver.pki.constants import CA_TEST, COMPUTER_TEST, TEST_DSA, TEST_SHA256
+from penatesserver.management.commands.renew_certificates import parse_hours
+from penatesserver.pki.constants import CA_TEST, COMPUTER_TEST, TEST_DSA, TEST_SHA256, CESSATION_OF_OPERATION
+from penatesserver.pki.ocsp import OcspResponder, parse_ocsp_request, UNAUTHORIZED, MALFORMED_REQUEST
 from penatesserver.pki.service import CertificateEntry, PKI
 
 __author__ = 'Matthieu Gallet'
@@ -127,6 +131,10 @@ class TestCertRole(TestPKI):
         stdout, stderr = p.communicate(input=password.encode('utf-8'))
         dst_key_content = stdout.decode('utf-8')
         self.assertTrue(src_key_content in dst_key_content)
+        # PKCS#12 bundles are salted, so identical bundles come from the cache
+        with open(filename, 'rb') as fd:
+            self.assertEqual(fd.read(), self.pki.get_pkcs12(entry, password=password))
+        self.assertNotEqual(self.pki.get_pkcs12(entry, password=password), self.pki.get_pkcs12(entry, password='other'))
 
 
 class TestCrl(TestPKI):
@@ -146,6 +154,77 @@ class TestCrl(TestPKI):
         with open(self.pki.dirname + '/index.txt', b'r') as fd:
             self.assertEqual(6, len(fd.read().splitlines()))
 
+    def test_fingerprints(self):
+        entry = CertificateEntry('test_fingerprints', organizationName='test_org', organizationalUnitName='test_unit',
+                                 emailAddress='test@example.com', localityName='City', countryName='FR',
+                                 stateOrProvinceName='Province', altNames=[], role=COMPUTER_TEST,
+                                 dirname=self.dirname)
+        self.pki.ensure_certificate(entry)
+        self.assertTrue(os.path.isfile(entry.fingerprints_filename))
+        self.assertEqual(CertificateEntry.pem_hash(entry.crt_filename), entry.crt_sha256)
+        self.assertEqual(CertificateEntry.pem_hash(entry.pub_filename, hashlib.sha512), entry.pub_sha512)
+        self.assertIs(entry.fingerprints, entry.fingerprints)
+        with codecs.open(entry.crt_filename, 'r', encoding='utf-8') as fd:
+            self.pki.revoke_certificate(fd.read(), regen_crl=False)
+        self.assertRaises(IOError, lambda: entry.crt_sha256)
+
+    def test_revoke_certificates(self):
+        entries = [CertificateEntry('test_bulk_%d' % i, organizationName='test_org', organizationalUnitName='test_unit',
+                                    emailAddress='test@example.com', localityName='City', countryName='FR',
+                                    stateOrProvinceName='Province', altNames=[], role=COMPUTER_TEST,
+                                    dirname=self.dirname) for i in range(3)]
+        for entry in entries:
+            self.pki.ensure_certificate(entry)
+        revoked = self.pki.revoke_certificates(entries, reason=CESSATION_OF_OPERATION)
+        self.assertEqual(3, len(revoked))
+        self.assertEqual([], self.pki.revoke_certificates(revoked))
+        for entry in entries:
+            self.assertFalse(os.path.isfile(entry.crt_filename))
+            self.assertTrue(os.path.isfile(entry.key_filename + '.bak'))
+        with codecs.open(self.pki.index_path, 'r', encoding='utf-8') as fd:
+            self.assertEqual(3, fd.read().count(',%s' % CESSATION_OF_OPERATION))
+        self.assertRaises(ValueError, self.pki.revoke_certificates, revoked, reason='invalid')
+
+    def test_delta_crl(self):
+        entry = CertificateEntry('test_delta', organizationName='test_org', organizationalUnitName='test_unit',
+                                 emailAddress='test@example .com', localityName='City',
+                                 countryName='FR', stateOrProvinceName='Province', altNames=[],
+                                 role=COMPUTER_TEST, dirname=self.dirname)
+        self.pki.ensure_certificate(entry)
+        crl = self.pki.get_crl()
+        self.assertIs(crl, self.pki.get_crl())
+        with codecs.open(entry.crt_filename, 'r', encoding='utf-8') as fd:
+            self.pki.revoke_certificate(fd.read(), regen_crl=False)
+        delta_crl = self.pki.get_crl(delta=True)
+        self.assertTrue(b'BEGIN X509 CRL' in delta_crl.content)
+        self.assertNotEqual(crl.etag, delta_crl.etag)
+
+    def test_ocsp(self):
+        entry = CertificateEntry('test_ocsp', organizationName='test_org', organizationalUnitName='test_unit',
+                                 emailAddress='test@example.com', localityName='City',
+                                 countryName='FR', stateOrProvinceName='Province', altNames=[],
+                                 role=COMPUTER_TEST, dirname=self.dirname)
+        self.pki.ensure_certificate(entry)
+        responder = OcspResponder(self.pki)
+        request_path = os.path.join(self.dirname, 'ocsp_request.der')
+        subprocess.check_call([settings.OPENSSL_PATH, 'ocsp', '-issuer', self.pki.hosts_crt_path, '-cert',
+                               entry.crt_filename, '-no_nonce', '-reqout', request_path])
+        with open(request_path, 'rb') as fd:
+            request_der = fd.read()
+        key_hash, serial = parse_ocsp_request(request_der)[0]
+        self.assertEqual('hosts', responder.get_issuers()[key_hash])
+        self.assertEqual('V', responder.get_status(serial))
+        response = responder.respond(request_der)
+        self.assertEqual(response, responder.get_stapling_response(entry))
+        self.assertEqual(MALFORMED_REQUEST, responder.respond(b'invalid'))
+        self.assertEqual(UNAUTHORIZED, responder.get_response('hosts', serial + 1000))
+        self.assertEqual([], [x for x in os.listdir(responder.responses_dirname) if '_U.der' in x])
+        with codecs.open(entry.crt_filename, 'r', encoding='utf-8') as fd:
+            self.pki.revoke_certificate(fd.read(), regen_crl=False)
+        self.assertEqual('R', responder.get_status(serial))
+        self.assertNotEqual(response, responder.respond(request_der))
+        self.assertEqual(UNAUTHORIZED, responder.respond(request_der.replace(key_hash, b'0' * len(key_hash))))
+
 
 class TestSha256(TestCase):
     def test_sha256(self):
@@ -214,3 +293,25 @@ ZqLrk/Ya0PcWM220wKmoHmkCAwEAAQ==
             sha256 = CertificateEntry.pem_hash(fd.name)
             self.assertEqual("bf2f7adbc2bd0865bf65d41b9a7277b531fb3618c00ea339256e9e76ffbdb4e6", sha256)
 
+
+class TestRenewal(TestPKI):
+    def test_renew_certificate(self):
+        entry = CertificateEntry('test_renewal', organizationName='test_org', organizationalUnitName='test_unit',
+                                 emailAddress='test@example.com', localityName='City',
+                                 countryName='FR', stateOrProvinceName='Province', altNames=[],
+                                 role=COMPUTER_TEST, dirname=self.dirname)
+        self.pki.ensure_certificate(entry)
+        serials = [x[1] for x in self.pki.get_expiry_index() if x[2].commonName == 'test_renewal']
+        self.assertEqual(1, len(serials))
+        new_serial = self.pki.renew_certificate(entry)
+        self.assertNotEqual(serials[0], new_serial)
+        index = [x for x in self.pki.get_expiry_index() if x[2].commonName == 'test_renewal']
+        self.assertEqual([new_serial], [x[1] for x in index])
+        self.assertEqual(COMPUTER_TEST, index[0][2].role)
+
+    def test_renewal_hours(self):
+        self.assertEqual({22, 23, 0, 1}, parse_hours('22-1'))
+        self.assertEqual({1, 2, 3}, parse_hours('1-3'))
+        self.assertRaises(ValueError, parse_hours, 'night')
+        self.assertRaises(ValueError, parse_hours, '1-25')
+        self.assertRaises(CommandError, call_command, 'renew_certificates', hours='night')
@@ -54,3 +54,18 @@ class TestLocalResolve(TestCase):
 
     def test_no_answer(self):
         self.assertIsNone(Record.local_resolve('i.%s' % self.domain_name))
+
+
+class TestSshfpRecords(TestCase):
+
+    def test_keep_unparsable(self):
+        domain = Domain.objects.get_or_create(name='sshfp.domain.org')[0]
+        name = 'a.sshfp.domain.org'
+        Record(domain=domain, type='SSHFP', content='manually added', name=name).save()
+        Record(domain=domain, type='SSHFP', content='2 1 abcd', name=name).save()
+        domain.set_sshfp_records(name, {(1, 1): '1 1 1234'}, replace=False)
+        self.assertEqual({'manually added', '2 1 abcd', '1 1 1234'},
+                         set(Record.objects.filter(name=name, type='SSHFP').values_list('content', flat=True)))
+        domain.set_sshfp_records(name, {(1, 1): '1 1 1234'})
+        self.assertEqual(['1 1 1234'], list(Record.objects.filter(name=name, type='SSHFP')
+                                            .values_list('content', flat=True)))
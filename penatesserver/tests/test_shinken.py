@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import json
+
+from django.core.exceptions import ValidationError
+from django.test import TestCase, RequestFactory
+
+from penatesserver.glpi.models import ShinkenService, MonitoringChange, CheckTemplate
+from penatesserver.glpi.services import get_shinken_services, get_monitoring_delta, get_contact_password
+from penatesserver.glpi.views import monitoring_export
+from penatesserver.models import Host, Service, DjangoUser
+
+__author__ = 'Matthieu Gallet'
+
+
+class TestShinkenServices(TestCase):
+
+    def test_services(self):
+        Host(fqdn='vm01.infra.test.example.org', main_ip_address='10.19.1.2').save()
+        Service(fqdn='vm01.infra.test.example.org', scheme='http', hostname='www.test.example.org', port=443,
+                encryption='tls').save()
+        Service(fqdn='vm01.infra.test.example.org', scheme='dkim', hostname='mail.test.example.org', port=0).save()
+        Service(fqdn='vm01.infra.test.example.org', scheme='foo', hostname='foo.test.example.org', port=1234).save()
+        services = get_shinken_services()
+        self.assertEqual(CheckTemplate.objects.count() + 2, len(services))
+        commands = {x['check_command'] for x in services}
+        self.assertIn('penates_dig_2!vm01.infra.test.example.org!10.19.1.2', commands)
+        self.assertIn('penates_https!www.test.example.org!443', commands)
+        self.assertIn('check_tcp!1234', commands)
+        self.assertIn('check_ping!100.0,20%!500.0,60%', commands)
+        self.assertEqual(services, get_shinken_services())
+        # the cached configuration is invalidated by signals
+        ShinkenService(host_name='vm01.infra.test.example.org', check_command='check_nrpe!check_raid').save()
+        services = get_shinken_services()
+        self.assertEqual(CheckTemplate.objects.count() + 3, len(services))
+        self.assertEqual({'use': 'generic-service', 'host_name': 'vm01.infra.test.example.org',
+                          'check_command': 'check_nrpe!check_raid',
+                          'service_description': 'check_nrpe-check_raid on vm01.infra.test.example.org'},
+                         services[-1])
+
+    def test_check_templates(self):
+        Host(fqdn='vm01.infra.test.example.org', main_ip_address='10.19.1.2').save()
+        Host(fqdn='vm02.infra.test.example.org', main_ip_address='10.19.1.3').save()
+        count = len(get_shinken_services())
+        version = MonitoringChange.get_version()
+        template = CheckTemplate(name='ntp', service_description='NTP on %(hostname)s',
+                                 check_command='check_nrpe!check_ntp_time', check_interval=60)
+        template.full_clean()
+        template.save()
+        services = get_shinken_services()
+        self.assertEqual(count + 2, len(services))
+        self.assertIn({'use': 'generic-service', 'host_name': 'vm02.infra.test.example.org',
+                       'service_description': 'NTP on vm02', 'check_command': 'check_nrpe!check_ntp_time',
+                       'notifications_enabled': '0', 'check_interval': '60'}, services)
+        self.assertEqual(['vm01.infra.test.example.org', 'vm02.infra.test.example.org'],
+                         get_monitoring_delta(MonitoringChange.SERVICES, version)['deleted'])
+        self.assertRaises(ValidationError, CheckTemplate(name='bad', service_description='%(unknown)s',
+                                                         check_command='check_ssh').full_clean)
+
+
+class TestShinkenContacts(TestCase):
+
+    def test_contact_password(self):
+        self.assertEqual(get_contact_password('user1'), get_contact_password('user1'))
+        self.assertNotEqual(get_contact_password('user1'), get_contact_password('user2'))
+        self.assertEqual(20, len(get_contact_password('user1')))
+
+
+class TestShinkenServiceSynchronize(TestCase):
+    host_name = 'vm01.infra.test.example.org'
+
+    def test_synchronize(self):
+        ShinkenService(host_name=self.host_name, check_command='check_nrpe!check_raid').save()
+        ShinkenService(host_name=self.host_name, check_command='check_nrpe!check_old').save()
+        definitions = [{'check_command': 'check_nrpe!check_raid', 'check_interval': 60},
+                       {'check_command': 'check_nrpe!check_mysql', 'icon_set': 'database'},
+                       {'check_command': 'check_nrpe!check_postgresql'}]
+        self.assertEqual((2, 1, 1), ShinkenService.synchronize(self.host_name, definitions))
+        self.assertEqual({'check_nrpe!check_raid', 'check_nrpe!check_mysql', 'check_nrpe!check_postgresql'},
+                         set(ShinkenService.objects.filter(host_name=self.host_name)
+                             .values_list('check_command', flat=True)))
+        self.assertEqual(60, ShinkenService.objects.get(check_command='check_nrpe!check_raid').check_interval)
+        self.assertEqual((0, 0, 0), ShinkenService.synchronize(self.host_name, definitions))
+        self.assertRaises(ValueError, ShinkenService.synchronize, self.host_name, [{'check_interval': 60}])
+        self.assertRaises(ValueError, ShinkenService.synchronize, self.host_name,
+                          [{'check_command': 'check_ssh', 'unknown_field': 1}])
+        self.assertEqual((0, 0, 3), ShinkenService.synchronize(self.host_name, []))
+
+
+class TestMonitoringExport(TestCase):
+
+    def get(self, kind, **kwargs):
+        request = RequestFactory().get('/auth/monitoring/%s' % kind, **kwargs)
+        request.user = DjangoUser(username='supervisor_admin')
+        return monitoring_export(request, kind)
+
+    def test_export(self):
+        Host(fqdn='vm01.infra.test.example.org', main_ip_address='10.19.1.2', admin_ip_address='10.19.2.2').save()
+        response = self.get('hosts')
+        self.assertEqual(200, response.status_code)
+        hosts = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(['vm01.infra.test.example.org'], [x['host_name'] for x in hosts])
+        response = self.get('hosts', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(304, response.status_code)
+        etag = response['ETag']
+        Host(fqdn='vm02.infra.test.example.org', main_ip_address='10.19.1.3', admin_ip_address='10.19.2.3').save()
+        response = self.get('hosts', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(2, len(json.loads(response.content.decode('utf-8'))))
+        response = self.get('commands')
+        self.assertIn('penates_dig_2', {x['command_name'] for x in json.loads(response.content.decode('utf-8'))})
+
+    def test_forbidden(self):
+        request = RequestFactory().get('/auth/monitoring/hosts')
+        request.user = DjangoUser.objects.create(username='supervisor')
+        self.assertEqual(403, monitoring_export(request, 'hosts').status_code)
+
+
+class TestMonitoringDelta(TestCase):
+
+    def test_delta(self):
+        Host(fqdn='vm01.infra.test.example.org', main_ip_address='10.19.1.2').save()
+        version = MonitoringChange.get_version()
+        self.assertEqual({'version': version, 'upserts': [], 'deleted': []},
+                         get_monitoring_delta(MonitoringChange.HOSTS, version))
+        Host(fqdn='vm02.infra.test.example.org', main_ip_address='10.19.1.3').save()
+        self.assertEqual(version + 1, MonitoringChange.get_version())
+        ShinkenService(host_name='vm01.infra.test.example.org', check_command='check_nrpe!check_raid').save()
+        delta = get_monitoring_delta(MonitoringChange.HOSTS, version)
+        self.assertEqual(['vm02.infra.test.example.org'], [x['host_name'] for x in delta['upserts']])
+        delta = get_monitoring_delta(MonitoringChange.SERVICES, version)
+        self.assertEqual(['vm01.infra.test.example.org', 'vm02.infra.test.example.org'], delta['deleted'])
+        self.assertEqual(2 * CheckTemplate.objects.count() + 1, len(delta['upserts']))
+        version = delta['version']
+        Host.objects.filter(fqdn='vm02.infra.test.example.org').delete()
+        delta = get_monitoring_delta(MonitoringChange.HOSTS, version)
+        self.assertEqual({'version': MonitoringChange.get_version(), 'upserts': [],
+                          'deleted': ['vm02.infra.test.example.org']}, delta)
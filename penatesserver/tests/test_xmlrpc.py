@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import gzip
+import io
+import threading
+
+from django.contrib.auth.models import Permission
+from django.core.exceptions import PermissionDenied
+from django.core.signing import BadSignature
+from django.test import TestCase, RequestFactory
+from django.utils.six.moves.xmlrpc_client import dumps, loads, Fault
+
+from penatesserver.glpi.services import create_session, check_session, check_login
+from penatesserver.glpi.views import refresh_session
+from penatesserver.glpi.xmlrpc import XMLRPCSite, register_rpc_method
+from penatesserver.models import AdminUser
+
+__author__ = 'Matthieu Gallet'
+site = XMLRPCSite()
+site.chunk_size = 100
+
+
+# noinspection PyUnusedLocal
+@register_rpc_method(site, name='test.values')
+def values(request, args):
+    if args[0] < 0:
+        raise ValueError('negative count')
+    return ({'index': x, 'name': 'élément %d' % x} for x in range(args[0]))
+
+
+# noinspection PyUnusedLocal
+@register_rpc_method(site, name='test.thread', serial=True)
+def thread_name(request, args):
+    return threading.current_thread().name
+
+
+class TestXmlRpc(TestCase):
+    def call(self, count, gzipped=False):
+        factory = RequestFactory()
+        kwargs = {'HTTP_ACCEPT_ENCODING': 'gzip'} if gzipped else {}
+        request = factory.post('/rpc', dumps((count, ), 'test.values'), content_type='text/xml', **kwargs)
+        response = site.dispatch(request)
+        if response.streaming:
+            content = b''.join(response.streaming_content)
+        else:
+            content = response.content
+        if gzipped:
+            self.assertEqual('gzip', response['Content-Encoding'])
+            content = gzip.GzipFile(fileobj=io.BytesIO(content)).read()
+        return response, loads(content.decode('utf-8'))[0][0]
+
+    def test_streaming(self):
+        response, result = self.call(50)
+        self.assertTrue(response.streaming)
+        self.assertEqual([{'index': x, 'name': 'élément %d' % x} for x in range(50)], result)
+        response, result = self.call(50, gzipped=True)
+        self.assertEqual(50, len(result))
+        response, result = self.call(0)
+        self.assertEqual([], result)
+
+    def test_fault(self):
+        self.assertRaises(Fault, self.call, -1)
+
+    def test_multicall(self):
+        calls = [{'methodName': 'test.values', 'params': [2]}, {'methodName': 'test.values', 'params': [-1]},
+                 {'methodName': 'test.unknown', 'params': []}]
+        request = RequestFactory().post('/rpc', dumps((calls, ), 'system.multicall'), content_type='text/xml')
+        result = loads(site.dispatch(request).content.decode('utf-8'))[0][0]
+        self.assertEqual([[{'index': 0, 'name': 'élément 0'}, {'index': 1, 'name': 'élément 1'}]], result[0])
+        self.assertEqual('ValueError', result[1]['faultCode'])
+        self.assertEqual('KeyError', result[2]['faultCode'])
+
+    def test_serial_multicall(self):
+        calls = [{'methodName': 'test.thread'}, {'methodName': 'test.values', 'params': [1]},
+                 {'methodName': 'test.values', 'params': [2]}, {'methodName': 'test.thread'}]
+        request = RequestFactory().post('/rpc', dumps((calls, ), 'system.multicall'), content_type='text/xml')
+        result = loads(site.dispatch(request).content.decode('utf-8'))[0][0]
+        self.assertEqual([threading.current_thread().name], result[0])
+        self.assertEqual(2, len(result[2][0]))
+        self.assertEqual([threading.current_thread().name], result[3])
+
+    def test_introspection(self):
+        request = RequestFactory().get('/rpc')
+        self.assertEqual(['system.listMethods', 'system.methodHelp', 'system.methodSignature', 'system.multicall',
+                          'test.thread', 'test.values'], site.list_methods(request, []))
+        self.assertEqual([['array', 'array']], site.method_signature(request, ['system.multicall']))
+        self.assertEqual('undef', site.method_signature(request, ['test.values']))
+        self.assertEqual('Return the list of the available methods', site.method_help(request, ['system.listMethods']))
+        self.assertRaises(KeyError, site.method_signature, request, ['test.unknown'])
+
+
+class TestMonitoringSessions(TestCase):
+
+    def test_sessions(self):
+        request = RequestFactory().get('/rpc')
+        session = create_session('supervision')
+        self.assertEqual('supervision', check_session(request, [{'session': session}]))
+        self.assertEqual(session, request.monitoring_session[0])
+        self.assertRaises(BadSignature, check_session, RequestFactory().get('/rpc'), [{'session': session + 'x'}])
+        with self.settings(MONITORING_SESSION_DURATION=-10):
+            expired_session = create_session('supervision')
+        self.assertRaises(ValueError, check_session, RequestFactory().get('/rpc'), [{'session': expired_session}])
+
+    def test_logins(self):
+        user = AdminUser(username='supervision')
+        user.set_password('toto')
+        user.save()
+        self.assertFalse(check_login('supervision', 'toto'))
+        user.user_permissions.add(Permission.objects.get(codename='supervision'))
+        self.assertTrue(check_login('supervision', 'toto'))
+        user.set_password('titi')
+        user.save()
+        self.assertFalse(check_login('supervision', 'toto'))
+        self.assertTrue(check_login('supervision', 'titi'))
+        session = create_session('supervision')
+        self.assertTrue(refresh_session(RequestFactory().get('/rpc'), [{'session': session}])['session'])
+        user.user_permissions.clear()
+        self.assertRaises(PermissionDenied, refresh_session, RequestFactory().get('/rpc'), [{'session': session}])
@@ -8,6 +8,10 @@ import os
 import random
 import re
 import string
+import sys
+import threading
+from django.core.urlresolvers import get_script_prefix, set_script_prefix
+from django.utils import six
 from django.utils.encoding import force_text
 
 from django.utils.timezone import utc
@@ -113,6 +117,51 @@ def ensure_list(value):
     return [value]
 
 
+def chunks(values, size):
+    """Split a list into sublists of at most `size` elements (e.g. for `__in` lookups on large lists)
+
+    >>> list(chunks([1, 2, 3, 4, 5], 2))
+    [[1, 2], [3, 4], [5]]
+    """
+    values = list(values)
+    for index in range(0, len(values), size):
+        yield values[index:index + size]
+
+
+class BackgroundCall(object):
+    """Call a function in a separate thread, so the current thread can do something else in the meantime (e.g. DNS
+    and Kerberos work while openssl is generating a certificate). The function must not use the database, since
+    each thread has its own connection. The script prefix of the current thread is used by the new thread,
+    so `reverse()` still builds the same URLs.
+
+    >>> call = BackgroundCall(sum, [1, 2, 3])
+    >>> call.join()
+    6
+    """
+
+    def __init__(self, func, *args, **kwargs):
+        self.result = None
+        self.exc_info = None
+        self.script_prefix = get_script_prefix()
+        self.thread = threading.Thread(target=self.run, args=(func, args, kwargs))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, func, args, kwargs):
+        set_script_prefix(self.script_prefix)
+        try:
+            self.result = func(*args, **kwargs)
+        except Exception:
+            self.exc_info = sys.exc_info()
+
+    def join(self):
+        """Wait for the end of the call and return its result (or raise its exception)"""
+        self.thread.join()
+        if self.exc_info is not None:
+            six.reraise(*self.exc_info)
+        return self.result
+
+
 def dhcp_list_to_dict(value_list):
     """Convert a list of DHCP values to a dict
     >>> dhcp_list_to_dict(['key1 value11 value12', 'key2 value21 value22 value23']) == OrderedDict([('key1', ['value11', 'value12']), ('key2', ['value21', 'value22', 'value23'])])
@@ -188,6 +237,44 @@ def clean_string(value, allow_unicode=False):
     return value
 
 
+SSHFP_ALGORITHMS = {'ssh-rsa': 1, 'ssh-dss': 2, 'ecdsa-sha2-nistp256': 3, 'ssh-ed25519': 4, }
+SSH_PUB_RE = re.compile(r'^([\w\-]+) ([\w\+=/]{1,5000})(|\s.*)$')
+
+
+def sshfp_values(pub_ssh_keys):
+    """Parse one or more public SSH keys (one per line, e.g. the concatenation of all ssh_host_*_key.pub files)
+    and return the content of the matching SSHFP records (both SHA-1 and SHA-256 digests), indexed by (algorithm,
+    digest type).
+
+    >>> sshfp_values('ssh-rsa QkJCQnozcVZRSTlNYTFIYw== root@localhost')[(1, 1)] == \
+'1 1 915984d4f71be43b49154b61c786d1a092e49a4d'
+    True
+    >>> len(sshfp_values('ssh-rsa QkJCQnozcVZRSTlNYTFIYw==\\nssh-ed25519 RkJCQnozcVZRSTlNYTFIYw==\\n'))
+    4
+
+    :raise ValueError: if a key is invalid or of an unknown type
+    :rtype: :class:`dict`
+    """
+    result = OrderedDict()
+    for line in pub_ssh_keys.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        matcher = SSH_PUB_RE.match(line)
+        if not matcher:
+            raise ValueError('Invalid public SSH key')
+        if matcher.group(1) not in SSHFP_ALGORITHMS:
+            raise ValueError('Unknown SSH key type %s' % matcher.group(1))
+        algorithm_code = SSHFP_ALGORITHMS[matcher.group(1)]
+        try:
+            key_content = b64decode(matcher.group(2))
+        except (TypeError, ValueError):
+            raise ValueError('Invalid public SSH key')
+        result[(algorithm_code, 1)] = '%s 1 %s' % (algorithm_code, hashlib.sha1(key_content).hexdigest())
+        result[(algorithm_code, 2)] = '%s 2 %s' % (algorithm_code, hashlib.sha256(key_content).hexdigest())
+    return result
+
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
@@ -1,9 +1,7 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
-import base64
-import hashlib
+import json
 import os
-import re
 import tempfile
 
 from django.conf import settings
@@ -12,19 +10,25 @@ from django.http import HttpResponse
 from django.http.response import HttpResponseRedirect
 from django.shortcuts import render_to_response, get_object_or_404
 from django.template import RequestContext
+from django.utils.six import text_type
 from django.utils.translation import ugettext as _
 import netaddr
 from rest_framework.generics import ListCreateAPIView, RetrieveUpdateDestroyAPIView
 
 from penatesserver.forms import PasswordForm
+from penatesserver.glpi.models import record_monitoring_changes
+from penatesserver.importer import UserImporter
 from penatesserver.kerb import add_principal_to_keytab, add_principal, principal_exists
-from penatesserver.models import Service, Host, User, Group, MountPoint
+from penatesserver.ldappool import get_pool_stats
+from penatesserver.models import Service, Host, User, Group, MountPoint, ldap_cache_stats
+from penatesserver.pagination import LdapCursorPagination
 from penatesserver.pki.constants import COMPUTER, SERVICE, KERBEROS_DC, PRINTER, TIME_SERVER, SERVICE_1024
 from penatesserver.pki.service import CertificateEntry, PKI
 from penatesserver.powerdns.models import Domain, Record
 from penatesserver.serializers import UserSerializer, GroupSerializer
 from penatesserver.subnets import get_subnets
-from penatesserver.utils import hostname_from_principal, principal_from_hostname
+from penatesserver.utils import hostname_from_principal, principal_from_hostname, sshfp_values, is_admin, \
+    BackgroundCall
 
 __author__ = 'flanker'
 
@@ -103,10 +107,10 @@ def get_host_keytab(request, hostname):
     else:
         add_principal(principal)
     Host.objects.get_or_create(fqdn=fqdn)
-    # create private key, public key, public certificate, public SSH key
+    # create private key, public key, public certificate, public SSH key (openssl runs while DNS records are created
+    # and while the keytab is extracted)
     entry = entry_from_hostname(fqdn)
-    pki = PKI()
-    pki.ensure_certificate(entry)
+    certificate_call = BackgroundCall(PKI().ensure_certificate, entry)
     # create DNS records
     if ip_address:
         Domain.ensure_auto_record(ip_address, fqdn, unique=True, override_reverse=True)
@@ -115,9 +119,13 @@ def get_host_keytab(request, hostname):
         admin_fqdn = '%s.%s%s' % (short_hostname, settings.PDNS_ADMIN_PREFIX, domain_name)
         Domain.ensure_auto_record(admin_ip_address, admin_fqdn, unique=True, override_reverse=False)
         Host.objects.filter(fqdn=fqdn).update(admin_ip_address=admin_ip_address)
+    record_monitoring_changes(hosts=[fqdn])
     if settings.OFFER_HOST_KEYTABS:
-        return KeytabResponse(principal)
-    return HttpResponse('', content_type='text/plain', status=201)
+        response = KeytabResponse(principal)
+    else:
+        response = HttpResponse('', content_type='text/plain', status=201)
+    certificate_call.join()
+    return response
 
 
 def set_dhcp(request, mac_address):
@@ -136,6 +144,7 @@ def set_dhcp(request, mac_address):
         Host.objects.filter(fqdn=hostname)\
             .update(admin_ip_address=admin_ip_address, admin_mac_address=admin_mac_address)
         Domain.ensure_auto_record(admin_ip_address, long_admin_hostname, unique=True, override_reverse=False)
+    record_monitoring_changes(hosts=[hostname])
     return HttpResponse(status=201)
 
 
@@ -164,31 +173,51 @@ def set_mount_point(request):
     return HttpResponse('', status=201)
 
 
+def set_mount_points(request):
+    """Replace all mount points of the host by the complete mount table given in the request body
+    (in the /proc/mounts format). Stale mount points are removed.
+    """
+    hostname = hostname_from_principal(request.user.username)
+    hosts = list(Host.objects.filter(fqdn=hostname)[0:1])
+    if not hosts:
+        return HttpResponse(status=404)
+    if request.method != 'POST':
+        return HttpResponse('mount table must be POSTed', status=405)
+    try:
+        mount_points = MountPoint.parse_mount_table(request.body.decode('utf-8'))
+    except ValueError as e:
+        return HttpResponse(text_type(e), status=400)
+    created, updated, deleted = MountPoint.synchronize(hosts[0], mount_points)
+    return HttpResponse('%d created, %d updated, %d deleted' % (created, updated, deleted), status=200,
+                        content_type='text/plain')
+
+
 def set_ssh_pub(request):
+    """Publish the SSHFP records of the public SSH key(s) given in the request body.
+    Records of other key types are kept."""
+    return publish_ssh_pub(request, replace=False)
+
+
+def set_ssh_pubs(request):
+    """Publish the SSHFP records of the whole bundle of public SSH keys (all ssh_host_*_key.pub files) given in the
+    request body. SSHFP records of key types that are not in the bundle are removed."""
+    return publish_ssh_pub(request, replace=True)
+
+
+def publish_ssh_pub(request, replace=False):
     fqdn = hostname_from_principal(request.user.username)
     if Host.objects.filter(fqdn=fqdn).count() == 0:
         return HttpResponse(status=404)
     fqdn = '%s.%s%s' % (fqdn.partition('.')[0], settings.PDNS_ADMIN_PREFIX, settings.PENATES_DOMAIN)
     domain_name = '%s%s' % (settings.PDNS_ADMIN_PREFIX, settings.PENATES_DOMAIN)
-    pub_ssh_key = request.body
-    matcher = re.match(r'([\w\-]+) ([\w\+=/]{1,5000})(|\s.*)$', pub_ssh_key)
-    if not matcher:
+    try:
+        values = sshfp_values(request.body.decode('utf-8'))
+    except ValueError as e:
+        return HttpResponse(status=406, content=text_type(e))
+    if not values:
         return HttpResponse(status=406, content='Invalid public SSH key')
-    methods = {'ssh-rsa': 1, 'ssh-dss': 2, 'ecdsa-sha2-nistp256': 3, 'ssh-ed25519': 4, }
-    if matcher.group(1) not in methods:
-        return HttpResponse(status=406, content='Unknown SSH key type %s' % matcher.group(1))
-    sha1_hash = hashlib.sha1(base64.b64decode(matcher.group(2))).hexdigest()
-    sha256_hash = hashlib.sha256(base64.b64decode(matcher.group(2))).hexdigest()
-    algorithm_code = methods[matcher.group(1)]
     domain = Domain.objects.get(name=domain_name)
-    sha1_value = '%s 1 %s' % (algorithm_code, sha1_hash)
-    sha256_value = '%s 2 %s' % (algorithm_code, sha256_hash)
-    for value in sha1_value, sha256_value:
-        if Record.objects.filter(domain=domain, name=fqdn, type='SSHFP', content__startswith=value[:4]).count() == 0:
-            Record(domain=domain, name=fqdn, type='SSHFP', content=value, ttl=86400).save()
-        else:
-            Record.objects.filter(domain=domain, name=fqdn, type='SSHFP', content__startswith=value[:4])\
-                .update(content=value)
+    domain.set_sshfp_records(fqdn, values, replace=replace)
     return HttpResponse(status=201)
 
 
@@ -243,16 +272,18 @@ def set_service(request, scheme, hostname, port):
                                                      protocol=protocol)
     Service.objects.filter(pk=service.pk).update(kerberos_service=kerberos_service, description=description,
                                                  dns_srv=srv_field, encryption=encryption)
+    record_monitoring_changes(services=[fqdn])
     # certificates
     entry = CertificateEntry(hostname, organizationName=settings.PENATES_ORGANIZATION,
                              organizationalUnitName=_('Services'), emailAddress=settings.PENATES_EMAIL_ADDRESS,
                              localityName=settings.PENATES_LOCALITY, countryName=settings.PENATES_COUNTRY,
                              stateOrProvinceName=settings.PENATES_STATE, altNames=[], role=role)
-    pki = PKI()
-    pki.ensure_certificate(entry)
+    # openssl runs while kadmin creates the principal
+    certificate_call = BackgroundCall(PKI().ensure_certificate, entry)
     if kerberos_service:
         principal_name = '%s/%s@%s' % (kerberos_service, fqdn, settings.PENATES_REALM)
         add_principal(principal_name)
+    certificate_call.join()
     # DNS part
     record_name, sep, domain_name = hostname.partition('.')
     if sep == '.':
@@ -326,6 +357,7 @@ class UserList(ListCreateAPIView):
     queryset = User.objects.all()
     serializer_class = UserSerializer
     lookup_field = 'name'
+    pagination_class = LdapCursorPagination
 
 
 class UserDetail(RetrieveUpdateDestroyAPIView):
@@ -344,6 +376,7 @@ class GroupList(ListCreateAPIView):
     queryset = Group.objects.all()
     serializer_class = GroupSerializer
     lookup_field = 'name'
+    pagination_class = LdapCursorPagination
 
 
 class GroupDetail(RetrieveUpdateDestroyAPIView):
@@ -355,11 +388,49 @@ class GroupDetail(RetrieveUpdateDestroyAPIView):
     lookup_field = 'name'
 
 
+def import_users(request):
+    """Create many users at once (admin only). The request body is either a CSV file (with a header line) or a
+    JSON list of objects, with the following fields: name, display_name, phone, uid_number, gid_number, groups
+    (;-separated in CSV files) and password.
+    Return a JSON report: {"created": [names], "errors": [{"row": index, "name": name, "error": message}]}
+    """
+    if not is_admin(request.user.username):
+        return HttpResponse(status=403)
+    if request.method != 'POST':
+        return HttpResponse('users must be POSTed', status=405)
+    content = request.body.decode('utf-8')
+    try:
+        if request.META.get('CONTENT_TYPE', '').startswith('application/json'):
+            rows = UserImporter.read_json(content)
+        else:
+            rows = UserImporter.read_csv(content)
+    except ValueError as e:
+        return HttpResponse(text_type(e), status=400)
+    report = UserImporter().run(rows)
+    return HttpResponse(json.dumps(report), status=200, content_type='application/json')
+
+
+def get_ldap_pool_stats(request):
+    """Return the statistics of the LDAP connection pool(s) of the current worker process (admin only)"""
+    if not is_admin(request.user.username):
+        return HttpResponse(status=403)
+    return HttpResponse(json.dumps(get_pool_stats()), status=200, content_type='application/json')
+
+
+def get_ldap_cache_stats(request):
+    """Return the hit/miss counters of the LDAP lookup cache of the current worker process (admin only)"""
+    if not is_admin(request.user.username):
+        return HttpResponse(status=403)
+    return HttpResponse(json.dumps(ldap_cache_stats), status=200, content_type='application/json')
+
+
 def change_own_password(request):
-    ldap_user = get_object_or_404(User, name=request.user.username)
+    ldap_user = User.get_cached_or_404(name=request.user.username)
     if request.method == 'POST':
         form = PasswordForm(request.POST)
         if form.is_valid():
+            # cached users must not be saved
+            ldap_user = get_object_or_404(User, name=request.user.username)
             ldap_user.set_password(form.cleaned_data['password_1'])
             return HttpResponseRedirect(reverse('index'))
     else:
@@ -369,7 +440,7 @@ def change_own_password(request):
 
 
 def get_user_mobileconfig(request):
-    user = get_object_or_404(User, name=request.user.username)
+    user = User.get_cached_or_404(name=request.user.username)
     password = request.GET.get('password', '')
     if not password:
         password = user.read_password()
@@ -382,11 +453,7 @@ def get_user_mobileconfig(request):
             (user.email_certificate_entry, _('Email certificate')),
             (user.signature_certificate_entry, _('Signature certificate')),
     ):
-        with tempfile.NamedTemporaryFile() as fd:
-            filename = fd.name
-        pki.ensure_certificate(entry)
-        pki.gen_pkcs12(entry, filename, password=password)
-        p12_certificates.append((filename, title))
+        p12_certificates.append((pki.get_pkcs12(entry, password=password), title))
 
     def f_scheme(y):
         if y in ('caldav', 'carddav'):
@@ -438,7 +505,5 @@ def get_user_mobileconfig(request):
 
     template_values['email_servers'] = list(mail_services.values())
     response = render_to_response('penatesserver/mobileconfig.xml', template_values, content_type='application/xml')
-    for filename, title in p12_certificates:
-        os.remove(filename)
     response['Content-Disposition'] = 'attachment; filename=%s.mobileconfig' % request.user.username
     return response